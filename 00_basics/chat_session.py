@@ -0,0 +1,384 @@
+"""
+多轮对话会话：在轮次之间保留KV缓存
+
+chatbot.py 原来每一轮都把全部历史拼成提示词重新送给模型，
+历史越长每轮的预填充越慢；截断历史（[-10:]）又会让缓存全部失效。
+
+ChatSession 记录已经在KV缓存中的token：
+- 每一轮只预填充新的用户消息（回答生成时已经在缓存里了）
+- 超出上下文时按token预算淘汰最早的轮次：从KV缓存中删除这些位置，
+  再把后面的缓存整体前移（KV shift），不需要重新预填充
+- 系统提示词固定在最前面，不会被淘汰
+- 设置 summarize_after 时，历史超过这个token数后由后台线程在用户两次提问之间
+  把旧轮次压缩成摘要（01_inference/history_manager.py），摘要固定在系统提示词之后，
+  KV缓存也在空闲时重建，下一轮仍然只预填充新消息
+
+    session = ChatSession(llm, system_prompt="你是一个有帮助的助手。")
+    for text in session.chat("你好"):
+        print(text, end="")
+    print(session.last_turn)   # 本轮预填充/复用/淘汰的token数
+
+llm 是本进程内的 Llama 时直接管理KV缓存；LLMClient、OllamaBackend 等
+远程后端只能按token预算裁剪文本历史（服务端会复用相同的前缀）。
+"""
+
+import sys
+import time
+import codecs
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "01_inference"))
+
+# Qwen 系列的对话格式（ChatML）
+TURN_TEMPLATE = "<|im_start|>{role}\n{content}<|im_end|>\n"
+SUMMARY_TEMPLATE = "之前对话的摘要：{summary}"
+ASSISTANT_START = "<|im_start|>assistant\n"
+TURN_END = "<|im_end|>\n"
+
+
+def _kv_functions():
+    """llama.cpp 不同版本的KV缓存操作函数"""
+    import llama_cpp
+    if hasattr(llama_cpp, "llama_memory_seq_rm"):
+        def seq_rm(ctx, p0, p1):
+            llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(ctx), 0, p0, p1)
+
+        def seq_add(ctx, p0, p1, delta):
+            llama_cpp.llama_memory_seq_add(llama_cpp.llama_get_memory(ctx), 0, p0, p1, delta)
+
+        def can_shift(ctx):
+            return bool(llama_cpp.llama_memory_can_shift(llama_cpp.llama_get_memory(ctx)))
+    else:
+        def seq_rm(ctx, p0, p1):
+            llama_cpp.llama_kv_cache_seq_rm(ctx, 0, p0, p1)
+
+        def seq_add(ctx, p0, p1, delta):
+            llama_cpp.llama_kv_cache_seq_add(ctx, 0, p0, p1, delta)
+
+        def can_shift(ctx):
+            return True
+    return seq_rm, seq_add, can_shift
+
+
+class ChatSession:
+    """保留KV缓存的多轮对话"""
+
+    def __init__(self,
+                 llm,
+                 system_prompt: str = "你是一个有帮助的AI助手。",
+                 max_tokens: int = 256,
+                 temperature: float = 0.7,
+                 top_p: float = 0.9,
+                 repeat_penalty: float = 1.1,
+                 summarize_after: int = None):
+        """
+        Args:
+            llm: Llama 实例（或调用方式相同的远程后端）
+            system_prompt: 系统提示词（固定在最前面）
+            max_tokens: 每轮回答的最大token数（同时作为淘汰历史时预留的空间）
+            temperature / top_p / repeat_penalty: 采样参数
+            summarize_after: 历史token预算；设置后超过阈值的旧轮次在后台压缩成摘要
+        """
+        self.llm = llm
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repeat_penalty = repeat_penalty
+        self.n_ctx = llm.n_ctx()
+
+        # 本进程内的 Llama 才能直接操作KV缓存
+        self.local = hasattr(llm, "_ctx") and hasattr(llm, "generate")
+
+        system_text = TURN_TEMPLATE.format(role="system", content=system_prompt) if system_prompt else ""
+        self.system_tokens = self._tokenize(system_text, add_bos=True) if system_text else []
+        self.system_text = system_text
+        # 固定在最前面、不会被淘汰的部分：系统提示词 + 对话摘要
+        self.pinned_tokens = list(self.system_tokens)
+        self.pinned_text = system_text
+
+        self.tokens = []       # 本地模式：已经在KV缓存中的token
+        self.turns = []        # 每一轮 {'user', 'assistant', 'n_tokens'}
+        self.last_turn = None
+        self.stats = {'turns': 0, 'prefill_tokens': 0, 'reused_tokens': 0, 'evicted_tokens': 0}
+
+        self.memory = None
+        if summarize_after:
+            from history_manager import SummarizingHistory
+            self.memory = SummarizingHistory(llm, token_budget=summarize_after,
+                                             on_compact=self._on_compact)
+
+    def _tokenize(self, text: str, add_bos: bool = False):
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+
+    def history(self):
+        """当前保留的对话 [(用户, 助手), ...]"""
+        return [(t['user'], t['assistant']) for t in self.turns]
+
+    def reset(self):
+        """清空对话（保留系统提示词）"""
+        if self.memory is not None:
+            with self.memory.foreground():
+                self.memory.clear()
+                self._reset_state()
+        else:
+            self._reset_state()
+
+    def _reset_state(self):
+        self.turns = []
+        self.tokens = []
+        self.pinned_tokens = list(self.system_tokens)
+        self.pinned_text = self.system_text
+
+    def close(self):
+        """停止后台摘要线程"""
+        if self.memory is not None:
+            self.memory.close()
+
+    def chat(self, user_input: str):
+        """
+        发送一条消息，流式产出回答文本
+
+        本轮统计（预填充、复用、淘汰的token数，首token延迟）写入 self.last_turn
+        """
+        if self.memory is None:
+            yield from self._generate(user_input)
+            return
+        # 生成期间独占模型，后台摘要会被打断；结束后记入历史，需要时安排摘要
+        with self.memory.foreground():
+            yield from self._generate(user_input)
+            self.memory.add(user_input, self.turns[-1]['assistant'])
+
+    def _generate(self, user_input: str):
+        if self.local:
+            yield from self._chat_local(user_input)
+        else:
+            yield from self._chat_remote(user_input)
+
+    # ---------------- 摘要替换旧轮次（后台线程，已占用模型） ----------------
+
+    def _on_compact(self, summary: str, recent_turns):
+        summary_text = TURN_TEMPLATE.format(role="system", content=SUMMARY_TEMPLATE.format(summary=summary))
+        self.pinned_text = self.system_text + summary_text
+        self.pinned_tokens = list(self.system_tokens) + self._tokenize(summary_text)
+
+        tokens = list(self.pinned_tokens)
+        turns = []
+        for t in recent_turns:
+            turn_tokens = self._tokenize(
+                TURN_TEMPLATE.format(role="user", content=t['user']) +
+                TURN_TEMPLATE.format(role="assistant", content=t['assistant'])
+            )
+            tokens.extend(turn_tokens)
+            turns.append({'user': t['user'], 'assistant': t['assistant'], 'n_tokens': len(turn_tokens)})
+        self.turns = turns
+        self.tokens = tokens
+
+        if self.local:
+            # 趁空闲把新前缀预填充进KV缓存；用户发来消息时停下，剩下的由 _sync_state 补齐
+            self._sync_state(should_stop=self.memory.preempted)
+
+    # ---------------- 本地模式：直接管理KV缓存 ----------------
+
+    def _is_eog(self, token: int) -> bool:
+        import llama_cpp
+        if token == self.llm.token_eos():
+            return True
+        model = self.llm._model.model
+        try:
+            if hasattr(llama_cpp, "llama_vocab_is_eog"):
+                return bool(llama_cpp.llama_vocab_is_eog(llama_cpp.llama_model_get_vocab(model), token))
+            if hasattr(llama_cpp, "llama_token_is_eog"):
+                return bool(llama_cpp.llama_token_is_eog(model, token))
+        except Exception:
+            pass
+        return False
+
+    def _sync_state(self, should_stop=None, chunk_size: int = 64) -> int:
+        """
+        确认模型的KV缓存仍然是本会话的（同一个 Llama 可能被别的代码用过）
+
+        只重新预填充与缓存不同的部分；should_stop() 返回 True 时提前停下
+
+        Returns:
+            为恢复状态重新预填充的token数
+        """
+        llm = self.llm
+        if not self.tokens:
+            self.tokens = list(self.pinned_tokens)
+        cached = list(llm.input_ids[:llm.n_tokens])
+        if cached == self.tokens:
+            return 0
+
+        common = 0
+        for a, b in zip(cached, self.tokens):
+            if a != b:
+                break
+            common += 1
+        if common and common == len(self.tokens):
+            common -= 1   # 至少重算最后一个token，保证 logits 对应当前位置
+        if common > 0:
+            seq_rm, _, _ = _kv_functions()
+            seq_rm(llm._ctx.ctx, common, -1)
+            llm.n_tokens = common
+        else:
+            llm.reset()
+
+        for i in range(common, len(self.tokens), chunk_size):
+            if should_stop is not None and should_stop():
+                break
+            llm.eval(self.tokens[i:i + chunk_size])
+        return llm.n_tokens - common
+
+    def _evict(self, needed: int) -> int:
+        """
+        淘汰最早的轮次，直到能再放下 needed 个token
+
+        被淘汰的位置从KV缓存删除，之后的缓存整体前移
+
+        Returns:
+            淘汰的token数
+        """
+        budget = self.n_ctx - needed
+        if len(self.tokens) <= budget:
+            return 0
+
+        start = len(self.pinned_tokens)
+        cut = start
+        dropped = 0
+        while self.turns and len(self.tokens) - (cut - start) > budget:
+            cut += self.turns[0]['n_tokens']
+            self.turns.pop(0)
+            dropped += 1
+        if len(self.tokens) - (cut - start) > budget:
+            raise ValueError(
+                f"单轮对话过长：需要 {needed} tokens，上下文只有 {self.n_ctx - start} tokens 可用"
+            )
+
+        llm = self.llm
+        n = llm.n_tokens
+        delta = cut - start
+        seq_rm, seq_add, can_shift = _kv_functions()
+        ctx = llm._ctx.ctx
+
+        if can_shift(ctx):
+            seq_rm(ctx, start, cut)
+            seq_add(ctx, cut, -1, -delta)
+            llm._input_ids[start:n - delta] = llm._input_ids[cut:n]
+            llm.n_tokens = n - delta
+            self.tokens = self.tokens[:start] + self.tokens[cut:]
+        else:
+            # 模型不支持位置平移：只能重新预填充剩下的部分
+            self.tokens = self.tokens[:start] + self.tokens[cut:]
+            seq_rm(ctx, start, -1)
+            llm.n_tokens = start
+            llm.eval(self.tokens[start:])
+        return delta
+
+    def _chat_local(self, user_input: str):
+        llm = self.llm
+        start_time = time.time()
+        restored = self._sync_state()
+
+        new_tokens = self._tokenize(TURN_TEMPLATE.format(role="user", content=user_input) + ASSISTANT_START)
+        evicted = self._evict(len(new_tokens) + self.max_tokens + len(self._tokenize(TURN_END)) + 1)
+        reused = len(self.tokens)
+        turn_start = len(self.tokens) - len(self.pinned_tokens)
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        reply = ""
+        last_token = None
+        n_generated = 0
+        ttft = None
+
+        generator = llm.generate(
+            new_tokens,
+            temp=self.temperature,
+            top_p=self.top_p,
+            repeat_penalty=self.repeat_penalty,
+            reset=False
+        )
+        try:
+            for token in generator:
+                if ttft is None:
+                    ttft = time.time() - start_time
+                if self._is_eog(token):
+                    last_token = None
+                    break
+                last_token = token
+                n_generated += 1
+                text = decoder.decode(llm.detokenize([token]))
+                reply += text
+                yield text
+                if n_generated >= self.max_tokens:
+                    break
+        finally:
+            generator.close()
+
+        # 最后一个采样出的token还没送入模型；补上它和轮次结束标记，下一轮直接接着用
+        closing = ([last_token] if last_token is not None else []) + self._tokenize(TURN_END)
+        llm.eval(closing)
+        self.tokens = list(llm.input_ids[:llm.n_tokens])
+
+        self.turns.append({
+            'user': user_input,
+            'assistant': reply,
+            'n_tokens': len(self.tokens) - len(self.pinned_tokens) - turn_start
+        })
+        self._record(len(new_tokens) + restored, reused - restored, evicted, ttft, n_generated, start_time)
+
+    # ---------------- 远程模式：按token预算裁剪文本历史 ----------------
+
+    def _chat_remote(self, user_input: str):
+        start_time = time.time()
+        user_text = TURN_TEMPLATE.format(role="user", content=user_input) + ASSISTANT_START
+        needed = len(self._tokenize(user_text)) + self.max_tokens
+
+        # 一次多淘汰一些（到预算的3/4），避免之后每一轮都改变前缀
+        evicted = 0
+        history_tokens = len(self.pinned_tokens) + sum(t['n_tokens'] for t in self.turns)
+        if history_tokens + needed > self.n_ctx:
+            target = self.n_ctx * 3 // 4 - needed
+            while self.turns and history_tokens > target:
+                history_tokens -= self.turns[0]['n_tokens']
+                evicted += self.turns.pop(0)['n_tokens']
+
+        prompt = self.pinned_text + "".join(
+            TURN_TEMPLATE.format(role="user", content=t['user']) +
+            TURN_TEMPLATE.format(role="assistant", content=t['assistant'])
+            for t in self.turns
+        ) + user_text
+
+        reply = ""
+        n_generated = 0
+        ttft = None
+        for chunk in self.llm(prompt, max_tokens=self.max_tokens, temperature=self.temperature,
+                              top_p=self.top_p, repeat_penalty=self.repeat_penalty,
+                              stop=["<|im_end|>", "<|im_start|>"], stream=True):
+            if ttft is None:
+                ttft = time.time() - start_time
+            text = chunk['choices'][0]['text']
+            n_generated += 1
+            reply += text
+            yield text
+
+        turn_text = TURN_TEMPLATE.format(role="user", content=user_input) + \
+            TURN_TEMPLATE.format(role="assistant", content=reply)
+        self.turns.append({'user': user_input, 'assistant': reply,
+                           'n_tokens': len(self._tokenize(turn_text))})
+        # 远程后端看不到缓存命中情况，这里按整段提示词计
+        self._record(len(self._tokenize(prompt, add_bos=True)), 0, evicted, ttft, n_generated, start_time)
+
+    def _record(self, prefill, reused, evicted, ttft, n_generated, start_time):
+        self.last_turn = {
+            'prefill_tokens': prefill,
+            'reused_tokens': reused,
+            'evicted_tokens': evicted,
+            'generated_tokens': n_generated,
+            'ttft': ttft or 0.0,
+            'total_time': time.time() - start_time
+        }
+        self.stats['turns'] += 1
+        self.stats['prefill_tokens'] += prefill
+        self.stats['reused_tokens'] += reused
+        self.stats['evicted_tokens'] += evicted
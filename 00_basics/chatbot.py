@@ -1,19 +1,25 @@
-from llama_cpp import Llama
 import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "01_inference"))
+from llm_server import connect_or_load
+from chat_session import ChatSession
 
 # 加载模型
 print("正在加载模型...")
-llm = Llama(
+llm = connect_or_load(
     model_path="/Users/a58/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf",
     n_ctx=2048,
-    n_threads=4,
     n_gpu_layers=0,
     verbose=False
 )
 print("模型加载完成！输入 'exit' 退出\n")
 
-# 对话循环
-conversation_history = []
+# 对话会话：KV缓存在轮次之间保留，每轮只预填充新消息；
+# 历史超过768 tokens后，在等待输入的空闲时间里把旧轮次压缩成摘要
+session = ChatSession(llm, system_prompt="你是一个有帮助的AI助手。", max_tokens=256, temperature=0.7,
+                      summarize_after=768)
 
 while True:
     # 获取用户输入
@@ -21,30 +27,14 @@ while True:
     
     if user_input.lower() in ['exit', 'quit', '退出']:
         print("再见！")
+        session.close()
         break
     
-    # 构建prompt（包含历史）
-    conversation_history.append(f"用户: {user_input}")
-    prompt = "\n".join(conversation_history) + "\n助手: "
-    
     # 流式生成回复
     print("AI: ", end="", flush=True)
-    response = ""
-    for output in llm(
-        prompt,
-        max_tokens=256,
-        temperature=0.7,
-        stop=["用户:", "\n\n"],
-        stream=True
-    ):
-        text = output['choices'][0]['text']
+    for text in session.chat(user_input):
         print(text, end="", flush=True)
-        response += text
     
-    print("\n")  # 换行
-    conversation_history.append(f"助手: {response.strip()}")
-    
-    # 限制历史长度（避免超出上下文）
-    if len(conversation_history) > 10:
-        conversation_history = conversation_history[-10:]
-
+    turn = session.last_turn
+    print(f"\n   [预填充 {turn['prefill_tokens']} tokens, 复用 {turn['reused_tokens']} tokens, "
+          f"首字 {turn['ttft']*1000:.0f}ms, 历史 {session.memory.total_tokens()} tokens]\n")
@@ -1,11 +1,15 @@
-from llama_cpp import Llama
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "01_inference"))
+from llm_server import connect_or_load
 
 # 加载模型（纯CPU模式）
 print("正在加载模型...")
-llm = Llama(
+llm = connect_or_load(
     model_path="/Users/a58/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf",
     n_ctx=2048,       # 上下文长度
-    n_threads=4,      # CPU线程数
     n_gpu_layers=0,   # 0 = 纯CPU模式
     verbose=False     # 不显示加载信息
 )
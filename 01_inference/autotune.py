@@ -0,0 +1,297 @@
+"""
+llama.cpp 运行参数自动调优
+
+benchmark_quantization 只测一个总速度，而且线程数写死为6。
+这个工具在本机对一个模型扫描：
+- n_threads / n_threads_batch：解码和预填充分别选最快的线程数
+- n_batch：预填充的batch大小
+- use_mmap / use_mlock：加载时间与内存占用
+- n_ctx：不同上下文长度的内存占用和解码速度
+
+分别测量预填充速度（tokens/秒）、解码速度（tokens/秒）和峰值内存（RSS），
+最佳配置保存到 ~/.cache/myllm/llama_profiles.json，
+之后 llama_factory.create_llama（以及 connect_or_load、llm_server）自动使用。
+
+用法：
+    python autotune.py                      # 使用 find_gguf_models() 找到的第一个模型
+    python autotune.py --model ~/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf
+    python autotune.py --threads 2,4,6,8 --batch 128,256,512 --ctx 2048,4096
+    python autotune.py --show               # 查看已保存的配置
+
+每组参数在独立子进程中测量，保证内存和加载时间互不影响。
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from pathlib import Path
+
+from llama_factory import host_key, load_profile, save_profile, PROFILE_FILE
+
+# 预填充文本（重复到需要的token数）和解码用的短问题
+PREFILL_TEXT = (
+    "中华人民共和国道路交通安全法规定，机动车驾驶人应当遵守道路交通安全法律、法规的规定，"
+    "按照操作规范安全驾驶、文明驾驶。饮酒、服用国家管制的精神药品或者麻醉药品，"
+    "或者患有妨碍安全驾驶机动车的疾病，或者过度疲劳影响安全驾驶的，不得驾驶机动车。"
+)
+DECODE_PROMPT = "<|im_start|>user\n介绍一下大语言模型的推理过程。<|im_end|>\n<|im_start|>assistant\n"
+
+
+def _peak_rss_mb() -> float:
+    """本进程的峰值内存（MB）"""
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位是KB，macOS 是字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _total_memory_mb() -> float:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0.0
+
+
+def _prefill_tokens(llm, n_tokens: int, decode_tokens: int):
+    """重复 PREFILL_TEXT 直到 n_tokens 个token（不超过上下文长度）"""
+    limit = max(16, min(n_tokens, llm.n_ctx() - decode_tokens - 64))
+    unit = llm.tokenize(PREFILL_TEXT.encode("utf-8"), add_bos=False)
+    tokens = [llm.token_bos()]
+    while len(tokens) < limit:
+        tokens.extend(unit)
+    return tokens[:limit]
+
+
+def _measure_in_process(model_path: str, params: dict, decode_tokens: int, prefill_tokens: int) -> dict:
+    """子进程中执行的测量逻辑（见 measure）"""
+    from llama_cpp import Llama
+
+    start = time.perf_counter()
+    llm = Llama(model_path=model_path, verbose=False, **params)
+    load_time = time.perf_counter() - start
+
+    # 1. 预填充：一次送入长提示词（n_batch 较小时分成多个batch）
+    tokens = _prefill_tokens(llm, prefill_tokens, decode_tokens)
+    llm.reset()
+    start = time.perf_counter()
+    llm.eval(tokens)
+    prefill_time = time.perf_counter() - start
+
+    # 2. 解码：从第一个token之后开始计时，排除预填充
+    llm.reset()
+    first_at = last_at = None
+    n = 0
+    for _ in llm(DECODE_PROMPT, max_tokens=decode_tokens, temperature=0, stream=True):
+        now = time.perf_counter()
+        if first_at is None:
+            first_at = now
+        last_at = now
+        n += 1
+    decode_time = (last_at - first_at) if n > 1 else 0.0
+
+    return {
+        'load_time': load_time,
+        'prefill_tps': len(tokens) / prefill_time if prefill_time > 0 else 0.0,
+        'prefill_tokens': len(tokens),
+        'decode_tps': (n - 1) / decode_time if decode_time > 0 else 0.0,
+        'rss_mb': _peak_rss_mb()
+    }
+
+
+def measure(model_path: str, params: dict, decode_tokens: int = 64, prefill_tokens: int = 2048) -> dict:
+    """在独立子进程中测量一组参数"""
+    try:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--measure",
+             "--model", model_path, "--params", json.dumps(params),
+             "--decode-tokens", str(decode_tokens), "--prefill-tokens", str(prefill_tokens)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    except (subprocess.CalledProcessError, ValueError, IndexError) as e:
+        return {'error': str(e)}
+
+
+def _describe(params: dict) -> str:
+    return ", ".join(f"{k}={v}" for k, v in params.items())
+
+
+def _run(model_path: str, params: dict, results: list, decode_tokens: int, prefill_tokens: int) -> dict:
+    result = measure(model_path, params, decode_tokens, prefill_tokens)
+    results.append({'params': dict(params), **result})
+    if 'error' in result:
+        print(f"   {_describe(params):<60} ❌ 失败")
+    else:
+        print(f"   {_describe(params):<60} 预填充 {result['prefill_tps']:>7.1f} t/s  "
+              f"解码 {result['decode_tps']:>6.2f} t/s  RSS {result['rss_mb']:>7.0f}MB  "
+              f"加载 {result['load_time']:.2f}s")
+    return result
+
+
+def autotune(model_path: str,
+             threads=None,
+             batches=(128, 256, 512, 1024),
+             contexts=(2048, 4096, 8192),
+             decode_tokens: int = 64,
+             max_rss_mb: float = None) -> dict:
+    """
+    逐项扫描参数（每一项在前面选出的最佳值基础上进行）
+
+    Args:
+        model_path: GGUF模型路径
+        threads: 候选线程数，默认 1..逻辑核心数 中的若干个
+        batches: 候选 n_batch
+        contexts: 候选 n_ctx
+        decode_tokens: 每次测量生成的token数
+        max_rss_mb: 推荐 n_ctx 时允许的最大内存，默认物理内存的一半
+
+    Returns:
+        调优配置（params + 测量记录）
+    """
+    cpu = os.cpu_count() or 4
+    threads = threads or sorted({t for t in (1, 2, 4, 6, 8, 12, 16, cpu // 2, cpu) if 0 < t <= cpu})
+    max_rss_mb = max_rss_mb or _total_memory_mb() / 2 or float("inf")
+    results = []
+    # 预填充输入至少是最大候选 n_batch 的2倍，否则大的 n_batch 都是一个batch送完，比不出差别；
+    # 基准上下文放得下它（按256对齐）
+    prefill_tokens = 2 * max(batches)
+    base_ctx = max(2048, -(-(prefill_tokens + decode_tokens + 64) // 256) * 256)
+    base = {'n_ctx': base_ctx, 'n_batch': 512}
+    print(f"   预填充输入: {prefill_tokens} tokens（基准 n_ctx={base_ctx}）")
+
+    def run(params):
+        return _run(model_path, params, results, decode_tokens, prefill_tokens)
+
+    def ok(result):
+        return 'error' not in result
+
+    # 1. 线程数：解码和预填充分别选择
+    print("\n🧵 [1/4] 线程数")
+    by_threads = {}
+    for t in threads:
+        by_threads[t] = run({**base, 'n_threads': t, 'n_threads_batch': t})
+    valid = {t: r for t, r in by_threads.items() if ok(r)}
+    if not valid:
+        raise RuntimeError("所有线程配置都测量失败，请检查模型路径和 llama-cpp-python 安装")
+    best = {
+        'n_threads': max(valid, key=lambda t: valid[t]['decode_tps']),
+        'n_threads_batch': max(valid, key=lambda t: valid[t]['prefill_tps'])
+    }
+
+    # 2. batch大小：影响预填充
+    print("\n📦 [2/4] n_batch")
+    by_batch = {b: run({**base, **best, 'n_batch': b}) for b in batches}
+    valid = {b: r for b, r in by_batch.items() if ok(r)}
+    best['n_batch'] = max(valid, key=lambda b: valid[b]['prefill_tps']) if valid else base['n_batch']
+
+    # 3. mmap/mlock：加载时间与内存
+    print("\n💾 [3/4] use_mmap / use_mlock")
+    memory_modes = [
+        {'use_mmap': True, 'use_mlock': False},
+        {'use_mmap': False, 'use_mlock': False},
+        {'use_mmap': True, 'use_mlock': True}
+    ]
+    by_mode = []
+    for mode in memory_modes:
+        result = run({**base, **best, **mode})
+        if ok(result):
+            by_mode.append((mode, result))
+    if by_mode:
+        # 解码速度在最快的95%以内时，选加载最快的
+        fastest = max(r['decode_tps'] for _, r in by_mode)
+        candidates = [(m, r) for m, r in by_mode if r['decode_tps'] >= fastest * 0.95]
+        best.update(min(candidates, key=lambda mr: mr[1]['load_time'])[0])
+
+    # 4. 上下文长度：记录内存占用，推荐不超过内存上限的最大值
+    print("\n📏 [4/4] n_ctx")
+    # （上下文较小时预填充输入按上下文截断）
+    by_ctx = {c: run({**best, 'n_ctx': c}) for c in contexts}
+    fitting = [c for c, r in by_ctx.items() if ok(r) and r['rss_mb'] <= max_rss_mb]
+    best['n_ctx'] = max(fitting) if fitting else 2048
+
+    final = by_ctx.get(best['n_ctx']) or {}
+    return {
+        'params': best,
+        'host': host_key(),
+        'model': os.path.basename(model_path),
+        'tuned_at': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'summary': {k: final.get(k) for k in ('prefill_tps', 'decode_tps', 'rss_mb', 'load_time')},
+        'results': results
+    }
+
+
+def _parse_list(text: str, cast=int):
+    return [cast(x) for x in text.split(",") if x.strip()] if text else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="llama.cpp 运行参数自动调优")
+    parser.add_argument("--model", help="GGUF模型路径（默认使用找到的第一个模型）")
+    parser.add_argument("--threads", help="候选线程数，逗号分隔")
+    parser.add_argument("--batch", default="128,256,512,1024", help="候选 n_batch，逗号分隔")
+    parser.add_argument("--ctx", default="2048,4096,8192", help="候选 n_ctx，逗号分隔")
+    parser.add_argument("--decode-tokens", type=int, default=64, help="每次测量生成的token数")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="推荐 n_ctx 时的内存上限")
+    parser.add_argument("--show", action="store_true", help="显示已保存的配置")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--params", default="{}", help=argparse.SUPPRESS)
+    parser.add_argument("--prefill-tokens", type=int, default=2048, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # 子进程测量模式（见 measure）
+        print(json.dumps(_measure_in_process(args.model, json.loads(args.params), args.decode_tokens,
+                                             args.prefill_tokens)))
+        return
+
+    if args.model:
+        model_path = Path(args.model).expanduser()
+    else:
+        from test_llamacpp import find_gguf_models
+        models = find_gguf_models()
+        if not models:
+            print("❌ 未找到GGUF模型，请用 --model 指定")
+            sys.exit(1)
+        model_path = models[0]
+
+    if args.show:
+        profile = load_profile(model_path)
+        if profile is None:
+            print(f"❌ {model_path.name} 在本机 ({host_key()}) 还没有调优配置")
+        else:
+            print(json.dumps({k: v for k, v in profile.items() if k != 'results'},
+                             ensure_ascii=False, indent=2))
+        return
+
+    print("=" * 60)
+    print(f"🔧 自动调优: {model_path.name}")
+    print(f"   主机: {host_key()}")
+    print("=" * 60)
+
+    profile = autotune(
+        str(model_path),
+        threads=_parse_list(args.threads),
+        batches=_parse_list(args.batch),
+        contexts=_parse_list(args.ctx),
+        decode_tokens=args.decode_tokens,
+        max_rss_mb=args.max_rss_mb
+    )
+    save_profile(model_path, profile)
+
+    summary = profile['summary']
+    print("\n" + "=" * 60)
+    print("✅ 最佳配置:")
+    for key, value in profile['params'].items():
+        print(f"   {key}: {value}")
+    if summary.get('decode_tps') is not None:
+        print(f"\n   预填充 {summary['prefill_tps']:.1f} t/s, 解码 {summary['decode_tps']:.2f} t/s, "
+              f"RSS {summary['rss_mb']:.0f}MB")
+    print(f"\n💾 已保存到 {PROFILE_FILE}")
+    print("   create_llama / connect_or_load / llm_server 会自动使用")
+
+
+if __name__ == "__main__":
+    main()
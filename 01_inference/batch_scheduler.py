@@ -0,0 +1,512 @@
+"""
+连续批处理（continuous batching）生成调度器
+
+一个 Llama 实例一次只能服务一个请求：并发用户必须排队，
+聚合吞吐量（tokens/秒）不随并发数增长。
+
+这个调度器在同一份模型权重上创建一个多序列上下文，每个请求占用
+一个序列槽（seq_id）。后台线程每一步把所有请求拼进一个batch：
+- 还在预填充（prefill）的请求放入下一段提示词token
+- 已经在解码（decode）的请求各放入1个token
+一次 llama_decode 同时推进所有请求，新请求随时加入空闲槽位，
+结束的请求立即释放槽位。
+
+用法与 Llama.__call__ 相同，可以直接传给 ProductionRAG(llm=...)：
+
+    llm = Llama(model_path=..., n_ctx=4096)
+    scheduler = BatchScheduler(llm, n_slots=4)
+    for chunk in scheduler(prompt, max_tokens=200, stream=True):
+        print(chunk['choices'][0]['text'], end="")
+"""
+
+import time
+import queue
+import itertools
+import codecs
+import threading
+from typing import Optional
+import numpy as np
+import llama_cpp
+
+
+# ============================================================
+# llama.cpp 底层API的版本差异
+# ============================================================
+
+def _new_context(model, params):
+    if hasattr(llama_cpp, "llama_init_from_model"):
+        return llama_cpp.llama_init_from_model(model, params)
+    return llama_cpp.llama_new_context_with_model(model, params)
+
+
+def _seq_rm(ctx, seq_id: int, p0: int = -1, p1: int = -1):
+    """删除某个序列在KV缓存中 [p0, p1) 的位置（默认全部）"""
+    if hasattr(llama_cpp, "llama_memory_seq_rm"):
+        llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(ctx), seq_id, p0, p1)
+    else:
+        llama_cpp.llama_kv_cache_seq_rm(ctx, seq_id, p0, p1)
+
+
+# ============================================================
+# 请求
+# ============================================================
+
+class GenerationRequest:
+    """一个生成请求的状态（只由调度线程修改）"""
+
+    # 请求在多个线程里创建；count() 的 next() 在CPython里是原子的，不会发出重复的id
+    _ids = itertools.count(1)
+
+    def __init__(self, prompt_tokens, max_tokens, temperature, top_p, stop, seed=None):
+        self.id = f"cmpl-batch-{next(GenerationRequest._ids)}"
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stop = [s for s in (stop or []) if s]
+        self.rng = np.random.default_rng(seed)
+
+        self.seq_id = None
+        self.n_prefilled = 0          # 已送入模型的提示词token数
+        self.n_past = 0               # 该序列在KV缓存中的位置
+        self.next_token = None        # 下一步要送入模型的token
+        self.completion_tokens = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.text = ""                # 已生成的全部文本
+        self.emitted = 0              # 已经推送给调用方的字符数
+
+        self.output = queue.Queue()   # 推送给调用方的chunk，None表示结束
+        self.finished = False
+        self.cancelled = False        # 调用方提前停止读取
+        self.submitted_at = time.time()
+        self.first_token_at = None
+
+    @property
+    def prefilling(self) -> bool:
+        return self.n_prefilled < len(self.prompt_tokens)
+
+
+# ============================================================
+# 调度器
+# ============================================================
+
+class BatchScheduler:
+    """
+    多序列连续批处理调度器
+
+    与 LLMServer 配合时声明自己是线程安全的，服务端不再串行化请求
+    """
+
+    thread_safe = True
+
+    def __init__(self, llm, n_slots: int = 4, n_ctx: int = None, n_batch: int = 512):
+        """
+        Args:
+            llm: 已加载的 Llama 实例（共享它的模型权重和分词器）
+            n_slots: 同时解码的最大请求数
+            n_ctx: 多序列上下文的总KV容量，默认 llm.n_ctx() * n_slots
+            n_batch: 每一步最多送入模型的token数（预填充按这个预算切段）
+        """
+        self.llm = llm
+        self.n_slots = n_slots
+        self.n_batch = n_batch
+        self.n_ctx_total = n_ctx or llm.n_ctx() * n_slots
+        self.n_ctx_per_seq = self.n_ctx_total // n_slots
+        self.n_vocab = llm.n_vocab()
+        self.eos = llm.token_eos()
+        self.model = llm._model.model
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx_total
+        params.n_batch = n_batch
+        params.n_seq_max = n_slots
+        if hasattr(params, "n_ubatch"):
+            params.n_ubatch = min(n_batch, 512)
+        params.n_threads = llm.context_params.n_threads
+        params.n_threads_batch = llm.context_params.n_threads_batch
+        self.ctx = _new_context(self.model, params)
+        if not self.ctx:
+            raise RuntimeError("创建多序列上下文失败")
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+
+        self.waiting = queue.Queue()
+        self.slots = [None] * n_slots
+        self.closed = False
+
+        # 统计
+        self.stats = {
+            'steps': 0,
+            'batch_tokens': 0,
+            'generated_tokens': 0,
+            'completed_requests': 0,
+            'started_at': time.time()
+        }
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    # ---------------- 与 Llama 相同的接口 ----------------
+
+    def n_ctx(self) -> int:
+        """单个请求可用的上下文长度"""
+        return self.n_ctx_per_seq
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return self.llm.tokenize(text, add_bos=add_bos, special=special)
+
+    def __call__(self,
+                 prompt: str,
+                 max_tokens: Optional[int] = 16,
+                 temperature: float = 0.8,
+                 top_p: float = 0.95,
+                 stop=None,
+                 stream: bool = False,
+                 seed: int = None,
+                 **kwargs):
+        """
+        提交一个生成请求（参数和返回值与 Llama.__call__ 相同）
+
+        不支持的采样参数（repeat_penalty、top_k等）会被忽略
+        """
+        request = self.submit(prompt, max_tokens, temperature, top_p, stop, seed)
+        if stream:
+            return self._stream(request)
+
+        text = ""
+        finish_reason = None
+        for chunk in self._stream(request):
+            text += chunk['choices'][0]['text']
+            finish_reason = chunk['choices'][0]['finish_reason'] or finish_reason
+        return {
+            'id': request.id,
+            'object': 'text_completion',
+            'created': int(request.submitted_at),
+            'choices': [{'text': text, 'index': 0, 'logprobs': None, 'finish_reason': finish_reason}],
+            'usage': {
+                'prompt_tokens': len(request.prompt_tokens),
+                'completion_tokens': request.completion_tokens,
+                'total_tokens': len(request.prompt_tokens) + request.completion_tokens
+            }
+        }
+
+    create_completion = __call__
+
+    # ---------------- 提交与输出 ----------------
+
+    def submit(self, prompt: str, max_tokens: Optional[int] = 16, temperature: float = 0.8,
+               top_p: float = 0.95, stop=None, seed: int = None) -> GenerationRequest:
+        """
+        提交请求，立即返回（输出从 request.output 读取）
+
+        max_tokens 为 None 或 <= 0 时与 Llama.__call__ 一样，一直生成到上下文用完
+        """
+        if self.closed:
+            raise RuntimeError("调度器已关闭")
+        if isinstance(stop, str):
+            stop = [stop]
+
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        available = self.n_ctx_per_seq - len(tokens)
+        if available <= 0:
+            raise ValueError(
+                f"提示词过长: {len(tokens)} tokens，单个请求上下文为 {self.n_ctx_per_seq}"
+            )
+        if max_tokens is None or max_tokens <= 0 or max_tokens > available:
+            max_tokens = available
+
+        request = GenerationRequest(tokens, max_tokens, temperature, top_p, stop, seed)
+        self.waiting.put(request)
+        return request
+
+    def _stream(self, request: GenerationRequest):
+        try:
+            while True:
+                item = request.output.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 调用方中途放弃（例如客户端断开），通知调度线程释放槽位
+            if not request.finished:
+                request.cancelled = True
+
+    def _emit(self, request: GenerationRequest, text: str, finish_reason=None):
+        request.output.put({
+            'id': request.id,
+            'object': 'text_completion',
+            'created': int(request.submitted_at),
+            'choices': [{'text': text, 'index': 0, 'logprobs': None, 'finish_reason': finish_reason}]
+        })
+
+    # ---------------- 调度循环 ----------------
+
+    def _admit(self, block: bool):
+        """把等待中的请求放入空闲槽位"""
+        for seq_id in range(self.n_slots):
+            if self.slots[seq_id] is not None:
+                continue
+            try:
+                request = self.waiting.get(block=block, timeout=0.1 if block else None)
+            except queue.Empty:
+                return
+            block = False
+            if request is None:
+                continue
+            request.seq_id = seq_id
+            self.slots[seq_id] = request
+
+    def _build_batch(self):
+        """
+        组装一步的batch
+
+        Returns:
+            [(batch内下标, request)]：需要在这一步采样的请求
+        """
+        batch = self.batch
+        n = 0
+        sample_at = []
+
+        def add(token, pos, seq_id, logits):
+            nonlocal n
+            batch.token[n] = token
+            batch.pos[n] = pos
+            batch.n_seq_id[n] = 1
+            batch.seq_id[n][0] = seq_id
+            batch.logits[n] = logits
+            n += 1
+
+        # 1. 解码中的请求各放入1个token（优先，保证已经在出字的请求不卡顿）
+        for request in self.slots:
+            if request is not None and not request.prefilling:
+                add(request.next_token, request.n_past, request.seq_id, True)
+                sample_at.append((n - 1, request))
+                request.n_past += 1
+
+        # 2. 预填充中的请求按剩余预算放入提示词片段
+        for request in self.slots:
+            if request is None or not request.prefilling or n >= self.n_batch:
+                continue
+            remaining = len(request.prompt_tokens) - request.n_prefilled
+            take = min(remaining, self.n_batch - n)
+            for i in range(take):
+                is_last = request.n_prefilled + i == len(request.prompt_tokens) - 1
+                add(request.prompt_tokens[request.n_prefilled + i], request.n_past + i,
+                    request.seq_id, is_last)
+                if is_last:
+                    sample_at.append((n - 1, request))
+            request.n_prefilled += take
+            request.n_past += take
+
+        batch.n_tokens = n
+        return sample_at
+
+    def _sample(self, logits: np.ndarray, request: GenerationRequest) -> int:
+        if request.temperature <= 0:
+            return int(np.argmax(logits))
+
+        logits = logits.astype(np.float64) / request.temperature
+        probs = np.exp(logits - logits.max())
+        probs /= probs.sum()
+
+        if request.top_p < 1.0:
+            order = np.argsort(-probs)
+            cumulative = np.cumsum(probs[order])
+            keep = order[:int(np.searchsorted(cumulative, request.top_p)) + 1]
+            filtered = np.zeros_like(probs)
+            filtered[keep] = probs[keep]
+            probs = filtered / filtered.sum()
+
+        return int(request.rng.choice(self.n_vocab, p=probs))
+
+    def _is_eog(self, token: int) -> bool:
+        if token == self.eos:
+            return True
+        try:
+            if hasattr(llama_cpp, "llama_vocab_is_eog"):
+                vocab = llama_cpp.llama_model_get_vocab(self.model)
+                return bool(llama_cpp.llama_vocab_is_eog(vocab, token))
+            if hasattr(llama_cpp, "llama_token_is_eog"):
+                return bool(llama_cpp.llama_token_is_eog(self.model, token))
+        except Exception:
+            pass
+        return False
+
+    def _finish(self, request: GenerationRequest, finish_reason: str):
+        """推送剩余文本，释放槽位和KV缓存"""
+        tail = request.text[request.emitted:]
+        request.emitted = len(request.text)
+        self._emit(request, tail, finish_reason)
+        request.output.put(None)
+        request.finished = True
+
+        _seq_rm(self.ctx, request.seq_id)
+        self.slots[request.seq_id] = None
+        self.stats['completed_requests'] += 1
+
+    def _on_token(self, request: GenerationRequest, token: int):
+        """处理一个新采样的token：停止条件、文本推送"""
+        if request.first_token_at is None:
+            request.first_token_at = time.time()
+
+        if self._is_eog(token):
+            self._finish(request, "stop")
+            return
+
+        request.completion_tokens += 1
+        self.stats['generated_tokens'] += 1
+        request.text += request.decoder.decode(self.llm.detokenize([token]))
+
+        # 停止词：截断并结束
+        for stop in request.stop:
+            pos = request.text.find(stop)
+            if pos != -1:
+                request.text = request.text[:pos]
+                self._finish(request, "stop")
+                return
+
+        if request.completion_tokens >= request.max_tokens:
+            self._finish(request, "length")
+            return
+
+        # 末尾可能是停止词的前半部分，先扣住不推送
+        hold = max((len(s) - 1 for s in request.stop), default=0)
+        safe = max(request.emitted, len(request.text) - hold)
+        if safe > request.emitted:
+            self._emit(request, request.text[request.emitted:safe])
+            request.emitted = safe
+
+        request.next_token = token
+
+    def _fail_all(self, error: Exception):
+        for request in self.slots:
+            if request is not None:
+                request.output.put(error)
+                request.output.put(None)
+                request.finished = True
+                self.slots[request.seq_id] = None
+                try:
+                    _seq_rm(self.ctx, request.seq_id)
+                except Exception:
+                    pass
+
+    def _run(self):
+        while not self.closed:
+            # 任何一步出错（分词、采样、numpy……）都只让当前槽位里的请求失败，
+            # 调度线程继续运行；否则所有调用方会永远阻塞在 output.get()
+            try:
+                self._step()
+            except Exception as e:
+                self._fail_all(e)
+
+    def _step(self):
+        idle = all(slot is None for slot in self.slots)
+        self._admit(block=idle)
+        for request in self.slots:
+            if request is not None and request.cancelled:
+                self._finish(request, "cancelled")
+        if all(slot is None for slot in self.slots):
+            return
+
+        sample_at = self._build_batch()
+        if self.batch.n_tokens == 0:
+            return
+
+        ret = llama_cpp.llama_decode(self.ctx, self.batch)
+        self.stats['steps'] += 1
+        self.stats['batch_tokens'] += self.batch.n_tokens
+        if ret != 0:
+            self._fail_all(RuntimeError(f"llama_decode 失败 (返回值 {ret})，可能是KV缓存已满"))
+            return
+
+        for index, request in sample_at:
+            ptr = llama_cpp.llama_get_logits_ith(self.ctx, index)
+            logits = np.ctypeslib.as_array(ptr, shape=(self.n_vocab,))
+            self._on_token(request, self._sample(logits, request))
+
+    def throughput(self) -> dict:
+        """聚合吞吐统计"""
+        elapsed = time.time() - self.stats['started_at']
+        steps = max(self.stats['steps'], 1)
+        return {
+            'generated_tokens': self.stats['generated_tokens'],
+            'tokens_per_sec': self.stats['generated_tokens'] / elapsed if elapsed > 0 else 0.0,
+            'avg_batch_tokens': self.stats['batch_tokens'] / steps,
+            'completed_requests': self.stats['completed_requests']
+        }
+
+    def close(self):
+        """停止调度线程并释放上下文"""
+        self.closed = True
+        self.waiting.put(None)
+        self.thread.join()
+        self._fail_all(RuntimeError("调度器已关闭"))
+        while True:
+            try:
+                request = self.waiting.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.output.put(RuntimeError("调度器已关闭"))
+                request.output.put(None)
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+
+# ============================================================
+# 演示：串行 vs 连续批处理
+# ============================================================
+
+if __name__ == "__main__":
+    import os
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    model_path = sys.argv[1] if len(sys.argv) > 1 else os.path.expanduser(
+        "~/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf"
+    )
+    if not os.path.exists(model_path):
+        print(f"❌ 模型文件不存在: {model_path}")
+        sys.exit(1)
+
+    prompts = [
+        "醉驾会受到什么处罚？",
+        "闯红灯扣几分？",
+        "驾驶证扣满12分怎么办？",
+        "交通事故后应该怎么处理？"
+    ]
+    formatted = [
+        f"<|im_start|>user\n{p}<|im_end|>\n<|im_start|>assistant\n" for p in prompts
+    ]
+
+    print("📦 加载模型...")
+    llm = llama_cpp.Llama(model_path=model_path, n_ctx=2048, verbose=False)
+
+    print("\n⏱️  串行生成（单个Llama实例）:")
+    start = time.time()
+    total = 0
+    for prompt in formatted:
+        output = llm(prompt, max_tokens=128, temperature=0, stop=["<|im_end|>"])
+        total += output['usage']['completion_tokens']
+    serial_time = time.time() - start
+    print(f"   {total} tokens, {serial_time:.2f}秒, {total / serial_time:.2f} tokens/秒")
+
+    print(f"\n⏱️  连续批处理（{len(prompts)} 个并发请求）:")
+    scheduler = BatchScheduler(llm, n_slots=len(prompts))
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+        outputs = list(pool.map(
+            lambda p: scheduler(p, max_tokens=128, temperature=0, stop=["<|im_end|>"]),
+            formatted
+        ))
+    batch_time = time.time() - start
+    total = sum(o['usage']['completion_tokens'] for o in outputs)
+    print(f"   {total} tokens, {batch_time:.2f}秒, {total / batch_time:.2f} tokens/秒")
+    print(f"   平均每步batch: {scheduler.throughput()['avg_batch_tokens']:.1f} tokens")
+
+    for prompt, output in zip(prompts, outputs):
+        print(f"\n❓ {prompt}")
+        print(f"💬 {output['choices'][0]['text'].strip()[:100]}")
+
+    scheduler.close()
@@ -0,0 +1,370 @@
+"""
+GGUF模型目录（只读文件头，不加载模型）
+
+find_gguf_models 每次运行都递归扫描家目录下的模型文件夹，
+而要知道一个模型的量化方式、上下文长度、参数量，只能把它加载进来。
+
+GGUF文件开头是元数据（键值对）和张量信息表，张量数据在后面。
+这个模块只解析文件头：
+- 架构、模型名、量化方式（general.file_type）
+- 上下文长度、层数、隐藏维度、词表大小
+- 参数量（张量形状相乘求和）
+解析结果按 路径 + 修改时间 + 大小 缓存在 ~/.cache/myllm/gguf_catalog.json，
+文件没变就不再读取。Ollama 的模型（~/.ollama/models/blobs 下没有扩展名的文件）
+按文件头魔数识别。
+
+    catalog = GGUFCatalog()
+    for model in catalog.query(quant="Q4_K_M", max_size_gb=5):
+        print(model['name'], model['n_params'], model['context_length'])
+"""
+
+import os
+import json
+import time
+import struct
+from pathlib import Path
+
+from llama_factory import CACHE_DIR
+
+CATALOG_FILE = CACHE_DIR / "gguf_catalog.json"
+CATALOG_VERSION = 1
+
+DEFAULT_ROOTS = [
+    Path.home() / "llama.cpp" / "models",
+    Path.home() / ".ollama" / "models",
+    Path("/Users/a58/code/MyLLM/models")
+]
+
+GGUF_MAGIC = b"GGUF"
+
+# general.file_type -> 量化名称（llama.cpp 的 llama_ftype）
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1",
+    10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M",
+    16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S",
+    22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M",
+    28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16"
+}
+
+
+# ============================================================
+# 文件头解析
+# ============================================================
+
+# GGUF 值类型 -> struct 格式
+_SCALAR_FORMATS = {
+    0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i",
+    6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"
+}
+_TYPE_STRING = 8
+_TYPE_ARRAY = 9
+
+
+class _Reader:
+    def __init__(self, f):
+        self.f = f
+
+    def unpack(self, fmt: str):
+        size = struct.calcsize(fmt)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise ValueError("文件头不完整")
+        return struct.unpack(fmt, data)[0]
+
+    def string(self) -> str:
+        length = self.unpack("<Q")
+        return self.f.read(length).decode("utf-8", errors="replace")
+
+    def skip_string(self):
+        self.f.seek(self.unpack("<Q"), os.SEEK_CUR)
+
+    def value(self, value_type: int):
+        """读取一个值；数组只返回长度（词表等大数组不需要内容）"""
+        if value_type in _SCALAR_FORMATS:
+            return self.unpack(_SCALAR_FORMATS[value_type])
+        if value_type == _TYPE_STRING:
+            return self.string()
+        if value_type == _TYPE_ARRAY:
+            item_type = self.unpack("<I")
+            count = self.unpack("<Q")
+            if item_type in _SCALAR_FORMATS:
+                self.f.seek(struct.calcsize(_SCALAR_FORMATS[item_type]) * count, os.SEEK_CUR)
+            elif item_type == _TYPE_STRING:
+                for _ in range(count):
+                    self.skip_string()
+            else:
+                for _ in range(count):
+                    self.value(item_type)
+            return {'array_length': count}
+        raise ValueError(f"未知的GGUF值类型: {value_type}")
+
+
+def is_gguf(path) -> bool:
+    """按魔数判断是否是GGUF文件"""
+    try:
+        with open(path, "rb") as f:
+            return f.read(4) == GGUF_MAGIC
+    except OSError:
+        return False
+
+
+def read_gguf_header(path) -> dict:
+    """
+    解析GGUF文件头
+
+    Returns:
+        {'version', 'metadata': {键: 值}, 'n_tensors', 'n_params'}
+    """
+    with open(path, "rb", buffering=1 << 16) as f:
+        reader = _Reader(f)
+        if f.read(4) != GGUF_MAGIC:
+            raise ValueError(f"不是GGUF文件: {path}")
+        version = reader.unpack("<I")
+        # v1 的计数是32位
+        count_format = "<I" if version == 1 else "<Q"
+        n_tensors = reader.unpack(count_format)
+        n_kv = reader.unpack(count_format)
+
+        metadata = {}
+        for _ in range(n_kv):
+            key = reader.string()
+            metadata[key] = reader.value(reader.unpack("<I"))
+
+        n_params = 0
+        for _ in range(n_tensors):
+            reader.skip_string()
+            n_dims = reader.unpack("<I")
+            elements = 1
+            for _ in range(n_dims):
+                elements *= reader.unpack("<Q")
+            reader.unpack("<I")   # 张量类型
+            reader.unpack("<Q")   # 数据偏移
+            n_params += elements
+
+    return {'version': version, 'metadata': metadata, 'n_tensors': n_tensors, 'n_params': n_params}
+
+
+def _quant_from_name(name: str):
+    upper = name.upper()
+    for quant in sorted(FILE_TYPES.values(), key=len, reverse=True):
+        if quant in upper:
+            return quant
+    return None
+
+
+def describe_gguf(path) -> dict:
+    """把文件头整理成目录条目"""
+    path = Path(path)
+    stat = path.stat()
+    header = read_gguf_header(path)
+    meta = header['metadata']
+    arch = meta.get("general.architecture", "unknown")
+
+    file_type = meta.get("general.file_type")
+    quant = FILE_TYPES.get(file_type) if file_type is not None else None
+    tokens = meta.get("tokenizer.ggml.tokens")
+
+    return {
+        'path': str(path),
+        'file': path.name,
+        'name': meta.get("general.name") or path.stem,
+        'arch': arch,
+        'quant': quant or _quant_from_name(path.name),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'n_params': header['n_params'],
+        'context_length': meta.get(f"{arch}.context_length"),
+        'embedding_length': meta.get(f"{arch}.embedding_length"),
+        'block_count': meta.get(f"{arch}.block_count"),
+        'vocab_size': tokens['array_length'] if isinstance(tokens, dict) else None,
+        'gguf_version': header['version']
+    }
+
+
+# ============================================================
+# 目录
+# ============================================================
+
+class GGUFCatalog:
+    """本机GGUF模型目录（带缓存）"""
+
+    def __init__(self, roots=None, cache_file=CATALOG_FILE, max_age: float = 3600):
+        """
+        Args:
+            roots: 扫描的目录，默认 DEFAULT_ROOTS
+            cache_file: 缓存文件
+            max_age: 目录扫描结果的有效期（秒）；有效期内只检查已知文件，不重新遍历目录
+        """
+        self.roots = [Path(r).expanduser() for r in (roots or DEFAULT_ROOTS)]
+        self.cache_file = Path(cache_file)
+        self.max_age = max_age
+        self._entries = None
+
+    def _load_cache(self) -> dict:
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+            if cache.get('version') == CATALOG_VERSION:
+                return cache
+        except (OSError, ValueError):
+            pass
+        return {'version': CATALOG_VERSION, 'roots': [], 'scanned_at': 0, 'entries': {}}
+
+    def _save_cache(self, cache: dict):
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_file.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp, self.cache_file)
+        except OSError:
+            pass
+
+    def _walk(self):
+        """遍历模型目录，找出 *.gguf 和无扩展名的GGUF文件（Ollama blobs）"""
+        for root in self.roots:
+            if not root.exists():
+                continue
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if name.endswith(".gguf"):
+                        yield path
+                    elif "." not in name and os.path.getsize(path) > (1 << 20) and is_gguf(path):
+                        yield path
+
+    def scan(self, refresh: bool = False) -> list:
+        """
+        返回所有模型条目
+
+        Args:
+            refresh: 忽略有效期，重新遍历目录
+        """
+        cache = self._load_cache()
+        roots = [str(r) for r in self.roots]
+        fresh = (not refresh and cache['roots'] == roots
+                 and time.time() - cache['scanned_at'] < self.max_age)
+
+        if fresh:
+            paths = list(cache['entries'])
+        else:
+            paths = list(self._walk())
+            cache['roots'] = roots
+            cache['scanned_at'] = time.time()
+
+        entries = {}
+        changed = not fresh
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                changed = True
+                continue
+            cached = cache['entries'].get(path)
+            if cached and cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                entries[path] = cached
+                continue
+            try:
+                entries[path] = describe_gguf(path)
+            except (OSError, ValueError):
+                continue
+            changed = True
+
+        if changed or len(entries) != len(cache['entries']):
+            cache['entries'] = entries
+            self._save_cache(cache)
+
+        self._entries = list(entries.values())
+        return self._entries
+
+    def models(self) -> list:
+        if self._entries is None:
+            self.scan()
+        return self._entries
+
+    def query(self,
+              arch: str = None,
+              quant: str = None,
+              name: str = None,
+              max_size_gb: float = None,
+              min_size_gb: float = None,
+              min_context: int = None,
+              vocab_size: int = None,
+              sort_by: str = "size",
+              descending: bool = False) -> list:
+        """
+        按条件筛选模型
+
+        Args:
+            arch: 架构（qwen2、llama ...）
+            quant: 量化方式（Q4_K_M ...），大小写不敏感
+            name: 模型名或文件名包含的文字
+            max_size_gb / min_size_gb: 文件大小范围
+            min_context: 最小训练上下文长度
+            vocab_size: 词表大小（例如挑选同词表的草稿模型）
+            sort_by: 排序字段（size、n_params、context_length ...）
+            descending: 是否降序
+        """
+        results = []
+        for m in self.models():
+            if arch and m['arch'] != arch:
+                continue
+            if quant and (m['quant'] or "").upper() != quant.upper():
+                continue
+            if name and name.lower() not in (m['name'] + m['file']).lower():
+                continue
+            if max_size_gb is not None and m['size'] > max_size_gb * 1e9:
+                continue
+            if min_size_gb is not None and m['size'] < min_size_gb * 1e9:
+                continue
+            if min_context and (m['context_length'] or 0) < min_context:
+                continue
+            if vocab_size and m['vocab_size'] != vocab_size:
+                continue
+            results.append(m)
+        results.sort(key=lambda m: m.get(sort_by) or 0, reverse=descending)
+        return results
+
+    def get(self, path) -> dict:
+        """单个文件的条目（不在扫描目录里也可以）"""
+        path = str(Path(path).expanduser())
+        for m in self.models():
+            if m['path'] == path:
+                return m
+        return describe_gguf(path)
+
+
+def format_params(n: int) -> str:
+    """参数量转为易读格式（1.5B、494M）"""
+    if not n:
+        return "-"
+    return f"{n / 1e9:.1f}B" if n >= 1e9 else f"{n / 1e6:.0f}M"
+
+
+def print_catalog(models: list):
+    print(f"{'模型':<36} {'架构':<10} {'量化':<8} {'参数':>7} {'上下文':>7} {'大小':>8}")
+    print("-" * 82)
+    for m in models:
+        print(f"{m['name'][:35]:<36} {m['arch'][:9]:<10} {(m['quant'] or '-'):<8} "
+              f"{format_params(m['n_params']):>7} {str(m['context_length'] or '-'):>7} "
+              f"{m['size'] / 1e9:>7.2f}G")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="GGUF模型目录")
+    parser.add_argument("--refresh", action="store_true", help="重新遍历模型目录")
+    parser.add_argument("--arch", help="按架构筛选")
+    parser.add_argument("--quant", help="按量化方式筛选")
+    parser.add_argument("--max-size-gb", type=float, help="最大文件大小")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    catalog = GGUFCatalog()
+    catalog.scan(refresh=args.refresh)
+    models = catalog.query(arch=args.arch, quant=args.quant, max_size_gb=args.max_size_gb)
+    elapsed = time.perf_counter() - start
+
+    print(f"📚 找到 {len(models)} 个模型 ({elapsed * 1000:.0f}ms)\n")
+    print_catalog(models)
@@ -0,0 +1,287 @@
+"""
+对话历史管理：后台摘要，控制提示词长度
+
+长对话要么无限增长（超出上下文、预填充越来越慢），要么直接丢掉早期轮次
+（模型忘记之前说过的事）。SummarizingHistory 在历史超过token阈值后，
+利用用户两次提问之间的空闲时间，在后台线程里把较早的轮次压缩成摘要；
+提示词里用摘要代替这些轮次，长度始终不超过固定预算。
+
+热路径（用户提问 → 生成回答）不等待摘要：
+- 生成回答时用 foreground() 占用模型，后台摘要会被立即打断、稍后重试
+- 打断点很密：保存KV状态和调用模型之前都检查一次；本进程的 Llama 按
+  prefill_chunk 个token分段预填充摘要提示词，每段之间检查；每次只摘要
+  不超过 slice_tokens 的旧轮次，其他后端（常驻服务、Ollama）无法打断的
+  预填充也是有上限的
+- 摘要还没完成时，render() 只保留预算内最近的轮次
+
+    history = SummarizingHistory(llm, token_budget=512)
+    with history.foreground():
+        prompt = PREFIX + history.render() + question
+        answer = llm(prompt, ...)
+    history.add(question, answer)      # 超过阈值时安排后台摘要
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+SUMMARY_PROMPT = """<|im_start|>system
+你负责压缩对话记录。<|im_end|>
+<|im_start|>user
+请把下面的对话压缩成一段简短的摘要（不超过150字），保留关键事实、用户关心的问题和已经给出的结论。
+
+{previous}对话记录：
+{dialogue}<|im_end|>
+<|im_start|>assistant
+"""
+
+
+class _Preempted(Exception):
+    """后台摘要被热路径打断"""
+
+
+class SummarizingHistory:
+    """超过token阈值时在后台把旧轮次压缩成摘要的对话历史"""
+
+    def __init__(self,
+                 llm,
+                 token_budget: int = 512,
+                 trigger_ratio: float = 0.75,
+                 keep_recent: int = 2,
+                 summary_max_tokens: int = 200,
+                 idle_delay: float = 0.3,
+                 slice_tokens: int = 256,
+                 prefill_chunk: int = 64,
+                 on_compact=None):
+        """
+        Args:
+            llm: 用来生成摘要的模型（调用方式与 Llama.__call__ 相同）
+            token_budget: 历史（摘要 + 最近轮次）在提示词中最多占用的token数
+            trigger_ratio: 历史超过 budget * ratio 时开始安排摘要
+            keep_recent: 最近几轮始终保留原文
+            summary_max_tokens: 摘要的最大token数
+            idle_delay: 热路径结束后至少空闲多久才开始摘要（秒）
+            slice_tokens: 一次摘要最多处理多少token的旧轮次（至少一轮），剩下的下次再摘要
+            prefill_chunk: 本进程 Llama 分段预填充摘要提示词时每段的token数
+            on_compact: 摘要替换旧轮次后的回调 on_compact(summary, recent_turns)，
+                        在后台线程中调用，调用期间仍然占用模型
+        """
+        self.llm = llm
+        self.token_budget = token_budget
+        self.trigger_tokens = int(token_budget * trigger_ratio)
+        self.keep_recent = keep_recent
+        self.summary_max_tokens = summary_max_tokens
+        self.idle_delay = idle_delay
+        self.slice_tokens = slice_tokens
+        self.prefill_chunk = prefill_chunk
+        self.on_compact = on_compact
+
+        self.summary = ""
+        self.summary_tokens = 0
+        self.turns = []                    # [{'user', 'assistant', 'n_tokens'}]
+
+        self._state_lock = threading.Lock()    # 保护 summary / turns
+        self._llm_lock = threading.Lock()      # 模型同一时间只服务一方
+        self._preempt = threading.Event()      # 热路径需要模型
+        self._pending = threading.Event()      # 有摘要任务
+        self._last_active = time.time()
+        self._closed = False
+        self.stats = {'summaries': 0, 'preempted': 0, 'summarized_turns': 0}
+
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _count(self, text: str) -> int:
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    @staticmethod
+    def format_turn(turn) -> str:
+        return f"用户：{turn['user']}\n助手：{turn['assistant']}\n"
+
+    def total_tokens(self) -> int:
+        with self._state_lock:
+            return self._total_tokens_locked()
+
+    def _total_tokens_locked(self) -> int:
+        return self.summary_tokens + sum(t['n_tokens'] for t in self.turns)
+
+    # ---------------- 热路径 ----------------
+
+    @contextmanager
+    def foreground(self):
+        """热路径使用模型期间：打断后台摘要并独占模型"""
+        self._preempt.set()
+        self._llm_lock.acquire()
+        try:
+            yield
+        finally:
+            self._preempt.clear()
+            self._last_active = time.time()
+            self._llm_lock.release()
+
+    def preempted(self) -> bool:
+        """热路径是否在等待模型（on_compact 中的耗时操作应据此尽快让出）"""
+        return self._preempt.is_set()
+
+    def add(self, user: str, assistant: str):
+        """记录一轮对话；超过阈值时安排后台摘要"""
+        turn = {'user': user, 'assistant': assistant}
+        turn['n_tokens'] = self._count(self.format_turn(turn))
+        with self._state_lock:
+            self.turns.append(turn)
+        self._last_active = time.time()
+        if self.total_tokens() > self.trigger_tokens and len(self.turns) > self.keep_recent:
+            self._pending.set()
+
+    def render(self) -> str:
+        """
+        提示词中的历史部分：摘要 + 最近轮次，不超过 token_budget
+
+        摘要还没来得及生成时，超出预算的最早轮次不放进提示词（仍然保留，等待摘要）
+        """
+        with self._state_lock:
+            summary, summary_tokens = self.summary, self.summary_tokens
+            turns = list(self.turns)
+
+        used = summary_tokens
+        kept = []
+        for turn in reversed(turns):
+            if used + turn['n_tokens'] > self.token_budget:
+                break
+            kept.append(turn)
+            used += turn['n_tokens']
+        kept.reverse()
+
+        parts = []
+        if summary:
+            parts.append(f"之前对话的摘要：{summary}\n")
+        parts.extend(self.format_turn(t) for t in kept)
+        return "".join(parts)
+
+    def clear(self):
+        with self._state_lock:
+            self.summary = ""
+            self.summary_tokens = 0
+            self.turns = []
+        self._pending.clear()
+
+    # ---------------- 后台摘要 ----------------
+
+    def _check_preempt(self):
+        if self._preempt.is_set():
+            raise _Preempted()
+
+    def _prefill(self, prompt: str):
+        """
+        本进程的 Llama：分段预填充提示词，每段之间检查是否被打断
+
+        之后的 llm(prompt) 会跳过KV缓存里已有的相同前缀，只计算最后一个token
+        """
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        self.llm.reset()
+        for start in range(0, len(tokens) - 1, self.prefill_chunk):
+            self._check_preempt()
+            self.llm.eval(tokens[start:min(start + self.prefill_chunk, len(tokens) - 1)])
+
+    def _summarize(self, previous: str, turns) -> str:
+        prompt = SUMMARY_PROMPT.format(
+            previous=f"已有摘要：{previous}\n\n" if previous else "",
+            dialogue="".join(self.format_turn(t) for t in turns)
+        )
+        if hasattr(self.llm, "eval"):
+            self._prefill(prompt)
+        self._check_preempt()
+        summary = ""
+        chunks = self.llm(prompt, max_tokens=self.summary_max_tokens, temperature=0.2,
+                          stop=["<|im_end|>"], stream=True)
+        try:
+            for chunk in chunks:
+                self._check_preempt()
+                summary += chunk['choices'][0]['text']
+        finally:
+            close = getattr(chunks, "close", None)
+            if close:
+                close()
+        return summary.strip()
+
+    def _compact_once(self):
+        """摘要一段旧轮次（不超过 slice_tokens）；还有剩余时返回 True"""
+        with self._state_lock:
+            n_old = len(self.turns) - self.keep_recent
+            if n_old <= 0:
+                return False
+            # 一次只取不超过 slice_tokens 的最早几轮（至少一轮）
+            n_slice, used = 0, 0
+            for turn in self.turns[:n_old]:
+                if n_slice and used + turn['n_tokens'] > self.slice_tokens:
+                    break
+                n_slice += 1
+                used += turn['n_tokens']
+            previous = self.summary
+            old_turns = self.turns[:n_slice]
+
+        # 本进程内的 Llama：摘要会覆盖KV缓存，结束后恢复原来的状态
+        # （保存是整个KV缓存的拷贝，打断不了，开始前先看一眼热路径是否在等）
+        self._check_preempt()
+        saved = self.llm.save_state() if hasattr(self.llm, "save_state") else None
+        try:
+            summary = self._summarize(previous, old_turns)
+        finally:
+            if saved is not None:
+                self.llm.load_state(saved)
+
+        with self._state_lock:
+            # 摘要期间新增的轮次保留在后面
+            self.turns = self.turns[n_slice:]
+            self.summary = summary
+            self.summary_tokens = self._count(f"之前对话的摘要：{summary}\n")
+            recent = list(self.turns)
+            remaining = len(self.turns) > self.keep_recent and self._total_tokens_locked() > self.trigger_tokens
+        self.stats['summaries'] += 1
+        self.stats['summarized_turns'] += n_slice
+
+        if self.on_compact is not None:
+            self.on_compact(summary, recent)
+        return remaining
+
+    def _run(self):
+        while not self._closed:
+            if not self._pending.wait(timeout=0.5):
+                continue
+            # 等到热路径空闲一段时间
+            if self._preempt.is_set() or time.time() - self._last_active < self.idle_delay:
+                time.sleep(0.05)
+                continue
+            if not self._llm_lock.acquire(timeout=0.1):
+                continue
+            try:
+                if self._preempt.is_set():
+                    continue
+                self._pending.clear()
+                try:
+                    if self._compact_once():
+                        self._pending.set()   # 还有旧轮次超出阈值，下一段
+                except _Preempted:
+                    self.stats['preempted'] += 1
+                    self._pending.set()   # 稍后重试
+            except Exception as e:
+                print(f"⚠️  对话摘要失败: {e}")
+            finally:
+                self._llm_lock.release()
+
+    def wait_idle(self, timeout: float = 30) -> bool:
+        """等待后台摘要完成（演示和脚本退出前使用）"""
+        # 摘要分段进行，段与段之间 _pending 会短暂清除；
+        # 持有模型锁时仍然没有任务，才是真的空闲
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self._pending.is_set():
+                with self._llm_lock:
+                    if not self._pending.is_set():
+                        return True
+            time.sleep(0.05)
+        return False
+
+    def close(self):
+        self._closed = True
+        self._worker.join(timeout=2)
@@ -0,0 +1,103 @@
+"""
+统一创建 Llama 实例，自动应用本机调优结果
+
+线程数、batch大小、mmap/mlock 的最佳值取决于机器（核心数、内存）
+和模型，写死在每个脚本里（n_threads=4、"M1建议4-8"）既不准也难维护。
+
+autotune.py 在本机测出每个模型的最佳参数，保存为 (模型, 主机) 的配置；
+所有脚本通过 create_llama 创建模型时自动使用：
+
+    from llama_factory import create_llama
+    llm = create_llama(model_path, n_ctx=2048)
+
+参数优先级：调用方显式传入 > 本机调优配置 > llama.cpp 默认值
+"""
+
+import os
+import json
+import platform
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get("MYLLM_CACHE_DIR", Path.home() / ".cache" / "myllm"))
+PROFILE_FILE = CACHE_DIR / "llama_profiles.json"
+
+# 调优配置中会传给 Llama 的参数
+TUNED_PARAMS = ("n_threads", "n_threads_batch", "n_batch", "use_mmap", "use_mlock", "n_ctx")
+
+_warned_missing = set()
+
+
+def host_key() -> str:
+    """区分机器：主机名 + CPU架构 + 逻辑核心数"""
+    return f"{platform.node()}-{platform.machine()}-{os.cpu_count()}"
+
+
+def model_key(model_path) -> str:
+    """区分模型：文件名 + 文件大小（同名但重新下载/量化的模型会重新调优）"""
+    path = Path(model_path).expanduser()
+    try:
+        size = path.stat().st_size
+    except OSError:
+        size = 0
+    return f"{path.name}:{size}"
+
+
+def _profile_id(model_path) -> str:
+    return f"{host_key()}|{model_key(model_path)}"
+
+
+def _load_all() -> dict:
+    try:
+        with open(PROFILE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_profile(model_path) -> dict:
+    """读取本机对这个模型的调优配置，没有则返回None"""
+    return _load_all().get(_profile_id(model_path))
+
+
+def save_profile(model_path, profile: dict):
+    """保存调优配置（先写临时文件再替换，避免并发写坏）"""
+    profiles = _load_all()
+    profiles[_profile_id(model_path)] = profile
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = PROFILE_FILE.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, PROFILE_FILE)
+
+
+def tuned_params(model_path) -> dict:
+    """调优配置里传给 Llama 的参数"""
+    profile = load_profile(model_path) or {}
+    return {k: v for k, v in profile.get("params", {}).items() if k in TUNED_PARAMS}
+
+
+def create_llama(model_path, use_profile: bool = True, **kwargs):
+    """
+    创建 Llama 实例
+
+    Args:
+        model_path: GGUF模型路径
+        use_profile: 是否应用本机调优配置
+        **kwargs: 其他 Llama 参数（显式传入的值优先于调优配置）
+
+    Returns:
+        Llama 实例
+    """
+    from llama_cpp import Llama
+
+    model_path = str(Path(model_path).expanduser())
+    params = {}
+    if use_profile:
+        params = tuned_params(model_path)
+        if not params and model_path not in _warned_missing:
+            _warned_missing.add(model_path)
+            print(f"💡 {os.path.basename(model_path)} 在本机还没有调优配置，"
+                  f"运行 01_inference/autotune.py 可以获得更快的速度")
+
+    params.update({k: v for k, v in kwargs.items() if v is not None})
+    return Llama(model_path=model_path, **params)
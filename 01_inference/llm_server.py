@@ -0,0 +1,469 @@
+"""
+常驻LLM推理服务
+
+每个脚本各自 Llama(model_path=...) 都要付出几秒的模型加载时间
+（benchmark_quantization 里的"加载"一列）。这个服务只加载一次模型，
+通过本机HTTP提供补全（包括流式输出）：
+
+    python llm_server.py --model ~/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf
+    python llm_server.py --quant Q4_K_M      # 从模型目录（gguf_catalog.py）中挑选
+
+客户端 LLMClient 的调用方式与 Llama.__call__ 相同，可以直接替换：
+
+    llm = LLMClient()
+    output = llm(prompt, max_tokens=200, temperature=0.7, stop=["\\n\\n"])
+    for chunk in llm(prompt, max_tokens=200, stream=True):
+        print(chunk['choices'][0]['text'], end="")
+
+接口：
+    GET  /health       模型信息
+    POST /completion   补全，stream=true 时返回NDJSON流（每行一个chunk）
+    POST /tokenize     分词
+"""
+
+import os
+import json
+import time
+import argparse
+import threading
+import http.client
+from contextlib import nullcontext
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+
+
+# ============================================================
+# 服务端
+# ============================================================
+
+class LLMRequestHandler(BaseHTTPRequestHandler):
+    """HTTP请求处理（模型由 server.llm 持有）"""
+
+    # HTTP/1.1：客户端可以复用连接
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _write_chunk(self, data: bytes):
+        """写一个HTTP chunked分块"""
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json({
+                "model": self.server.model_path,
+                "n_ctx": self.server.llm.n_ctx(),
+                "speculative": bool(getattr(self.server.llm, "speculative", False)),
+                "uptime": time.time() - self.server.started_at
+            })
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        try:
+            params = self._read_json()
+        except ValueError as e:
+            self._send_json({"error": f"invalid json: {e}"}, status=400)
+            return
+
+        if self.path == "/tokenize":
+            text = params.get("text", "").encode("utf-8")
+            with self.server.lock:
+                tokens = self.server.llm.tokenize(
+                    text,
+                    add_bos=params.get("add_bos", True),
+                    special=params.get("special", False)
+                )
+            self._send_json({"tokens": tokens})
+        elif self.path == "/completion":
+            self._handle_completion(params)
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def _handle_completion(self, params):
+        prompt = params.pop("prompt", "")
+        stream = params.pop("stream", False)
+
+        if not stream:
+            try:
+                with self.server.lock:
+                    output = self.server.llm(prompt, stream=False, **params)
+            except Exception as e:
+                self._send_json({"error": str(e)}, status=500)
+                return
+            self._send_json(output)
+            return
+
+        # 流式：NDJSON + chunked编码，每生成一段就写一行
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        with self.server.lock:
+            chunks = self.server.llm(prompt, stream=True, **params)
+            try:
+                for chunk in chunks:
+                    line = json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n"
+                    self._write_chunk(line)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端断开：停止生成，释放模型
+                chunks.close()
+                self.close_connection = True
+                return
+            except Exception as e:
+                line = json.dumps({"error": str(e)}, ensure_ascii=False).encode("utf-8") + b"\n"
+                self._write_chunk(line)
+
+        self._write_chunk(b"")
+
+
+class LLMServer(ThreadingHTTPServer):
+    """加载一次模型，服务所有请求"""
+
+    daemon_threads = True
+
+    def __init__(self, llm, model_path: str = "",
+                 host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 verbose: bool = False):
+        """
+        Args:
+            llm: 已加载的 Llama 实例（或包装它的 BatchScheduler）
+            model_path: 模型路径（用于 /health）
+            host: 监听地址（默认只监听本机）
+            port: 监听端口
+            verbose: 是否打印访问日志
+        """
+        super().__init__((host, port), LLMRequestHandler)
+        self.llm = llm
+        self.model_path = model_path
+        self.verbose = verbose
+        self.started_at = time.time()
+        # Llama实例不是线程安全的，同一时间只允许一个请求使用；
+        # BatchScheduler 自己调度并发请求，不需要加锁
+        self.lock = nullcontext() if getattr(llm, "thread_safe", False) else threading.Lock()
+
+
+# ============================================================
+# 客户端
+# ============================================================
+
+class LLMClient:
+    """
+    常驻服务的客户端，调用方式与 Llama.__call__ 相同
+
+    每个线程复用一个keep-alive连接
+    """
+
+    MODEL_CHECK_INTERVAL = 5.0
+
+    def __init__(self, url: str = DEFAULT_URL, timeout: float = 600):
+        """
+        Args:
+            url: 服务地址
+            timeout: 单次请求超时（秒）
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.timeout = timeout
+        self.local = threading.local()
+        self._n_ctx = None
+        self._health = None
+        self._health_checked = 0.0
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def _request(self, method: str, path: str, body=None) -> http.client.HTTPResponse:
+        """发送请求；复用的连接被服务端关闭时重连一次"""
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                return conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                self.local.conn = None
+                if attempt == 1:
+                    raise
+
+    def _json(self, method: str, path: str, body=None):
+        response = self._request(method, path, body)
+        data = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"LLM服务错误 (HTTP {response.status}): {data.get('error')}")
+        return data
+
+    def health(self) -> dict:
+        """服务状态（模型路径、上下文长度）"""
+        return self._json("GET", "/health")
+
+    def _cached_health(self) -> dict:
+        # 服务可能被换了模型重启，最多缓存 MODEL_CHECK_INTERVAL 秒
+        now = time.monotonic()
+        if self._health is None or now - self._health_checked > self.MODEL_CHECK_INTERVAL:
+            self._health = self.health()
+            self._n_ctx = self._health["n_ctx"]
+            self._health_checked = now
+        return self._health
+
+    @property
+    def model_path(self) -> str:
+        """
+        服务端加载的模型路径（读 /health）
+
+        答案缓存等按模型区分的地方用它，而不是客户端的类名
+        """
+        return self._cached_health()["model"]
+
+    @property
+    def speculative(self) -> bool:
+        """服务是否用 --draft 启动（投机解码只在 temperature=0 时生效）"""
+        return bool(self._cached_health().get("speculative", False))
+
+    def n_ctx(self) -> int:
+        """上下文长度（与 Llama.n_ctx() 相同）"""
+        if self._n_ctx is None:
+            self._n_ctx = self.health()["n_ctx"]
+        return self._n_ctx
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        """分词（与 Llama.tokenize 相同，输入为bytes）"""
+        return self._json("POST", "/tokenize", {
+            "text": text.decode("utf-8", errors="ignore"),
+            "add_bos": add_bos,
+            "special": special
+        })["tokens"]
+
+    def __call__(self,
+                 prompt: str,
+                 suffix: str = None,
+                 max_tokens: int = 16,
+                 temperature: float = 0.8,
+                 top_p: float = 0.95,
+                 echo: bool = False,
+                 stop=None,
+                 repeat_penalty: float = 1.1,
+                 top_k: int = 40,
+                 stream: bool = False,
+                 **kwargs):
+        """补全（参数和返回值与 Llama.__call__ 相同）"""
+        body = {
+            "prompt": prompt,
+            "suffix": suffix,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "echo": echo,
+            "stop": stop or [],
+            "repeat_penalty": repeat_penalty,
+            "top_k": top_k,
+            "stream": stream,
+            **kwargs
+        }
+        if stream:
+            return self._stream(body)
+        return self._json("POST", "/completion", body)
+
+    create_completion = __call__
+
+    def _stream(self, body):
+        response = self._request("POST", "/completion", body)
+        if response.status != 200:
+            data = json.loads(response.read())
+            raise RuntimeError(f"LLM服务错误 (HTTP {response.status}): {data.get('error')}")
+
+        try:
+            for line in response:
+                if not line.strip():
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(f"LLM服务错误: {chunk['error']}")
+                yield chunk
+        finally:
+            # 提前停止迭代时响应没读完，这个连接不能再复用
+            if not response.isclosed():
+                self._connection().close()
+                self.local.conn = None
+
+
+def server_available(url: str = DEFAULT_URL, timeout: float = 0.5) -> bool:
+    """检查常驻服务是否在运行"""
+    parsed = urlparse(url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+    try:
+        conn.request("GET", "/health")
+        return conn.getresponse().status == 200
+    except OSError:
+        return False
+    finally:
+        conn.close()
+
+
+def _same_model(requested: str, served: str) -> bool:
+    """请求的模型和服务端加载的是否是同一个文件（服务可能在别的机器上，退而比较文件名）"""
+    requested = os.path.expanduser(requested)
+    if os.path.realpath(requested) == os.path.realpath(served):
+        return True
+    return os.path.basename(requested) == os.path.basename(served)
+
+
+def connect_or_load(model_path: str, url: str = None, **llama_kwargs):
+    """
+    优先连接常驻服务，服务没有运行时才在本进程加载模型
+
+    服务加载的模型与 model_path 不同、或上下文长度小于请求的 n_ctx 时，
+    打印原因并在本进程加载 model_path（不会悄悄用别的模型回答）
+
+    环境变量 LLM_BACKEND=ollama 时改用 Ollama（模型名读 OLLAMA_MODEL）
+
+    Args:
+        model_path: 模型路径（为空时接受服务端的任何模型）
+        url: 服务地址，默认读环境变量 LLM_SERVER_URL，否则用 DEFAULT_URL
+        **llama_kwargs: 本地加载时传给 Llama 的参数（未指定的参数使用本机调优配置）
+
+    Returns:
+        LLMClient、OllamaBackend 或 Llama，调用方式相同
+    """
+    if os.environ.get("LLM_BACKEND", "").lower() == "ollama":
+        from ollama_backend import OllamaBackend
+        model = os.environ.get("OLLAMA_MODEL", "qwen2:7b")
+        print(f"🦙 使用Ollama后端: {model}")
+        # 调用方传入的已经是完整的ChatML提示词，raw=True 避免再套一层对话模板
+        return OllamaBackend(model, num_ctx=llama_kwargs.get("n_ctx") or 4096, raw=True)
+
+    url = url or os.environ.get("LLM_SERVER_URL", DEFAULT_URL)
+    if server_available(url):
+        client = LLMClient(url)
+        served = client.model_path
+        n_ctx = llama_kwargs.get("n_ctx")
+        if model_path and not _same_model(model_path, served):
+            print(f"⚠️  常驻LLM服务加载的是 {os.path.basename(served)}，"
+                  f"不是 {os.path.basename(model_path)}，改为本地加载")
+        elif n_ctx and client.n_ctx() < n_ctx:
+            print(f"⚠️  常驻LLM服务的上下文长度 {client.n_ctx()} 小于需要的 {n_ctx}，改为本地加载")
+        else:
+            print(f"🔌 使用常驻LLM服务: {url}")
+            return client
+
+    from llama_factory import create_llama
+    return create_llama(model_path, **llama_kwargs)
+
+
+# ============================================================
+# 启动服务
+# ============================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="常驻LLM推理服务")
+    parser.add_argument("--model", default=None,
+                        help="GGUF模型路径（不指定时按 --quant/--arch 从模型目录中挑选最大的模型）")
+    parser.add_argument("--quant", default=None, help="自动挑选模型时的量化方式，例如 Q4_K_M")
+    parser.add_argument("--arch", default=None, help="自动挑选模型时的架构，例如 qwen2")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--n-threads", type=int, default=None, help="默认使用 autotune.py 的调优结果")
+    parser.add_argument("--n-gpu-layers", type=int, default=0)
+    parser.add_argument("--slots", type=int, default=1,
+                        help="并发解码槽位数，>1 时启用连续批处理（batch_scheduler.py）")
+    parser.add_argument("--draft", default=None,
+                        help="草稿模型路径，启用投机解码（speculative.py，只在temperature=0时生效；"
+                             "ProductionRAG / TrafficLawRAG 检测到后默认改用temperature=0）")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        import llama_cpp  # noqa: F401
+    except ImportError:
+        print("❌ llama-cpp-python未安装")
+        print("  pip install llama-cpp-python")
+        return
+    from llama_factory import create_llama
+
+    if args.model:
+        model_path = os.path.expanduser(args.model)
+    else:
+        # 只读GGUF文件头，不需要加载就能选出合适的模型
+        from gguf_catalog import GGUFCatalog
+        models = GGUFCatalog().query(arch=args.arch, quant=args.quant,
+                                     sort_by="n_params", descending=True)
+        if not models:
+            print("❌ 模型目录中没有符合条件的模型，请用 --model 指定")
+            return
+        model_path = models[0]['path']
+    print(f"📦 加载模型: {os.path.basename(model_path)}")
+    start = time.time()
+    llm = create_llama(
+        model_path,
+        n_ctx=args.n_ctx,
+        n_threads=args.n_threads,
+        n_gpu_layers=args.n_gpu_layers,
+        verbose=False
+    )
+    print(f"✅ 模型加载完成 ({time.time() - start:.2f}秒)")
+
+    if args.slots > 1 and args.draft:
+        print("❌ --slots 与 --draft 不能同时使用")
+        return
+
+    if args.draft:
+        from speculative import SpeculativeDecoder
+        draft_path = os.path.expanduser(args.draft)
+        draft = create_llama(
+            draft_path,
+            n_ctx=args.n_ctx,
+            n_threads=args.n_threads,
+            n_gpu_layers=args.n_gpu_layers,
+            verbose=False
+        )
+        llm = SpeculativeDecoder(llm, draft)
+        print(f"✏️  投机解码: 草稿模型 {os.path.basename(draft_path)}")
+
+    if args.slots > 1:
+        from batch_scheduler import BatchScheduler
+        llm = BatchScheduler(llm, n_slots=args.slots)
+        print(f"🔀 连续批处理: {args.slots} 个槽位")
+
+    server = LLMServer(llm, model_path, args.host, args.port, verbose=args.verbose)
+    print(f"🚀 服务已启动: http://{args.host}:{args.port}")
+    print("   按 Ctrl+C 停止")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 服务已停止")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
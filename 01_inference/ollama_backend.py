@@ -0,0 +1,591 @@
+"""
+Ollama 推理后端
+
+test_ollama.py 每次请求都用 requests.post 新建连接，流式输出逐行解析，
+没有连接复用，也没有并发控制。这个后端：
+- 同步调用：HTTP keep-alive 连接池（多线程共享）
+- 异步调用：基于 asyncio 的流式客户端（一个事件循环服务很多会话）
+- 并发限制：同时在Ollama上生成的请求数不超过 max_concurrency
+- keep_alive：每个请求都带上保活时间，模型常驻内存；load()/unload() 手动控制
+
+调用方式与 Llama.__call__ 相同，可以直接替换 llama.cpp：
+
+    llm = OllamaBackend("qwen2.5:3b")
+    rag = ProductionRAG(model_path="", llm=llm)
+
+    async for chunk in llm.astream(prompt, max_tokens=200):
+        print(chunk['choices'][0]['text'], end="")
+
+本地测试不需要真的Ollama：python ollama_backend.py --stub
+"""
+
+import os
+import json
+import time
+import queue
+import asyncio
+import threading
+import http.client
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+
+
+class OllamaBackend:
+    """Ollama /api/generate 的连接池客户端"""
+
+    def __init__(self,
+                 model: str = "qwen2:7b",
+                 base_url: str = None,
+                 keep_alive: str = "30m",
+                 num_ctx: int = 4096,
+                 max_concurrency: int = 4,
+                 pool_size: int = 8,
+                 raw: bool = False,
+                 timeout: float = 600):
+        """
+        Args:
+            model: Ollama模型名
+            base_url: 服务地址，默认读环境变量 OLLAMA_HOST，否则 http://localhost:11434
+            keep_alive: 模型在最后一次请求后保留在内存中的时间（"30m"、"-1"表示一直保留）
+            num_ctx: 上下文长度（每个请求都传给Ollama，n_ctx() 返回这个值）
+            max_concurrency: 同时生成的最大请求数
+            pool_size: 连接池保留的空闲连接数
+            raw: True 时不套用模型的对话模板（与 llama.cpp 直接补全一致）
+            timeout: 单次请求超时（秒）
+        """
+        url = base_url or os.environ.get("OLLAMA_HOST", DEFAULT_OLLAMA_URL)
+        if "://" not in url:
+            url = "http://" + url
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 11434
+        self.model = model
+        self.model_path = f"ollama:{model}"
+        self.keep_alive = keep_alive
+        self.num_ctx = num_ctx
+        self.raw = raw
+        self.timeout = timeout
+
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+
+        # 异步部分在第一次使用时绑定到当前事件循环
+        self._async_loop = None
+        self._async_pool = []
+        self._async_semaphore = None
+
+        self._tokenizer = None
+        self.stats = {'requests': 0, 'connections_opened': 0, 'connections_reused': 0}
+
+    # ---------------- 同步连接池 ----------------
+
+    def _acquire(self) -> http.client.HTTPConnection:
+        try:
+            conn = self._pool.get_nowait()
+            self.stats['connections_reused'] += 1
+            return conn
+        except queue.Empty:
+            self.stats['connections_opened'] += 1
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, conn: http.client.HTTPConnection, reusable: bool):
+        if not reusable:
+            conn.close()
+            return
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _request(self, method: str, path: str, body=None):
+        """
+        发送请求
+
+        Returns:
+            (连接, 响应)；读完响应后调用 _release 归还连接
+        """
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if payload is not None else {}
+
+        for attempt in range(2):
+            conn = self._acquire()
+            try:
+                conn.request(method, path, body=payload, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # 池里的空闲连接可能已被服务端关闭，换新连接重试一次
+                conn.close()
+                if attempt == 1:
+                    raise
+
+    def _json(self, method: str, path: str, body=None) -> dict:
+        conn, response = self._request(method, path, body)
+        data = response.read()
+        self._release(conn, not response.will_close)
+        result = json.loads(data or b"{}")
+        if response.status != 200:
+            raise RuntimeError(f"Ollama错误 (HTTP {response.status}): {result.get('error')}")
+        return result
+
+    # ---------------- 模型管理 ----------------
+
+    def list_models(self) -> list:
+        """已下载的模型"""
+        return self._json("GET", "/api/tags").get("models", [])
+
+    def running_models(self) -> list:
+        """当前加载在内存中的模型"""
+        return self._json("GET", "/api/ps").get("models", [])
+
+    def is_loaded(self) -> bool:
+        return any(m.get("name") == self.model or m.get("model") == self.model
+                   for m in self.running_models())
+
+    def load(self):
+        """预先加载模型（空提示词的请求只加载不生成）"""
+        self._json("POST", "/api/generate", {"model": self.model, "keep_alive": self.keep_alive})
+
+    def unload(self):
+        """立即从内存中卸载模型"""
+        self._json("POST", "/api/generate", {"model": self.model, "keep_alive": 0})
+
+    # ---------------- 与 Llama 相同的接口 ----------------
+
+    def n_ctx(self) -> int:
+        return self.num_ctx
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        """
+        分词
+
+        Ollama 没有分词接口：如果能找到模型的GGUF文件（Ollama blobs），
+        用 llama.cpp 只加载词表来分词；否则按字符数估算（偏保守）
+        """
+        tokenizer = self._load_tokenizer()
+        if tokenizer is not None:
+            return tokenizer.tokenize(text, add_bos=add_bos, special=special)
+
+        decoded = text.decode("utf-8", errors="ignore")
+        cjk = sum(1 for ch in decoded if ord(ch) > 0x2E80)
+        estimate = cjk + (len(decoded) - cjk + 2) // 3 + (1 if add_bos else 0)
+        return [0] * estimate
+
+    def _load_tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = False
+            try:
+                modelfile = self._json("POST", "/api/show", {"model": self.model}).get("modelfile", "")
+                blob = next((line[5:].strip() for line in modelfile.splitlines()
+                             if line.startswith("FROM ") and os.path.exists(line[5:].strip())), None)
+                if blob:
+                    from llama_cpp import Llama
+                    self._tokenizer = Llama(model_path=blob, vocab_only=True, verbose=False)
+            except Exception:
+                pass
+        return self._tokenizer or None
+
+    def _body(self, prompt, max_tokens, temperature, top_p, stop, top_k, repeat_penalty, seed, stream):
+        options = {
+            "num_predict": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "repeat_penalty": repeat_penalty,
+            "num_ctx": self.num_ctx
+        }
+        if stop:
+            options["stop"] = [stop] if isinstance(stop, str) else list(stop)
+        if seed is not None:
+            options["seed"] = seed
+        return {
+            "model": self.model,
+            "prompt": prompt,
+            "stream": stream,
+            "raw": self.raw,
+            "keep_alive": self.keep_alive,
+            "options": options
+        }
+
+    def _chunk(self, item: dict, created: int) -> dict:
+        """Ollama 的一行 → Llama 流式chunk"""
+        finish_reason = None
+        if item.get("done"):
+            finish_reason = "length" if item.get("done_reason") == "length" else "stop"
+        return {
+            'id': f"cmpl-ollama-{created}",
+            'object': 'text_completion',
+            'created': created,
+            'model': self.model,
+            'choices': [{'text': item.get("response", ""), 'index': 0,
+                         'logprobs': None, 'finish_reason': finish_reason}]
+        }
+
+    def __call__(self,
+                 prompt: str,
+                 max_tokens: int = 16,
+                 temperature: float = 0.8,
+                 top_p: float = 0.95,
+                 stop=None,
+                 stream: bool = False,
+                 top_k: int = 40,
+                 repeat_penalty: float = 1.1,
+                 seed: int = None,
+                 **kwargs):
+        """补全（参数和返回值与 Llama.__call__ 相同）"""
+        body = self._body(prompt, max_tokens, temperature, top_p, stop, top_k, repeat_penalty, seed, stream)
+        if stream:
+            return self._stream(body)
+
+        with self._semaphore:
+            self.stats['requests'] += 1
+            item = self._json("POST", "/api/generate", body)
+        created = int(time.time())
+        completion = self._chunk(item, created)
+        completion['usage'] = {
+            'prompt_tokens': item.get("prompt_eval_count", 0),
+            'completion_tokens': item.get("eval_count", 0),
+            'total_tokens': item.get("prompt_eval_count", 0) + item.get("eval_count", 0)
+        }
+        return completion
+
+    create_completion = __call__
+
+    def _stream(self, body):
+        created = int(time.time())
+        with self._semaphore:
+            self.stats['requests'] += 1
+            conn, response = self._request("POST", "/api/generate", body)
+            if response.status != 200:
+                data = json.loads(response.read() or b"{}")
+                self._release(conn, False)
+                raise RuntimeError(f"Ollama错误 (HTTP {response.status}): {data.get('error')}")
+
+            finished = False
+            try:
+                for line in response:
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    if "error" in item:
+                        raise RuntimeError(f"Ollama错误: {item['error']}")
+                    yield self._chunk(item, created)
+                    if item.get("done"):
+                        response.read()   # 读完结尾，连接才能复用
+                        finished = True
+                        break
+            finally:
+                # 提前停止时响应没读完：关闭连接，Ollama 会停止生成
+                self._release(conn, finished and not response.will_close)
+
+    # ---------------- 异步客户端 ----------------
+
+    def _bind_loop(self):
+        """异步连接和信号量属于某个事件循环；换了事件循环就重新创建"""
+        loop = asyncio.get_running_loop()
+        if self._async_loop is not loop:
+            self._drop_async_pool()
+            self._async_loop = loop
+            self._async_semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    def _drop_async_pool(self):
+        for _, writer in self._async_pool:
+            try:
+                writer.close()
+            except RuntimeError:
+                pass   # 所属的事件循环已经关闭
+        self._async_pool = []
+
+    async def _aopen(self):
+        if self._async_pool:
+            self.stats['connections_reused'] += 1
+            return self._async_pool.pop(), True
+        self.stats['connections_opened'] += 1
+        return await asyncio.open_connection(self.host, self.port), False
+
+    def _arelease(self, conn, reusable: bool):
+        reader, writer = conn
+        if reusable and len(self._async_pool) < self.pool_size:
+            self._async_pool.append(conn)
+        else:
+            writer.close()
+
+    async def _arequest(self, method: str, path: str, body=None):
+        """发送请求并读取响应头，返回 (连接, 状态码, 响应头)"""
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else b""
+        head = (f"{method} {path} HTTP/1.1\r\n"
+                f"Host: {self.host}:{self.port}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: keep-alive\r\n\r\n").encode("ascii")
+
+        for attempt in range(2):
+            conn, reused = await self._aopen()
+            reader, writer = conn
+            try:
+                writer.write(head + payload)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError("连接已被服务端关闭")
+            except (ConnectionResetError, BrokenPipeError):
+                writer.close()
+                if attempt == 1 or not reused:
+                    raise
+                continue
+
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            return conn, status, headers
+
+    @staticmethod
+    async def _abody(reader, headers):
+        """逐段读取响应体（支持 chunked 和 Content-Length）"""
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # 结尾的 trailer 直到空行
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return
+                data = await reader.readexactly(size)
+                await reader.readexactly(2)
+                yield data
+        else:
+            length = int(headers.get("content-length", 0))
+            if length:
+                yield await reader.readexactly(length)
+
+    async def astream(self,
+                      prompt: str,
+                      max_tokens: int = 16,
+                      temperature: float = 0.8,
+                      top_p: float = 0.95,
+                      stop=None,
+                      top_k: int = 40,
+                      repeat_penalty: float = 1.1,
+                      seed: int = None,
+                      **kwargs):
+        """异步流式补全，产出与 Llama 流式输出相同的chunk"""
+        body = self._body(prompt, max_tokens, temperature, top_p, stop, top_k, repeat_penalty, seed, True)
+        created = int(time.time())
+
+        self._bind_loop()
+        async with self._async_semaphore:
+            self.stats['requests'] += 1
+            conn, status, headers = await self._arequest("POST", "/api/generate", body)
+            finished = False
+            try:
+                buffer = b""
+                async for data in self._abody(conn[0], headers):
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        item = json.loads(line)
+                        if status != 200 or "error" in item:
+                            raise RuntimeError(f"Ollama错误 (HTTP {status}): {item.get('error')}")
+                        yield self._chunk(item, created)
+                if buffer.strip():
+                    item = json.loads(buffer)
+                    if status != 200 or "error" in item:
+                        raise RuntimeError(f"Ollama错误 (HTTP {status}): {item.get('error')}")
+                    yield self._chunk(item, created)
+                finished = True
+            finally:
+                self._arelease(conn, finished and headers.get("connection", "").lower() != "close")
+
+    async def acomplete(self, prompt: str, **kwargs) -> dict:
+        """异步非流式补全"""
+        text = ""
+        finish_reason = None
+        async for chunk in self.astream(prompt, **kwargs):
+            text += chunk['choices'][0]['text']
+            finish_reason = chunk['choices'][0]['finish_reason'] or finish_reason
+        return {
+            'id': f"cmpl-ollama-{int(time.time())}",
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': self.model,
+            'choices': [{'text': text, 'index': 0, 'logprobs': None, 'finish_reason': finish_reason}]
+        }
+
+    async def aclose(self):
+        """关闭异步连接（在使用它们的事件循环里调用）"""
+        pool, self._async_pool = self._async_pool, []
+        for _, writer in pool:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._drop_async_pool()
+
+
+# ============================================================
+# 本地测试用的Ollama替身
+# ============================================================
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    """
+    模拟 Ollama 的 /api/generate、/api/tags、/api/ps、/api/show
+
+    把提示词最后几个字按字逐个"生成"出来，每个字之间等待 server.token_delay 秒
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": "stub", "size": 0, "modified_at": ""}]})
+        elif self.path == "/api/ps":
+            self._send_json({"models": [{"name": m} for m in self.server.loaded]})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        params = json.loads(self.rfile.read(length) or b"{}")
+        self.server.connections.add(self.client_address)
+
+        if self.path == "/api/show":
+            self._send_json({"modelfile": f"FROM {params.get('model')}"})
+            return
+        if self.path != "/api/generate":
+            self._send_json({"error": "not found"}, status=404)
+            return
+
+        model = params.get("model")
+        if params.get("keep_alive") == 0:
+            self.server.loaded.discard(model)
+        else:
+            self.server.loaded.add(model)
+        if "prompt" not in params:
+            self._send_json({"model": model, "response": "", "done": True})
+            return
+
+        n = params.get("options", {}).get("num_predict", 16)
+        text = params["prompt"][-n:]
+        if not params.get("stream", True):
+            time.sleep(self.server.token_delay * len(text))
+            self._send_json({"model": model, "response": text, "done": True, "done_reason": "stop",
+                             "prompt_eval_count": len(params["prompt"]), "eval_count": len(text)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for ch in text:
+                time.sleep(self.server.token_delay)
+                self._write_chunk({"model": model, "response": ch, "done": False})
+            self._write_chunk({"model": model, "response": "", "done": True, "done_reason": "stop",
+                               "eval_count": len(text)})
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def _write_chunk(self, item):
+        data = json.dumps(item, ensure_ascii=False).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_stub_server(port: int = 0, token_delay: float = 0.01):
+    """在后台线程启动Ollama替身，返回 (server, base_url)"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubOllamaHandler)
+    server.daemon_threads = True
+    server.token_delay = token_delay
+    server.loaded = set()
+    server.connections = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ============================================================
+# 演示
+# ============================================================
+
+if __name__ == "__main__":
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+
+    if "--stub" in sys.argv:
+        stub, url = start_stub_server()
+        model = "stub"
+        print(f"🧪 使用Ollama替身: {url}")
+    else:
+        url = None
+        model = sys.argv[1] if len(sys.argv) > 1 else "qwen2:7b"
+
+    llm = OllamaBackend(model, base_url=url, max_concurrency=4)
+    print(f"🤖 模型: {model}")
+
+    print("\n[1/3] 预加载模型（keep_alive 保持常驻）")
+    start = time.time()
+    llm.load()
+    print(f"   ✅ {time.time() - start:.2f}秒, 已加载: {llm.is_loaded()}")
+
+    print("\n[2/3] 同步流式（连接池复用）")
+    prompts = ["什么是RAG？", "醉驾会受到什么处罚？", "列举3个大模型的应用场景"]
+    for prompt in prompts:
+        print("   💬 ", end="")
+        for chunk in llm(prompt, max_tokens=64, stream=True):
+            print(chunk['choices'][0]['text'], end="", flush=True)
+        print()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        start = time.time()
+        outputs = list(pool.map(lambda p: llm(p, max_tokens=64), prompts * 3))
+        print(f"   9个并发请求（最多{llm.max_concurrency}个同时生成）: {time.time() - start:.2f}秒")
+
+    print("\n[3/3] 异步流式（一个事件循环，多个会话）")
+
+    async def session(prompt):
+        text = ""
+        async for chunk in llm.astream(prompt, max_tokens=64):
+            text += chunk['choices'][0]['text']
+        return text
+
+    async def main():
+        results = await asyncio.gather(*(session(p) for p in prompts * 2))
+        await llm.aclose()
+        return results
+
+    start = time.time()
+    results = asyncio.run(main())
+    print(f"   {len(results)} 个会话完成: {time.time() - start:.2f}秒")
+
+    print(f"\n📊 请求 {llm.stats['requests']} 次, 新建连接 {llm.stats['connections_opened']} 个, "
+          f"复用 {llm.stats['connections_reused']} 次")
+    llm.close()
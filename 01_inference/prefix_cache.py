@@ -0,0 +1,101 @@
+"""
+固定提示词前缀的KV缓存
+
+RAG的提示词模板都以同一段很长的说明开头（角色设定、回答规则），
+变化的只有检索到的参考资料和用户问题。llama.cpp 每次请求都会把
+这段说明重新预填充一遍，在CPU上这是首token延迟的大头。
+
+PrefixCache 在模型处理完静态前缀之后保存模型状态（KV缓存），
+下一次请求先恢复这个状态。llama-cpp-python 在生成时会自动跳过与
+当前状态相同的前缀token，于是只需要计算参考资料和问题部分。
+
+    cache = PrefixCache(llm)
+    cache.register(PROMPT_PREFIX)
+    cache.prepare(prompt)       # prompt 以 PROMPT_PREFIX 开头
+    output = llm(prompt, ...)   # 只预填充前缀之后的部分
+
+按 (模型, 前缀哈希) 缓存，多个模板之间按LRU淘汰。
+"""
+
+import hashlib
+from collections import OrderedDict
+
+
+class PrefixCache:
+    """静态前缀的模型状态缓存（LRU）"""
+
+    def __init__(self, llm, capacity: int = 4, model_key: str = None):
+        """
+        Args:
+            llm: Llama 实例（需要 save_state / load_state）
+            capacity: 最多缓存几个前缀的状态
+            model_key: 区分模型的键，默认用模型路径
+        """
+        self.llm = llm
+        self.capacity = capacity
+        self.model_key = model_key or getattr(llm, "model_path", "")
+        self.prefixes = []               # 已注册的前缀文本（长的在前）
+        self.states = OrderedDict()      # key -> (前缀token, LlamaState)
+        self.stats = {'hits': 0, 'misses': 0, 'reused_tokens': 0}
+
+    def register(self, prefix: str):
+        """注册一个模板前缀（建议以换行结尾，保证分词边界稳定）"""
+        if prefix and prefix not in self.prefixes:
+            self.prefixes.append(prefix)
+            self.prefixes.sort(key=len, reverse=True)
+
+    def _key(self, prefix: str) -> str:
+        digest = hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+        return f"{self.model_key}:{digest}"
+
+    def _tokenize(self, text: str):
+        # 与 Llama.create_completion 对提示词的分词方式一致
+        return self.llm.tokenize(text.encode("utf-8"), add_bos=True, special=True)
+
+    def match(self, prompt: str):
+        """找出 prompt 开头的最长已注册前缀"""
+        for prefix in self.prefixes:
+            if prompt.startswith(prefix):
+                return prefix
+        return None
+
+    def prepare(self, prompt: str) -> int:
+        """
+        生成前调用：让模型状态停在 prompt 的静态前缀之后
+
+        Returns:
+            可以复用的前缀token数（0 表示没有匹配的前缀）
+        """
+        prefix = self.match(prompt)
+        if prefix is None:
+            return 0
+
+        key = self._key(prefix)
+        entry = self.states.get(key)
+
+        if entry is not None:
+            tokens, state = entry
+            self.states.move_to_end(key)
+            self.stats['hits'] += 1
+            # 模型当前状态已经包含这个前缀时不需要恢复
+            if list(self.llm.input_ids[:len(tokens)]) != tokens:
+                self.llm.load_state(state)
+        else:
+            self.stats['misses'] += 1
+            tokens = self._tokenize(prefix)
+            self.llm.reset()
+            self.llm.eval(tokens)
+            self.states[key] = (tokens, self.llm.save_state())
+            if len(self.states) > self.capacity:
+                self.states.popitem(last=False)
+
+        self.stats['reused_tokens'] += len(tokens)
+        return len(tokens)
+
+    def warm(self):
+        """预先计算所有已注册前缀的状态（例如服务启动时）"""
+        for prefix in reversed(self.prefixes[:self.capacity]):
+            self.prepare(prefix)
+
+    def clear(self):
+        self.states.clear()
@@ -0,0 +1,494 @@
+"""
+投机解码（speculative decoding）
+
+CPU上解码是逐token的：每生成一个token都要把整个模型过一遍，
+300-512 token 的回答大部分时间花在这里。
+
+投机解码用一个小的草稿模型（同一系列、同一词表的小模型，例如
+qwen2.5-0.5b 给 qwen2.5-3b 打草稿）先便宜地猜出 k 个token，
+主模型再用一次batch同时验证这 k 个位置：
+- 主模型在每个位置的贪心选择与草稿一致 → 接受
+- 第一个不一致的位置 → 采用主模型的选择，丢弃后面的草稿
+每次主模型前向至少产出1个token，草稿猜得准时一次产出多个。
+
+只支持贪心解码（temperature=0），草稿和验证都施加与 Llama 相同的重复惩罚
+（repeat_penalty，最近 last_n_tokens_size 个token），输出与
+llm(prompt, temperature=0) 相同；temperature>0 时直接交给主模型正常采样。
+ProductionRAG / TrafficLawRAG 检测到投机解码（speculative 属性，或常驻服务
+用 --draft 启动）时默认改用 temperature=0，见各自的 greedy_with_draft 开关。
+
+    llm = Llama(model_path=".../qwen2.5-3b-instruct-q4_k_m.gguf", n_ctx=4096)
+    draft = Llama(model_path=".../qwen2.5-0.5b-instruct-q4_k_m.gguf", n_ctx=4096)
+    spec = SpeculativeDecoder(llm, draft, n_draft=4)
+    output = spec(prompt, max_tokens=512, temperature=0)
+    print(spec.last_report)   # 接受率、主模型前向次数、加速比
+
+调用方式与 Llama.__call__ 相同，可以传给 ProductionRAG(llm=...)
+或 TrafficLawRAG(llm=...)。
+"""
+
+import time
+import codecs
+import inspect
+from pathlib import Path
+
+import numpy as np
+import llama_cpp
+
+from batch_scheduler import _new_context, _seq_rm
+
+
+class _Sequence:
+    """一个模型在独立上下文中的单序列KV状态"""
+
+    def __init__(self, llm, n_ctx: int, n_batch: int):
+        self.llm = llm
+        self.model = llm._model.model
+        self.n_vocab = llm.n_vocab()
+        self.n_batch = n_batch
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = n_ctx
+        params.n_batch = n_batch
+        if hasattr(params, "n_ubatch"):
+            params.n_ubatch = min(n_batch, 512)
+        params.n_threads = llm.context_params.n_threads
+        params.n_threads_batch = llm.context_params.n_threads_batch
+        self.ctx = _new_context(self.model, params)
+        if not self.ctx:
+            raise RuntimeError("创建上下文失败")
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, 1)
+        self.tokens = []      # 已经在KV缓存中的token
+        self.n_forward = 0    # llama_decode 调用次数
+
+    def truncate(self, n: int):
+        """回滚到前 n 个token"""
+        if n < len(self.tokens):
+            _seq_rm(self.ctx, 0, n, -1)
+            self.tokens = self.tokens[:n]
+
+    def sync(self, tokens):
+        """让KV缓存恰好包含 tokens：保留公共前缀，只计算差异部分"""
+        common = 0
+        for a, b in zip(self.tokens, tokens):
+            if a != b:
+                break
+            common += 1
+        self.truncate(common)
+        if common < len(tokens):
+            self.eval(tokens[common:], all_logits=False)
+
+    def eval(self, tokens, all_logits: bool = False):
+        """
+        送入 tokens
+
+        Returns:
+            all_logits=True 时每个token之后的logits，否则只有最后一个
+        """
+        rows = []
+        for start in range(0, len(tokens), self.n_batch):
+            piece = tokens[start:start + self.n_batch]
+            is_final = start + len(piece) == len(tokens)
+            batch = self.batch
+            for i, token in enumerate(piece):
+                batch.token[i] = token
+                batch.pos[i] = len(self.tokens) + i
+                batch.n_seq_id[i] = 1
+                batch.seq_id[i][0] = 0
+                batch.logits[i] = all_logits or (is_final and i == len(piece) - 1)
+            batch.n_tokens = len(piece)
+
+            ret = llama_cpp.llama_decode(self.ctx, batch)
+            self.n_forward += 1
+            if ret != 0:
+                raise RuntimeError(f"llama_decode 失败 (返回值 {ret})，可能是KV缓存已满")
+            self.tokens.extend(piece)
+
+            for i in range(len(piece)):
+                if batch.logits[i]:
+                    ptr = llama_cpp.llama_get_logits_ith(self.ctx, i)
+                    rows.append(np.ctypeslib.as_array(ptr, shape=(self.n_vocab,)).copy())
+        return rows
+
+    def close(self):
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+
+def _default_repeat_penalty() -> float:
+    """Llama.__call__ 的 repeat_penalty 默认值（不同版本的 llama-cpp-python 不同）"""
+    try:
+        return float(inspect.signature(llama_cpp.Llama.create_completion).parameters['repeat_penalty'].default)
+    except (KeyError, TypeError, ValueError):
+        return 1.1
+
+
+def apply_repeat_penalty(logits: np.ndarray, history, penalty: float, last_n: int) -> np.ndarray:
+    """
+    llama.cpp 的重复惩罚：最近 last_n 个token中出现过的token，
+    正的logit除以 penalty，负的乘以 penalty（原地修改）
+    """
+    if penalty == 1.0 or last_n <= 0 or not history:
+        return logits
+    recent = np.unique(np.asarray(history[-last_n:], dtype=np.int64))
+    values = logits[recent]
+    logits[recent] = np.where(values > 0, values / penalty, values * penalty)
+    return logits
+
+
+class SpeculativeDecoder:
+    """草稿模型 + 主模型的贪心投机解码"""
+
+    speculative = True     # RAG 类据此把生成温度设为0
+
+    def __init__(self, llm, draft_llm, n_draft: int = 4, n_ctx: int = None):
+        """
+        Args:
+            llm: 主模型（Llama 实例，输出以它为准）
+            draft_llm: 草稿模型（Llama 实例，必须与主模型词表相同）
+            n_draft: 每轮草稿token数 k
+            n_ctx: 上下文长度，默认与主模型相同
+        """
+        if llm.n_vocab() != draft_llm.n_vocab():
+            raise ValueError(
+                f"草稿模型与主模型词表不同 ({draft_llm.n_vocab()} != {llm.n_vocab()})，"
+                "请选择同一系列的小模型"
+            )
+
+        self.llm = llm
+        self.draft_llm = draft_llm
+        self.n_draft = n_draft
+        self.model_path = getattr(llm, "model_path", "")
+        self._n_ctx = n_ctx or llm.n_ctx()
+        self.eos = llm.token_eos()
+        self.repeat_penalty = _default_repeat_penalty()
+        self.last_n = getattr(llm, "last_n_tokens_size", 64)
+
+        n_batch = max(512, n_draft + 1)
+        self.target = _Sequence(llm, self._n_ctx, n_batch)
+        self.draft = _Sequence(draft_llm, self._n_ctx, n_batch)
+
+        self.baseline_tps = None   # 主模型单独贪心解码的速度（benchmark 测得）
+        self.last_report = None
+
+    # ---------------- 与 Llama 相同的接口 ----------------
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return self.llm.tokenize(text, add_bos=add_bos, special=special)
+
+    def __call__(self,
+                 prompt: str,
+                 max_tokens: int = 16,
+                 temperature: float = 0.8,
+                 stop=None,
+                 stream: bool = False,
+                 repeat_penalty: float = None,
+                 **kwargs):
+        """
+        补全（参数和返回值与 Llama.__call__ 相同）
+
+        temperature>0 时交给主模型正常采样；贪心解码时只支持 repeat_penalty，
+        忽略其余采样参数
+        """
+        if temperature > 0:
+            self.last_report = {'mode': 'fallback', 'reason': f'temperature={temperature}'}
+            if repeat_penalty is not None:
+                kwargs['repeat_penalty'] = repeat_penalty
+            return self.llm(prompt, max_tokens=max_tokens, temperature=temperature,
+                            stop=stop, stream=stream, **kwargs)
+
+        if isinstance(stop, str):
+            stop = [stop]
+        chunks = self._completion(prompt, max_tokens, [s for s in (stop or []) if s],
+                                  repeat_penalty=repeat_penalty)
+        if stream:
+            return chunks
+
+        text = ""
+        finish_reason = None
+        for chunk in chunks:
+            text += chunk['choices'][0]['text']
+            finish_reason = chunk['choices'][0]['finish_reason'] or finish_reason
+        report = self.last_report
+        return {
+            'id': f"cmpl-spec-{int(time.time() * 1000)}",
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'choices': [{'text': text, 'index': 0, 'logprobs': None, 'finish_reason': finish_reason}],
+            'usage': {
+                'prompt_tokens': report['prompt_tokens'],
+                'completion_tokens': report['tokens'],
+                'total_tokens': report['prompt_tokens'] + report['tokens']
+            },
+            'speculative': report
+        }
+
+    create_completion = __call__
+
+    # ---------------- 解码 ----------------
+
+    def _is_eog(self, token: int) -> bool:
+        if token == self.eos:
+            return True
+        try:
+            if hasattr(llama_cpp, "llama_vocab_is_eog"):
+                vocab = llama_cpp.llama_model_get_vocab(self.target.model)
+                return bool(llama_cpp.llama_vocab_is_eog(vocab, token))
+            if hasattr(llama_cpp, "llama_token_is_eog"):
+                return bool(llama_cpp.llama_token_is_eog(self.target.model, token))
+        except Exception:
+            pass
+        return False
+
+    def _choose(self, logits: np.ndarray, history, penalty: float) -> int:
+        """重复惩罚后的贪心选择（与 Llama 在 temperature=0 时相同）"""
+        return int(np.argmax(apply_repeat_penalty(logits, history, penalty, self.last_n)))
+
+    def generate_tokens(self, prompt_tokens, max_tokens: int, n_draft: int = None,
+                        repeat_penalty: float = None):
+        """
+        贪心投机解码，逐个产出主模型的token
+
+        n_draft=0 时退化为主模型逐token的普通贪心解码。
+        统计写入 self.last_report
+        """
+        n_draft = self.n_draft if n_draft is None else n_draft
+        penalty = self.repeat_penalty if repeat_penalty is None else repeat_penalty
+        if len(prompt_tokens) + max_tokens > self._n_ctx:
+            max_tokens = self._n_ctx - len(prompt_tokens)
+            if max_tokens <= 0:
+                raise ValueError(f"提示词过长: {len(prompt_tokens)} tokens，上下文为 {self._n_ctx}")
+
+        report = {
+            'mode': 'speculative' if n_draft else 'greedy',
+            'n_draft': n_draft,
+            'prompt_tokens': len(prompt_tokens),
+            'tokens': 0,
+            'drafted': 0,
+            'accepted': 0,
+            'target_steps': 0,
+            'time': 0.0
+        }
+        self.last_report = report
+        target_forward = self.target.n_forward
+        start = time.time()
+
+        # 已确定的上下文 = context + [last]；last 还没有送入主模型
+        context = list(prompt_tokens[:-1])
+        last = prompt_tokens[-1]
+        produced = 0
+
+        try:
+            while produced < max_tokens:
+                self.target.sync(context)
+
+                # 1. 草稿模型逐个猜 k 个token
+                drafts = []
+                k = min(n_draft, max_tokens - produced - 1)
+                if k > 0:
+                    self.draft.sync(context)
+                    token = last
+                    history = context + [last]
+                    for _ in range(k):
+                        logits = self.draft.eval([token])[-1]
+                        token = self._choose(logits, history, penalty)
+                        drafts.append(token)
+                        history.append(token)
+                        if self._is_eog(token):
+                            break
+
+                # 2. 主模型一次batch验证：每个位置的贪心选择
+                #    第 i 行是看到 context + [last] + drafts[:i] 之后的logits，惩罚窗口也到这里为止
+                rows = self.target.eval([last] + drafts, all_logits=True)
+                report['target_steps'] += 1
+                accepted = []
+                history = context + [last]
+                for i, row in enumerate(rows):
+                    choice = self._choose(row, history + drafts[:i], penalty)
+                    accepted.append(choice)
+                    if i >= len(drafts) or choice != drafts[i]:
+                        break
+                report['drafted'] += len(drafts)
+                report['accepted'] += len(accepted) - 1
+
+                # 3. 产出主模型确认的token（不一致位置用主模型的选择）
+                for token in accepted:
+                    if self._is_eog(token):
+                        return
+                    produced += 1
+                    report['tokens'] = produced
+                    yield token
+                    if produced >= max_tokens:
+                        return
+
+                # 最后一个token还没送入主模型，下一轮作为 last
+                context = context + [last] + accepted[:-1]
+                last = accepted[-1]
+        finally:
+            report['time'] = time.time() - start
+            report['target_forward'] = self.target.n_forward - target_forward
+            report['acceptance_rate'] = report['accepted'] / report['drafted'] if report['drafted'] else 0.0
+            report['tokens_per_step'] = report['tokens'] / max(report['target_steps'], 1)
+            report['tokens_per_sec'] = report['tokens'] / report['time'] if report['time'] > 0 else 0.0
+            report['speedup'] = (report['tokens_per_sec'] / self.baseline_tps
+                                 if self.baseline_tps and n_draft else None)
+
+    def _completion(self, prompt: str, max_tokens: int, stop, n_draft: int = None,
+                    repeat_penalty: float = None):
+        """把token流转换成与 Llama 相同的流式chunk（处理停止词）"""
+        prompt_tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+        completion_id = f"cmpl-spec-{int(time.time() * 1000)}"
+        created = int(time.time())
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        hold = max((len(s) - 1 for s in stop), default=0)
+        text = ""
+        emitted = 0
+        finish_reason = "stop"
+
+        def chunk(piece, reason=None):
+            return {
+                'id': completion_id,
+                'object': 'text_completion',
+                'created': created,
+                'choices': [{'text': piece, 'index': 0, 'logprobs': None, 'finish_reason': reason}]
+            }
+
+        tokens = self.generate_tokens(prompt_tokens, max_tokens, n_draft, repeat_penalty)
+        try:
+            for n, token in enumerate(tokens, 1):
+                text += decoder.decode(self.llm.detokenize([token]))
+
+                positions = [p for p in (text.find(s) for s in stop) if p != -1]
+                if positions:
+                    text = text[:min(positions)]
+                    break
+                if n >= max_tokens:
+                    finish_reason = "length"
+
+                # 末尾可能是停止词的前半部分，先扣住不推送
+                safe = max(emitted, len(text) - hold)
+                if safe > emitted:
+                    yield chunk(text[emitted:safe])
+                    emitted = safe
+        finally:
+            tokens.close()
+
+        yield chunk(text[emitted:], finish_reason)
+
+    def benchmark(self, prompt: str, max_tokens: int = 256) -> dict:
+        """
+        对同一个提示词分别用主模型自己（llm(prompt, temperature=0)）和投机解码生成
+
+        检查两者输出一致，并记录主模型单独解码的速度（之后的请求据此报告加速比）
+        """
+        start = time.time()
+        reference = self.llm(prompt, max_tokens=max_tokens, temperature=0,
+                             repeat_penalty=self.repeat_penalty)
+        elapsed = time.time() - start
+        reference_tokens = reference['usage']['completion_tokens']
+        greedy_report = {
+            'tokens': reference_tokens,
+            'time': elapsed,
+            'tokens_per_sec': reference_tokens / elapsed if elapsed > 0 else 0.0
+        }
+        self.baseline_tps = greedy_report['tokens_per_sec']
+
+        speculative = "".join(
+            chunk['choices'][0]['text'] for chunk in self._completion(prompt, max_tokens, [])
+        )
+        spec_report = self.last_report
+
+        return {
+            'identical': reference['choices'][0]['text'] == speculative,
+            'greedy': greedy_report,
+            'speculative': spec_report,
+            'speedup': spec_report['speedup']
+        }
+
+    def close(self):
+        self.target.close()
+        self.draft.close()
+
+
+def pick_draft_model(target_path, models=None):
+    """
+    从模型目录中挑选草稿模型：与主模型同架构、同词表，参数量最小的一个
+
+    只读GGUF文件头（gguf_catalog），不需要加载模型就能判断词表是否一致
+    """
+    from gguf_catalog import GGUFCatalog
+
+    catalog = GGUFCatalog()
+    target = catalog.get(target_path)
+    candidates = [
+        m for m in catalog.query(arch=target['arch'], vocab_size=target['vocab_size'], sort_by="n_params")
+        if m['path'] != target['path'] and m['n_params'] < target['n_params']
+    ]
+    if models is not None:
+        allowed = {str(m) for m in models}
+        candidates = [m for m in candidates if m['path'] in allowed]
+    return Path(candidates[0]['path']) if candidates else None
+
+
+def print_report(report: dict):
+    """打印单个请求的投机解码统计"""
+    if report is None or report.get('mode') == 'fallback':
+        print("   (未使用投机解码)")
+        return
+    print(f"   生成: {report['tokens']} tokens, {report['time']:.2f}秒, "
+          f"{report['tokens_per_sec']:.2f} tokens/秒")
+    print(f"   草稿接受率: {report['acceptance_rate']:.0%} "
+          f"({report['accepted']}/{report['drafted']})")
+    print(f"   主模型验证次数: {report['target_steps']} "
+          f"(平均每次 {report['tokens_per_step']:.2f} tokens)")
+    if report['speedup'] is not None:
+        print(f"   加速比: {report['speedup']:.2f}x")
+
+
+# ============================================================
+# 演示：普通贪心 vs 投机解码
+# ============================================================
+
+if __name__ == "__main__":
+    import sys
+    from test_llamacpp import find_gguf_models
+
+    models = find_gguf_models()
+    if len(sys.argv) > 2:
+        target_path, draft_path = Path(sys.argv[1]), Path(sys.argv[2])
+    elif models:
+        target_path = models[-1]   # 按大小排序，最大的作为主模型
+        draft_path = pick_draft_model(target_path, models)
+    else:
+        target_path = draft_path = None
+
+    if target_path is None or draft_path is None:
+        print("❌ 需要两个同系列的GGUF模型（主模型 + 更小的草稿模型）")
+        print("   python speculative.py <主模型.gguf> <草稿模型.gguf>")
+        sys.exit(1)
+
+    print(f"🤖 主模型: {target_path.name}")
+    print(f"✏️  草稿模型: {draft_path.name}")
+    llm = llama_cpp.Llama(model_path=str(target_path), n_ctx=2048, verbose=False)
+    draft = llama_cpp.Llama(model_path=str(draft_path), n_ctx=2048, verbose=False)
+    spec = SpeculativeDecoder(llm, draft, n_draft=4)
+
+    prompt = "<|im_start|>user\n醉驾会受到什么处罚？请详细说明。<|im_end|>\n<|im_start|>assistant\n"
+
+    print("\n📊 普通贪心 vs 投机解码（256 tokens）:")
+    result = spec.benchmark(prompt, max_tokens=256)
+    print(f"\n   普通贪心: {result['greedy']['tokens_per_sec']:.2f} tokens/秒")
+    print("   投机解码:")
+    print_report(result['speculative'])
+    print(f"\n   输出一致: {'✅' if result['identical'] else '❌'}")
+
+    print("\n💬 流式输出:")
+    for chunk in spec(prompt, max_tokens=256, temperature=0, stop=["<|im_end|>"], stream=True):
+        print(chunk['choices'][0]['text'], end="", flush=True)
+    print()
+    print_report(spec.last_report)
+
+    spec.close()
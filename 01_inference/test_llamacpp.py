@@ -12,28 +12,25 @@ import os
 import time
 from pathlib import Path
 
+from llama_factory import create_llama
+from gguf_catalog import GGUFCatalog, format_params
 
-def find_gguf_models():
-    """查找可用的GGUF模型"""
-    possible_paths = [
-        Path.home() / "llama.cpp" / "models",
-        Path.home() / ".ollama" / "models",
-        Path("/Users/a58/code/MyLLM/models")
-    ]
-    
-    gguf_models = []
-    for path in possible_paths:
-        if path.exists():
-            for file in path.rglob("*.gguf"):
-                gguf_models.append(file)
-    
-    return gguf_models
+
+def find_gguf_models(refresh=False):
+    """
+    查找可用的GGUF模型
+    
+    使用 gguf_catalog 的缓存目录：只读文件头，文件没变就不再读取
+    """
+    catalog = GGUFCatalog()
+    catalog.scan(refresh=refresh)
+    return [Path(m['path']) for m in catalog.query(sort_by="size")]
 
 
 def test_llamacpp_basic(model_path, prompt="什么是大语言模型？"):
     """基础推理测试"""
     try:
-        from llama_cpp import Llama
+        import llama_cpp  # noqa: F401
     except ImportError:
         print("❌ llama-cpp-python未安装")
         print("\n安装方法：")
@@ -50,10 +47,10 @@ def test_llamacpp_basic(model_path, prompt="什么是大语言模型？"):
     print("\n[1/3] 加载模型...")
     start = time.time()
     
-    llm = Llama(
-        model_path=str(model_path),
+    # 线程数、batch大小等使用本机调优配置（autotune.py）
+    llm = create_llama(
+        model_path,
         n_ctx=2048,          # 上下文窗口
-        n_threads=6,         # CPU线程数（M1建议4-8）
         n_gpu_layers=1,      # 使用Metal加速
         verbose=False
     )
@@ -99,7 +96,7 @@ def test_llamacpp_basic(model_path, prompt="什么是大语言模型？"):
 def test_llamacpp_stream(model_path, prompt="写一首关于人工智能的四行诗"):
     """流式输出测试"""
     try:
-        from llama_cpp import Llama
+        import llama_cpp  # noqa: F401
     except ImportError:
         return
     
@@ -110,10 +107,9 @@ def test_llamacpp_stream(model_path, prompt="写一首关于人工智能的四
     print("-" * 60)
     
     # 加载模型
-    llm = Llama(
-        model_path=str(model_path),
+    llm = create_llama(
+        model_path,
         n_ctx=2048,
-        n_threads=6,
         n_gpu_layers=1,
         verbose=False
     )
@@ -146,13 +142,26 @@ def test_llamacpp_stream(model_path, prompt="写一首关于人工智能的四
     print(f"🚀 速度: {token_count/elapsed:.2f} tokens/秒")
 
 
-def benchmark_quantization(model_paths):
-    """对比不同量化方式的性能"""
+def benchmark_quantization(model_paths=None, max_models=3):
+    """
+    对比不同量化方式的性能
+    
+    不指定 model_paths 时从模型目录中挑选：同一架构下每种量化方式各一个
+    """
     try:
-        from llama_cpp import Llama
+        import llama_cpp  # noqa: F401
     except ImportError:
         return
     
+    catalog = GGUFCatalog()
+    if model_paths is None:
+        models = catalog.query(sort_by="size")
+        arch = models[0]['arch'] if models else None
+        by_quant = {}
+        for m in catalog.query(arch=arch, sort_by="n_params", descending=True):
+            by_quant.setdefault(m['quant'], m)
+        model_paths = [Path(m['path']) for m in list(by_quant.values())[:max_models]]
+    
     print("\n" + "="*60)
     print("📊 量化方式性能对比")
     print("="*60)
@@ -162,14 +171,14 @@ def benchmark_quantization(model_paths):
     results = []
     
     for model_path in model_paths:
-        print(f"\n测试: {model_path.name}")
+        info = catalog.get(model_path)
+        print(f"\n测试: {info['name']} ({info['quant'] or '未知量化'}, {format_params(info['n_params'])}参数)")
         
         # 加载模型
         start = time.time()
-        llm = Llama(
-            model_path=str(model_path),
+        llm = create_llama(
+            model_path,
             n_ctx=512,
-            n_threads=6,
             verbose=False
         )
         load_time = time.time() - start
@@ -184,11 +193,10 @@ def benchmark_quantization(model_paths):
         tokens = output['usage']['completion_tokens']
         speed = tokens / gen_time
         
-        # 获取模型大小
-        size_gb = model_path.stat().st_size / 1e9
+        size_gb = info['size'] / 1e9
         
         results.append({
-            'name': model_path.name,
+            'name': f"{info['name']} {info['quant'] or ''}".strip(),
             'size': size_gb,
             'load_time': load_time,
             'speed': speed
@@ -225,7 +233,7 @@ if __name__ == "__main__":
         
         print("\n方法2：如果已安装Ollama，模型在：")
         print("  ~/.ollama/models/blobs/")
-        print("  （需要找到.gguf文件）")
+        print("  （会按文件头自动识别，不需要.gguf扩展名）")
         
         print("\n方法3：手动下载")
         print("  访问：https://huggingface.co/Qwen/Qwen2-7B-Instruct-GGUF")
@@ -235,10 +243,13 @@ if __name__ == "__main__":
         exit(1)
     
     print(f"\n✅ 找到 {len(models)} 个模型:")
+    catalog = GGUFCatalog()
     for i, model in enumerate(models, 1):
-        size_gb = model.stat().st_size / 1e9
-        print(f"  {i}. {model.name} ({size_gb:.2f} GB)")
-        print(f"     位置: {model.parent}")
+        info = catalog.get(model)
+        print(f"  {i}. {info['name']} ({info['quant'] or '未知量化'}, "
+              f"{format_params(info['n_params'])}参数, 上下文 {info['context_length'] or '-'}, "
+              f"{info['size'] / 1e9:.2f} GB)")
+        print(f"     位置: {model}")
     
     # 选择第一个模型进行测试
     selected_model = models[0]
@@ -262,12 +273,12 @@ if __name__ == "__main__":
         print("\n" + "="*60)
         response = input("是否对比不同量化方式的性能？[y/N]: ")
         if response.lower() == 'y':
-            benchmark_quantization(models[:3])  # 最多对比3个
+            benchmark_quantization()  # 同一架构下每种量化方式各一个，最多3个
     
     print("\n✅ 测试完成！")
     print("\n💡 提示：")
     print("  - llama.cpp比Transformers快5-10倍")
     print("  - Q4_K_M量化是最佳平衡选择")
     print("  - M1芯片Metal加速效果明显")
-    print("  - 可以通过n_threads参数调整CPU线程数")
+    print("  - 运行 autotune.py 为本机找出最佳线程数和batch大小")
 
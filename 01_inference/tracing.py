@@ -0,0 +1,374 @@
+"""
+轻量级链路追踪：基于 contextvars 的 span
+
+检索和生成的每个阶段都包在一个 span 里，span 记录开始/结束时间、父 span 和属性
+（k、候选数、token数……）。结束的 span 进入两个地方：
+- 最近 N 个 span 的环形缓冲，可导出为 Chrome trace-event JSON
+  （chrome://tracing 或 https://ui.perfetto.dev 打开，能看到嵌套的时间线）
+- 按名字汇总的滚动统计（次数、平均、p50/p95、最大值）
+
+默认关闭。关闭时 span() 直接返回一个共享的空对象、traced 包装的函数只多一次
+全局变量判断，几乎没有开销；设置环境变量 RAG_TRACE=1 或调用 enable() 打开。
+
+    import tracing
+
+    @tracing.traced("retriever.vector_search")
+    def vector_search(self, query, n_results=10):
+        ...
+        tracing.current_span().set(k=n_results, candidates=len(results))
+
+    with tracing.span("docs.encode", chunks=len(chunks)):
+        ...
+
+    tracing.enable()
+    ...
+    tracing.print_summary()
+    tracing.export_chrome_trace("trace.json")
+"""
+
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+import itertools
+import contextvars
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+_current = contextvars.ContextVar("current_span", default=None)
+_ids = itertools.count(1)
+_enabled = False
+_recorder = None
+
+
+class Span:
+    """一次计时的操作"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "thread_id", "attrs")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        parent = _current.get()
+        self.name = name
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.thread_id = threading.get_ident()
+        self.attrs = attrs
+        self.end = None
+        self.start = time.perf_counter()
+
+    def set(self, **attrs) -> "Span":
+        """添加/更新属性"""
+        self.attrs.update(attrs)
+        return self
+
+    @property
+    def duration(self) -> float:
+        """耗时（秒），未结束时到现在为止"""
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+
+class _ActiveSpan(Span):
+    """with 语句里的 span：进入时成为当前 span，子操作自动挂在它下面"""
+
+    __slots__ = ("_token",)
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        _finish(self)
+        return False
+
+
+class _NoopSpan:
+    """追踪关闭时的共享空 span：所有操作都什么也不做"""
+
+    __slots__ = ()
+    name = ""
+    attrs = {}
+    duration = 0.0
+
+    def set(self, **attrs) -> "_NoopSpan":
+        return self
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class TraceRecorder:
+    """保存结束的 span，维护按名字的滚动统计"""
+
+    def __init__(self, max_spans: int = 10000, window: int = 1000):
+        """
+        Args:
+            max_spans: 保留最近多少个 span 用于导出
+            window: 每个名字用最近多少次耗时计算分位数
+        """
+        self.max_spans = max_spans
+        self.window = window
+        self.spans = deque(maxlen=max_spans)
+        self.stats = {}
+        self.origin = time.perf_counter()   # trace-event 的时间戳从这里算起
+        self.lock = threading.Lock()
+
+    def record(self, span: Span):
+        elapsed = span.end - span.start
+        with self.lock:
+            self.spans.append(span)
+            stat = self.stats.get(span.name)
+            if stat is None:
+                stat = self.stats[span.name] = {
+                    'count': 0, 'total': 0.0, 'max': 0.0, 'recent': deque(maxlen=self.window)
+                }
+            stat['count'] += 1
+            stat['total'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            stat['recent'].append(elapsed)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """{名字: {count, total_ms, mean_ms, p50_ms, p95_ms, max_ms}}，分位数按最近 window 次计算"""
+        with self.lock:
+            snapshot = {name: (s['count'], s['total'], s['max'], sorted(s['recent']))
+                        for name, s in self.stats.items()}
+        result = {}
+        for name, (count, total, longest, recent) in snapshot.items():
+            result[name] = {
+                'count': count,
+                'total_ms': total * 1000,
+                'mean_ms': total / count * 1000,
+                'p50_ms': _percentile(recent, 50) * 1000,
+                'p95_ms': _percentile(recent, 95) * 1000,
+                'max_ms': longest * 1000
+            }
+        return result
+
+    def trace_events(self) -> List[Dict[str, Any]]:
+        """转换为 Chrome trace-event 的完整事件（ph = "X"，时间单位微秒）"""
+        pid = os.getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = []
+        for span in spans:
+            args = {k: _jsonable(v) for k, v in span.attrs.items()}
+            args['span_id'] = span.span_id
+            if span.parent_id is not None:
+                args['parent_id'] = span.parent_id
+            events.append({
+                'name': span.name,
+                'cat': span.name.split(".", 1)[0],
+                'ph': 'X',
+                'ts': (span.start - self.origin) * 1e6,
+                'dur': (span.end - span.start) * 1e6,
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': args
+            })
+        return events
+
+    def last(self, name: str) -> Optional[Span]:
+        """最近结束的同名 span"""
+        with self.lock:
+            for span in reversed(self.spans):
+                if span.name == name:
+                    return span
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+            self.stats.clear()
+            self.origin = time.perf_counter()
+
+
+def percentile(values: List[float], p: float) -> float:
+    """线性插值百分位（p: 0-100），各个基准脚本共用"""
+    return _percentile(sorted(values), p)
+
+
+def _percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def _jsonable(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _finish(span: Span):
+    span.end = time.perf_counter()
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record(span)
+
+
+# ============================================================
+# 开关
+# ============================================================
+
+def enable(max_spans: int = 10000, window: int = 1000) -> TraceRecorder:
+    """打开追踪（已打开时保留已有记录）"""
+    global _enabled, _recorder
+    if _recorder is None:
+        _recorder = TraceRecorder(max_spans=max_spans, window=window)
+    _enabled = True
+    return _recorder
+
+
+def disable():
+    """关闭追踪（已有记录保留，可以继续导出）"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    """清空已记录的 span 和统计"""
+    if _recorder is not None:
+        _recorder.clear()
+
+
+# ============================================================
+# 埋点
+# ============================================================
+
+def span(name: str, **attrs):
+    """
+    计时一段代码：with tracing.span("name", k=5) as sp: ... sp.set(n=3)
+
+    追踪关闭时返回共享的空 span
+    """
+    if not _enabled:
+        return NOOP_SPAN
+    return _ActiveSpan(name, attrs)
+
+
+def current_span():
+    """当前的 span（用来在函数内部补充属性）；追踪关闭或不在 span 里时返回空 span"""
+    if not _enabled:
+        return NOOP_SPAN
+    return _current.get() or NOOP_SPAN
+
+
+def traced(name: Optional[str] = None):
+    """
+    装饰器：把整个函数调用包在一个 span 里
+
+    生成器函数的 span 覆盖整个迭代过程（到生成器结束或被关闭），
+    生成器内部代码运行时这个 span 是当前 span
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return func(*args, **kwargs)
+                return _traced_generator(span_name, func(*args, **kwargs))
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not _enabled:
+                    return func(*args, **kwargs)
+                with _ActiveSpan(span_name, {}):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _traced_generator(name: str, gen):
+    # 每次恢复生成器时把 span 设为当前 span，交还给调用方前恢复，
+    # 调用方在两次 next() 之间创建的 span 不会误挂到生成器下面
+    sp = Span(name, {})
+    try:
+        sent = None
+        while True:
+            token = _current.set(sp)
+            try:
+                item = gen.send(sent)
+            except StopIteration as stop:
+                return stop.value
+            except BaseException as e:
+                sp.attrs['error'] = type(e).__name__
+                raise
+            finally:
+                _current.reset(token)
+            sent = yield item
+    finally:
+        gen.close()
+        _finish(sp)
+
+
+# ============================================================
+# 输出
+# ============================================================
+
+def summary() -> Dict[str, Dict[str, float]]:
+    """按名字的滚动统计，没有打开过追踪时为空"""
+    return _recorder.summary() if _recorder is not None else {}
+
+
+def last_span(name: str) -> Optional[Span]:
+    """最近结束的同名 span（没有时为 None）"""
+    return _recorder.last(name) if _recorder is not None else None
+
+
+def last_duration(name: str) -> float:
+    """最近一次同名 span 的耗时（秒），没有记录时为 0"""
+    found = last_span(name)
+    return found.duration if found is not None else 0.0
+
+
+def export_chrome_trace(path: str) -> int:
+    """
+    导出为 Chrome trace-event JSON
+
+    Returns:
+        导出的事件数
+    """
+    events = _recorder.trace_events() if _recorder is not None else []
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+    return len(events)
+
+
+def print_summary(title: str = "链路追踪统计"):
+    """按总耗时从高到低打印滚动统计"""
+    stats = summary()
+    print("\n" + "=" * 78)
+    print(f"🔍 {title}")
+    print("=" * 78)
+    if not stats:
+        print("   （没有记录，追踪未打开？设置 RAG_TRACE=1 或调用 tracing.enable()）")
+        return
+    print(f"{'span':<30}{'次数':>6}{'平均':>10}{'p50':>10}{'p95':>10}{'最大':>10}")
+    print("-" * 78)
+    for name, s in sorted(stats.items(), key=lambda item: item[1]['total_ms'], reverse=True):
+        print(f"{name:<30}{s['count']:>8}{s['mean_ms']:>8.1f}ms{s['p50_ms']:>8.1f}ms"
+              f"{s['p95_ms']:>8.1f}ms{s['max_ms']:>8.1f}ms")
+    print("=" * 78)
+
+
+if os.environ.get("RAG_TRACE", "").lower() in ("1", "true", "yes", "on"):
+    enable()
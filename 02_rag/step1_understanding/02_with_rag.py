@@ -3,7 +3,12 @@
 演示：通过检索相关文档，LLM可以准确回答私有知识问题
 """
 
-from llama_cpp import Llama
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
 
 print("="*60)
 print("实验2：使用RAG的LLM")
@@ -12,10 +17,9 @@ print()
 
 # 加载模型
 print("正在加载模型...")
-llm = Llama(
+llm = connect_or_load(
     model_path="/Users/a58/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf",
     n_ctx=2048,
-    n_threads=4,
     n_gpu_layers=0,
     verbose=False
 )
@@ -3,7 +3,12 @@
 并排展示两种方式的回答差异
 """
 
-from llama_cpp import Llama
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
 
 print("="*70)
 print(" "*20 + "RAG vs 普通LLM 对比实验")
@@ -12,10 +17,9 @@ print()
 
 # 加载模型
 print("正在加载模型...")
-llm = Llama(
+llm = connect_or_load(
     model_path="/Users/a58/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf",
     n_ctx=2048,
-    n_threads=4,
     n_gpu_layers=0,
     verbose=False
 )
@@ -10,6 +10,7 @@ from sentence_transformers import SentenceTransformer
 import numpy as np
 import time
 import os
+from synthetic_corpus import SyntheticCorpus
 
 print("=" * 60)
 print("⚡ ChromaDB性能优化")
@@ -27,9 +28,11 @@ print(f"\n📦 加载embedding模型...")
 model = SentenceTransformer('shibing624/text2vec-base-chinese')
 print("   ✅ 模型加载完成")
 
-# 准备测试数据（100个文档）
+# 准备测试数据（100个文档块）
+# 合成法规语料：按交通法文档的章节、条款和处罚结构生成，比重复的模板字符串更接近真实数据
+corpus = SyntheticCorpus(seed=42)
 num_docs = 100
-test_docs = [f"这是第{i}个测试文档，内容关于交通法规和驾驶安全" for i in range(num_docs)]
+test_docs = [chunk['text'] for chunk in corpus.iter_chunks(num_docs)]
 
 print(f"\n🔄 生成 {num_docs} 个测试向量...")
 test_embeddings = model.encode(test_docs, show_progress_bar=False)
@@ -171,7 +174,7 @@ print(f"\n💾 初始内存: {mem_before:.1f} MB")
 # 加载大量数据
 print(f"\n🔄 创建大规模测试数据...")
 large_num = 1000
-large_docs = [f"测试文档{i}" * 10 for i in range(large_num)]  # 每个文档约100字符
+large_docs = [chunk['text'] for chunk in corpus.iter_chunks(large_num)]  # 每块约80字符
 large_embeddings = model.encode(large_docs, show_progress_bar=True, batch_size=64)
 
 # 测量内存增长
@@ -212,6 +215,7 @@ mem_final = process.memory_info().rss / 1024 / 1024
 
 print(f"💾 导入后内存: {mem_final:.1f} MB")
 print(f"📈 ChromaDB额外占用: {mem_final - mem_after:.1f} MB")
+print("   💡 分组件、1万~100万块的内存剖析: python 05_memory_profile.py")
 
 # ============================================================
 # 第四部分：向量化性能优化
@@ -222,7 +226,7 @@ print("-" * 60)
 
 # 测试不同batch_size对向量化速度的影响
 num_texts = 100
-test_texts = [f"测试文本{i}，关于交通安全和法规" for i in range(num_texts)]
+test_texts = [chunk['text'] for chunk in corpus.iter_chunks(num_texts)]
 
 batch_sizes = [1, 8, 16, 32, 64]
 
@@ -253,7 +257,7 @@ print("-" * 60)
 
 # 测试数据
 test_num = 50
-test_data_docs = [f"文档{i}" for i in range(test_num)]
+test_data_docs = [chunk['text'] for chunk in corpus.iter_chunks(test_num)]
 test_data_embeddings = model.encode(test_data_docs, show_progress_bar=False)
 
 # 测试1：持久化模式
@@ -357,6 +361,8 @@ for batch_size in batch_sizes:
         pass
 
 print("\n✅ 清理完成")
+print("   💡 删除集合不会立即释放磁盘空间，可以运行:")
+print(f"   python ../step6_final_project/06_compact_store.py {db_path}")
 
 # ============================================================
 # 总结
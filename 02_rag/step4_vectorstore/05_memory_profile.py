@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Step 4.5: 内存剖析
+学习目标：知道每个组件在 1万 / 10万 / 100万 个文档块时各占多少内存和磁盘
+
+04_performance.py 的内存部分只测了一次 1000 个文档的RSS。这个脚本按规模逐级导入
+合成法规语料（synthetic_corpus.py，固定种子，结果可复现），分组件记录：
+
+    组件            内存（RSS增量 + tracemalloc 前几名分配点）   其他
+    embedding模型   加载后的增量                                  编码速度
+    Chroma          导入时 / 重新打开后检索时的增量               磁盘占用、向量检索延迟
+    关键词索引      全量取回文档（AdvancedRetriever.keyword_search 的做法）  关键词检索延迟、recall@k
+    缓存            查询向量缓存写满时的增量
+
+每个规模分两个子进程运行（导入、检索），RSS 不会被上一个规模残留的内存污染；
+检索子进程的数字就是线上节点加载同样规模的库后需要的内存。
+
+    python 05_memory_profile.py                          # 1万 / 10万 / 100万
+    python 05_memory_profile.py --scales 10000 --embed model
+    python 05_memory_profile.py --save-baseline memory_baseline.json
+    python 05_memory_profile.py --baseline memory_baseline.json --tolerance 0.2
+
+向量：--embed random（默认）用固定种子生成归一化随机向量，维度与模型相同，
+内存、磁盘和ANN检索的开销与真实向量一致，100万块也能在几分钟内导入；
+--embed model 用模型真实编码（CPU上100万块需要数小时），这时还会用合成问题的
+金标准块统计向量检索的 recall@k。
+tracemalloc 只能看到 Python 分配的内存（numpy、Chroma 的 Python 层），
+模型权重和 HNSW 索引在C/C++里分配，只体现在RSS里。
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+import psutil
+
+from synthetic_corpus import SyntheticCorpus
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from tracing import percentile
+
+MODEL_NAME = 'shibing624/text2vec-base-chinese'
+
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000]
+COMPONENTS = ['embedding_model', 'chroma_ingest', 'chroma_serve', 'keyword_index', 'caches']
+
+_process = psutil.Process(os.getpid())
+
+
+def rss_mb() -> float:
+    gc.collect()
+    return _process.memory_info().rss / 1024 / 1024
+
+
+def peak_rss_mb() -> float:
+    """进程的最大RSS（Linux 下 ru_maxrss 单位是KB，macOS 是字节）"""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def dir_size_mb(path: Path) -> float:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total / 1024 / 1024
+
+
+# ============================================================
+# 分组件测量
+# ============================================================
+
+class ComponentProbe:
+    """
+    测量一段代码让进程多占了多少内存
+
+        with ComponentProbe("chroma_ingest", trace=True) as probe:
+            ...
+        probe.result  →  {rss_mb, traced_mb, traced_peak_mb, top: [...]}
+    """
+
+    def __init__(self, name: str, trace: bool = True, top: int = 5):
+        self.name = name
+        self.trace = trace
+        self.top = top
+        self.result = {}
+
+    def __enter__(self):
+        self.rss_before = rss_mb()
+        if self.trace:
+            tracemalloc.start(1)
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            self.traced_before = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.result['seconds'] = time.perf_counter() - self.start
+        if self.trace:
+            current, peak = tracemalloc.get_traced_memory()
+            ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            stats = tracemalloc.take_snapshot().filter_traces(ignore).compare_to(
+                self.snapshot.filter_traces(ignore), 'lineno')
+            tracemalloc.stop()
+            self.result['traced_mb'] = (current - self.traced_before) / 1024 / 1024
+            self.result['traced_peak_mb'] = (peak - self.traced_before) / 1024 / 1024
+            self.result['top'] = [
+                {'where': _short_location(stat.traceback[0]), 'size_mb': stat.size_diff / 1024 / 1024,
+                 'count': stat.count_diff}
+                for stat in stats[:self.top] if stat.size_diff > 0
+            ]
+        self.result['rss_mb'] = rss_mb() - self.rss_before
+        return False
+
+
+def _short_location(frame) -> str:
+    parts = Path(frame.filename).parts
+    return f"{'/'.join(parts[-2:])}:{frame.lineno}"
+
+
+# ============================================================
+# 向量
+# ============================================================
+
+def random_embeddings(n: int, dim: int, seed: int) -> np.ndarray:
+    """固定种子的归一化随机向量（float32）"""
+    vectors = np.random.default_rng(seed).standard_normal((n, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+# ============================================================
+# 导入（子进程1）
+# ============================================================
+
+def profile_ingest(n: int, store: Path, embed: str = "random", batch_size: int = 1000,
+                   seed: int = 42, trace: bool = True) -> Dict[str, Any]:
+    """导入 n 个合成块，记录导入时的内存、速度和磁盘占用"""
+    import chromadb
+
+    model = None
+    dim = 768
+    if embed == "model":
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(MODEL_NAME)
+        dim = model.get_sentence_embedding_dimension()
+
+    if store.exists():
+        shutil.rmtree(store)
+    baseline_rss = rss_mb()
+
+    with ComponentProbe("chroma_ingest", trace=trace) as probe:
+        client = chromadb.PersistentClient(path=str(store))
+        collection = client.create_collection(name="memory_profile")
+        embed_seconds = 0.0
+        for b, batch in enumerate(SyntheticCorpus(seed=seed).iter_batches(n, batch_size=batch_size)):
+            embed_start = time.perf_counter()
+            if model is not None:
+                vectors = model.encode(batch['documents'], batch_size=64, show_progress_bar=False,
+                                       convert_to_numpy=True, normalize_embeddings=True)
+            else:
+                vectors = random_embeddings(len(batch['ids']), dim, seed + b)
+            embed_seconds += time.perf_counter() - embed_start
+            collection.add(embeddings=vectors.tolist(), **batch)
+            done = min((b + 1) * batch_size, n)
+            print(f"\r   📥 导入 {done:,}/{n:,}", end="", flush=True)
+        print()
+
+    ingest = probe.result
+    ingest['chunks_per_sec'] = n / ingest['seconds'] if ingest['seconds'] > 0 else 0.0
+    ingest['embed_seconds'] = embed_seconds
+    return {
+        'n_chunks': n,
+        'embed': embed,
+        'dim': dim,
+        'baseline_rss_mb': baseline_rss,
+        'components': {'chroma_ingest': ingest},
+        'disk_mb': dir_size_mb(store),
+        'ingest_peak_rss_mb': peak_rss_mb()
+    }
+
+
+# ============================================================
+# 检索（子进程2）
+# ============================================================
+
+def _recall(ranked_ids: List[str], gold: List[str]) -> float:
+    return len(set(ranked_ids) & set(gold)) / len(gold)
+
+
+def keyword_scan(query: str, documents: List[str], n_results: int = 10) -> List[int]:
+    """与 AdvancedRetriever.keyword_search 相同的全量扫描打分"""
+    query_chars = set(query)
+    scored = []
+    for i, doc in enumerate(documents):
+        score = 100 if query in doc else 0
+        score += len(query_chars & set(doc)) / len(query_chars) * 50
+        score += sum(doc.count(c) for c in query) * 2
+        if score > 0:
+            scored.append((score, i))
+    scored.sort(reverse=True)
+    return [i for _, i in scored[:n_results]]
+
+
+def profile_serve(n: int, store: Path, n_queries: int = 50, k: int = 10, cache_size: int = 256,
+                  keyword_limit: int = 100_000, embed: str = "random", seed: int = 42,
+                  trace: bool = True) -> Dict[str, Any]:
+    """像线上节点一样：加载模型、打开已有的库、检索，记录每个组件的内存、检索延迟和召回率"""
+    import chromadb
+    from sentence_transformers import SentenceTransformer
+
+    components = {}
+    latency = {}
+    quality = {}
+    baseline_rss = rss_mb()
+    # 合成问题的金标准块都在前 n 个块里
+    qa = SyntheticCorpus(seed=seed).questions(n_queries, n)
+    queries = [item['question'] for item in qa]
+
+    # 1. embedding模型
+    with ComponentProbe("embedding_model", trace=trace) as probe:
+        model = SentenceTransformer(MODEL_NAME)
+        model.encode(["预热"], show_progress_bar=False)
+    components['embedding_model'] = probe.result
+    encode_start = time.perf_counter()
+    query_vectors = model.encode(queries, batch_size=32, show_progress_bar=False,
+                                 convert_to_numpy=True, normalize_embeddings=True)
+    components['embedding_model']['queries_per_sec'] = len(queries) / (time.perf_counter() - encode_start)
+
+    # 2. Chroma：打开库并完成第一次检索（HNSW索引在第一次检索时加载进内存）
+    with ComponentProbe("chroma_serve", trace=trace) as probe:
+        client = chromadb.PersistentClient(path=str(store))
+        collection = client.get_collection(name="memory_profile")
+        collection.query(query_embeddings=[query_vectors[0].tolist()], n_results=k, include=["distances"])
+    components['chroma_serve'] = probe.result
+
+    times, recalls = [], []
+    for vector, item in zip(query_vectors, qa):
+        start = time.perf_counter()
+        found = collection.query(query_embeddings=[vector.tolist()], n_results=k,
+                                 include=["documents", "metadatas", "distances"])
+        times.append((time.perf_counter() - start) * 1000)
+        recalls.append(_recall(found['ids'][0], item['gold']))
+    latency['vector'] = {'p50_ms': percentile(times, 50), 'p95_ms': percentile(times, 95)}
+    if embed == "model":
+        # 随机向量与文本无关，召回率没有意义
+        quality[f'vector_recall@{k}'] = sum(recalls) / len(recalls)
+
+    # 3. 关键词索引：keyword_search 每次都取回全部文档再扫描
+    if n <= keyword_limit:
+        with ComponentProbe("keyword_index", trace=trace) as probe:
+            fetched = collection.get(include=["documents"])
+            ids, documents = fetched['ids'], fetched['documents']
+        components['keyword_index'] = probe.result
+        times, recalls = [], []
+        for item in qa[:10]:
+            start = time.perf_counter()
+            ranked = keyword_scan(item['question'], documents, k)
+            times.append((time.perf_counter() - start) * 1000)
+            recalls.append(_recall([ids[i] for i in ranked], item['gold']))
+        latency['keyword'] = {'p50_ms': percentile(times, 50), 'p95_ms': percentile(times, 95)}
+        quality[f'keyword_recall@{k}'] = sum(recalls) / len(recalls)
+        del fetched, ids, documents
+    else:
+        components['keyword_index'] = {'skipped': f"超过 --keyword-limit {keyword_limit:,}"}
+
+    # 4. 缓存：查询向量缓存写满（与 AdvancedRetriever._query_embeddings 相同的结构）
+    with ComponentProbe("caches", trace=trace) as probe:
+        cache = OrderedDict()
+        rng = np.random.default_rng(0)
+        for i in range(cache_size):
+            cache[f"问题{i}"] = query_vectors[i % len(query_vectors)] + rng.standard_normal(
+                query_vectors.shape[1], dtype=np.float32) * 1e-3
+    components['caches'] = probe.result
+    components['caches']['entries'] = len(cache)
+
+    return {
+        'baseline_rss_mb': baseline_rss,
+        'components': components,
+        'latency': latency,
+        'quality': quality,
+        'serve_rss_mb': rss_mb(),
+        'serve_peak_rss_mb': peak_rss_mb()
+    }
+
+
+# ============================================================
+# 调度与报告
+# ============================================================
+
+def _run_worker(phase: str, n: int, store: Path, args) -> Dict[str, Any]:
+    """在子进程里运行一个阶段，读回它写出的JSON"""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        output = f.name
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--worker", phase, "--scales", str(n),
+           "--store", str(store), "--worker-output", output, "--embed", args.embed,
+           "--batch-size", str(args.batch_size), "--seed", str(args.seed),
+           "--queries", str(args.queries), "--k", str(args.k), "--cache-size", str(args.cache_size),
+           "--keyword-limit", str(args.keyword_limit)]
+    if args.no_tracemalloc:
+        cmd.append("--no-tracemalloc")
+    try:
+        subprocess.run(cmd, check=True)
+        with open(output, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        os.unlink(output)
+
+
+def _run_phase(phase: str, n: int, store: Path, args) -> Dict[str, Any]:
+    trace = not args.no_tracemalloc
+    if phase == "ingest":
+        return profile_ingest(n, store, embed=args.embed, batch_size=args.batch_size,
+                              seed=args.seed, trace=trace)
+    return profile_serve(n, store, n_queries=args.queries, k=args.k, cache_size=args.cache_size,
+                         keyword_limit=args.keyword_limit, embed=args.embed, seed=args.seed, trace=trace)
+
+
+def profile_scale(n: int, workdir: Path, args) -> Dict[str, Any]:
+    store = workdir / f"scale_{n}"
+    run = _run_phase if args.in_process else _run_worker
+    print(f"\n📏 规模 {n:,} 块")
+    result = run("ingest", n, store, args)
+    served = run("serve", n, store, args)
+    result['components'].update(served.pop('components'))
+    result.update(served)
+    if not args.keep:
+        shutil.rmtree(store, ignore_errors=True)
+    return result
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2,
+            min_delta_mb: float = 20.0, min_delta_ms: float = 5.0) -> List[Dict[str, Any]]:
+    """
+    与基线比较：同规模下某组件的RSS、磁盘占用或检索p95超出基线 tolerance 以上
+    （且绝对差超过 min_delta_mb / min_delta_ms，避免抖动误报）记为回归
+    """
+    regressions = []
+    base_scales = {str(s['n_chunks']): s for s in baseline.get('scales', [])}
+
+    def check(scale, metric, old, new, min_delta):
+        if old is not None and new is not None and new > old * (1 + tolerance) and new - old > min_delta:
+            regressions.append({'scale': scale, 'metric': metric, 'baseline': old, 'current': new,
+                                'change': (new - old) / old if old > 0 else float('inf')})
+
+    for current in report['scales']:
+        base = base_scales.get(str(current['n_chunks']))
+        if base is None:
+            continue
+        n = current['n_chunks']
+        for name in COMPONENTS:
+            check(n, f"{name}.rss_mb", base['components'].get(name, {}).get('rss_mb'),
+                  current['components'].get(name, {}).get('rss_mb'), min_delta_mb)
+        check(n, 'serve_rss_mb', base.get('serve_rss_mb'), current.get('serve_rss_mb'), min_delta_mb)
+        check(n, 'disk_mb', base.get('disk_mb'), current.get('disk_mb'), min_delta_mb)
+        for kind in ('vector', 'keyword'):
+            check(n, f"{kind}.p95_ms", base.get('latency', {}).get(kind, {}).get('p95_ms'),
+                  current.get('latency', {}).get(kind, {}).get('p95_ms'), min_delta_ms)
+    return regressions
+
+
+def _mb(component: Dict[str, Any]) -> str:
+    return f"{component['rss_mb']:.0f}" if 'rss_mb' in component else "-"
+
+
+def print_report(report: Dict[str, Any], regressions: Optional[List[Dict[str, Any]]] = None):
+    print("\n" + "=" * 108)
+    print(f"📊 内存剖析（向量: {report['meta']['embed']}，RSS增量单位MB，延迟为 p50/p95）")
+    print("=" * 108)
+    print(f"{'块数':>10}{'模型':>7}{'Chroma导入':>11}{'Chroma检索':>11}{'关键词':>8}{'缓存':>6}"
+          f"{'检索RSS':>9}{'峰值RSS':>9}{'磁盘MB':>9}{'KB/块':>7}{'向量检索':>14}{'关键词检索':>16}")
+    print("-" * 108)
+    for s in report['scales']:
+        c = s['components']
+        per_chunk = (c['chroma_serve'].get('rss_mb', 0) + s['disk_mb']) * 1024 / s['n_chunks']
+        vector = s['latency'].get('vector')
+        keyword = s['latency'].get('keyword')
+        vector_text = f"{vector['p50_ms']:.1f}/{vector['p95_ms']:.1f}ms" if vector else "-"
+        keyword_text = f"{keyword['p50_ms']:.0f}/{keyword['p95_ms']:.0f}ms" if keyword else "跳过"
+        print(f"{s['n_chunks']:>10,}{_mb(c['embedding_model']):>8}{_mb(c['chroma_ingest']):>12}"
+              f"{_mb(c['chroma_serve']):>12}{_mb(c['keyword_index']):>10}{_mb(c['caches']):>7}"
+              f"{s['serve_rss_mb']:>10.0f}{max(s['ingest_peak_rss_mb'], s['serve_peak_rss_mb']):>10.0f}"
+              f"{s['disk_mb']:>9.0f}{per_chunk:>8.1f}{vector_text:>16}{keyword_text:>16}")
+    print("-" * 108)
+    print("KB/块 = (Chroma检索时的RSS增量 + 磁盘占用) / 块数，用来估算更大规模需要的节点规格")
+
+    recalls = [(s['n_chunks'], s.get('quality', {})) for s in report['scales'] if s.get('quality')]
+    if recalls:
+        print("\n🎯 合成问题的召回率:")
+        for n, quality in recalls:
+            print(f"   {n:>10,}  " + "  ".join(f"{name}={value:.2f}" for name, value in quality.items()))
+
+    largest = report['scales'][-1] if report['scales'] else None
+    if largest and any('top' in c for c in largest['components'].values()):
+        print(f"\n🔬 tracemalloc 分配点（{largest['n_chunks']:,} 块）:")
+        for name, component in largest['components'].items():
+            for item in component.get('top', [])[:3]:
+                print(f"   {name:<16} {item['size_mb']:>8.1f}MB  {item['where']}")
+
+    if regressions is not None:
+        if regressions:
+            print(f"\n❌ 发现 {len(regressions)} 项内存/延迟回归:")
+            for r in regressions:
+                print(f"   {r['scale']:>10,} {r['metric']:<24} {r['baseline']:.1f} → {r['current']:.1f} "
+                      f"({r['change']:+.0%})")
+        else:
+            print("\n✅ 与基线相比没有回归")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量库分组件内存剖析")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="测试的块数")
+    parser.add_argument("--embed", choices=["random", "model"], default="random", help="向量来源")
+    parser.add_argument("--batch-size", type=int, default=1000, help="导入批量大小")
+    parser.add_argument("--seed", type=int, default=42, help="合成语料和随机向量的种子")
+    parser.add_argument("--queries", type=int, default=50, help="检索延迟用多少个问题")
+    parser.add_argument("--k", type=int, default=10, help="每次检索返回的结果数")
+    parser.add_argument("--cache-size", type=int, default=256, help="查询向量缓存容量")
+    parser.add_argument("--keyword-limit", type=int, default=100_000,
+                        help="超过这个块数不测关键词检索（全量取回文档太慢）")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="不记录分配点（导入更快）")
+    parser.add_argument("--workdir", default="./data/memory_profile", help="临时向量库目录")
+    parser.add_argument("--keep", action="store_true", help="保留生成的向量库")
+    parser.add_argument("--in-process", action="store_true", help="不开子进程（RSS会受前一个规模影响）")
+    parser.add_argument("--output", default="memory_profile.json", help="报告输出路径")
+    parser.add_argument("--baseline", help="与这个基线报告比较")
+    parser.add_argument("--save-baseline", help="把本次结果另存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的增长比例")
+    # 子进程内部使用
+    parser.add_argument("--worker", choices=["ingest", "serve"], help=argparse.SUPPRESS)
+    parser.add_argument("--store", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = _run_phase(args.worker, args.scales[0], Path(args.store), args)
+        with open(args.worker_output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        return
+
+    print("=" * 60)
+    print("🧠 向量库内存剖析")
+    print("=" * 60)
+    workdir = Path(args.workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+
+    report = {
+        'meta': {'embed': args.embed, 'model': MODEL_NAME, 'seed': args.seed, 'k': args.k,
+                 'python': sys.version.split()[0], 'cpu_count': os.cpu_count(),
+                 'total_memory_mb': psutil.virtual_memory().total / 1024 / 1024},
+        'scales': [profile_scale(n, workdir, args) for n in sorted(args.scales)]
+    }
+
+    regressions = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        report['regressions'] = regressions
+
+    print_report(report, regressions)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 报告已保存: {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 基线已保存: {args.save_baseline}")
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,8 +7,13 @@ Step 5.1.1: 手动对比RAG效果
 
 import chromadb
 from sentence_transformers import SentenceTransformer
-from llama_cpp import Llama
 import os
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
 
 print("=" * 60)
 print("🔬 手动对比：直接问LLM vs 使用RAG")
@@ -47,10 +52,9 @@ if not os.path.exists(llm_path):
     print(f"   请检查路径: {llm_path}")
     exit(1)
 
-llm = Llama(
+llm = connect_or_load(
     model_path=llm_path,
     n_ctx=2048,
-    n_threads=4,
     n_gpu_layers=0,
     verbose=False
 )
@@ -7,8 +7,13 @@ Step 5.2: 优化检索效果
 
 import chromadb
 from sentence_transformers import SentenceTransformer
-from llama_cpp import Llama
 import os
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
 
 print("=" * 60)
 print("🔍 优化RAG检索效果")
@@ -29,10 +34,9 @@ collection = client.get_collection(name="traffic_law")
 embedding_model = SentenceTransformer('shibing624/text2vec-base-chinese')
 
 # LLM
-llm = Llama(
+llm = connect_or_load(
     model_path="/Users/a58/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf",
     n_ctx=2048,
-    n_threads=4,
     n_gpu_layers=0,
     verbose=False
 )
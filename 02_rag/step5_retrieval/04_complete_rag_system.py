@@ -7,9 +7,14 @@ Step 5.4: 完整的RAG系统
 
 import chromadb
 from sentence_transformers import SentenceTransformer
-from llama_cpp import Llama
 import os
 import time
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
 
 print("=" * 60)
 print("🏗️  完整RAG系统")
@@ -61,10 +66,9 @@ class TrafficLawRAG:
         
         # 加载LLM
         print("   [3/3] 加载LLM...")
-        self.llm = Llama(
+        self.llm = connect_or_load(
             model_path=llm_path,
             n_ctx=2048,
-            n_threads=4,
             n_gpu_layers=0,
             verbose=False
         )
@@ -7,10 +7,29 @@ Step 5.5: 交互式问答系统
 
 import chromadb
 from sentence_transformers import SentenceTransformer
-from llama_cpp import Llama
 import os
 import time
 from datetime import datetime
+import sys
+from pathlib import Path
+
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
+from prefix_cache import PrefixCache
+from history_manager import SummarizingHistory
+from history_store import HistoryStore
+
+# 静态说明放在提示词最前面，可以被前缀KV缓存复用
+PROMPT_PREFIX = """你是一个专业的交通法规助手，专门解答中国道路交通安全法相关问题。
+
+【回答规则】
+1. 严格依据参考资料回答，不编造信息
+2. 尽量根据参考资料回答，可以适当推理
+3. 回答要准确、简洁、分点列出
+4. 保持客观中立的语气
+
+"""
 
 # ============================================================
 # 导入RAG系统类
@@ -19,18 +38,32 @@ from datetime import datetime
 class TrafficLawRAG:
     """交通法RAG问答系统（从04脚本复制）"""
     
-    def __init__(self, db_path, embedding_model_name, llm_path, collection_name="traffic_law"):
+    def __init__(self, db_path, embedding_model_name, llm_path, collection_name="traffic_law", llm=None,
+                 history_path="qa_history.jsonl", greedy_with_draft=True):
         self.client = chromadb.PersistentClient(path=db_path)
         self.collection = self.client.get_collection(name=collection_name)
         self.embedding_model = SentenceTransformer(embedding_model_name)
-        self.llm = Llama(
+        self.llm = llm or connect_or_load(
             model_path=llm_path,
             n_ctx=2048,
-            n_threads=4,
             n_gpu_layers=0,
             verbose=False
         )
-        self.history = []  # 对话历史
+        # 投机解码（草稿模型）只在贪心解码时生效：检测到时温度改为0
+        self.temperature = 0.2
+        if greedy_with_draft and getattr(self.llm, 'speculative', False):
+            self.temperature = 0.0
+            print("   ✏️  检测到投机解码（草稿模型），生成温度设为0")
+        # 对话历史：追加写入JSONL，内存里只保留最近100条
+        self.history = HistoryStore(history_path, memory_size=100)
+        # 提示词中的对话背景：超过384 tokens后，后台在空闲时把旧轮次压缩成摘要
+        self.conversation = SummarizingHistory(self.llm, token_budget=384)
+        
+        # 前缀KV缓存：每次请求只预填充参考资料和问题
+        self.prefix_cache = None
+        if hasattr(self.llm, 'save_state'):
+            self.prefix_cache = PrefixCache(self.llm)
+            self.prefix_cache.register(PROMPT_PREFIX)
     
     def retrieve(self, question, top_k=10, threshold=0.5, max_results=3):
         question_vector = self.embedding_model.encode([question], show_progress_bar=False)
@@ -54,29 +87,32 @@ class TrafficLawRAG:
         return retrieved_docs[:max_results]
     
     def generate(self, question, context, stream=True):
-        prompt = f"""你是一个专业的交通法规助手，专门解答中国道路交通安全法相关问题。
+        with self.conversation.foreground():
+            return self._generate(question, context, stream)
 
-【参考资料】
+    def _generate(self, question, context, stream):
+        background = self.conversation.render()
+        # 对话背景放在固定前缀之后，不影响前缀KV缓存
+        prompt = PROMPT_PREFIX + (f"""【对话背景】
+{background}
+""" if background else "") + f"""【参考资料】
 {context if context else "（无相关文档）"}
 
-【回答规则】
-1. 严格依据参考资料回答，不编造信息
-2. 尽量根据参考资料回答，可以适当推理
-3. 回答要准确、简洁、分点列出
-4. 保持客观中立的语气
-
 【用户问题】
 {question}
 
 【你的回答】
 """
         
+        if self.prefix_cache is not None:
+            self.prefix_cache.prepare(prompt)
+        
         if stream:
             # 流式输出
             output = self.llm(
                 prompt,
                 max_tokens=300,
-                temperature=0.2,
+                temperature=self.temperature,
                 stop=["【", "\n\n\n"],
                 echo=False,
                 stream=True
@@ -94,7 +130,7 @@ class TrafficLawRAG:
             output = self.llm(
                 prompt,
                 max_tokens=300,
-                temperature=0.2,
+                temperature=self.temperature,
                 stop=["【", "\n\n\n"],
                 echo=False,
                 stream=False
@@ -131,6 +167,7 @@ class TrafficLawRAG:
         print("=" * 60)
         answer, prompt = self.generate(question, context, stream=True)
         print("=" * 60)
+        self.conversation.add(question, answer)
         
         total_time = time.time() - start_time
         
@@ -173,7 +210,8 @@ def print_help():
     print("=" * 60)
     print("\n可用命令:")
     print("   • help      - 显示此帮助")
-    print("   • history   - 查看对话历史")
+    print("   • history   - 查看最近的对话历史")
+    print("   • search 词 - 在对话历史中查找")
     print("   • clear     - 清空屏幕")
     print("   • sources   - 显示/隐藏参考来源")
     print("   • exit/quit - 退出系统")
@@ -185,17 +223,19 @@ def print_help():
     print("\n" + "=" * 60 + "\n")
 
 
-def print_history(rag_system):
-    """打印对话历史"""
-    if not rag_system.history:
+def print_history(rag_system, last=10):
+    """打印最近的对话历史"""
+    history = rag_system.history
+    if not history:
         print("\n📋 还没有对话历史\n")
         return
     
     print("\n" + "=" * 60)
-    print(f"📋 对话历史 (共{len(rag_system.history)}条)")
+    print(f"📋 对话历史 (共{len(history)}条，显示最近{min(last, len(history))}条)")
     print("=" * 60)
     
-    for i, item in enumerate(rag_system.history, 1):
+    start = len(history) - min(last, len(history))
+    for i, item in enumerate(history.tail(last), start + 1):
         print(f"\n[{i}] {item['timestamp']}")
         print(f"   Q: {item['question']}")
         print(f"   A: {item['answer'][:60]}...")
@@ -204,27 +244,30 @@ def print_history(rag_system):
     print("\n" + "=" * 60 + "\n")
 
 
+def search_history(rag_system, keyword, limit=10):
+    """在对话历史中查找（从新到旧）"""
+    results = rag_system.history.search(keyword, limit=limit)
+    if not results:
+        print(f"\n📋 没有包含「{keyword}」的历史\n")
+        return
+    
+    print(f"\n🔍 包含「{keyword}」的历史 ({len(results)}条):")
+    for i, item in results:
+        print(f"\n[{i + 1}] {item['timestamp']}")
+        print(f"   Q: {item['question']}")
+        print(f"   A: {item['answer'][:60]}...")
+    print()
+
+
 def save_history(rag_system, filename="qa_history.txt"):
-    """保存对话历史到文件"""
+    """导出对话历史为可读文本（历史本身已经实时写入JSONL）"""
     if not rag_system.history:
         print("\n⚠️  没有对话历史可以保存\n")
         return
     
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write("=" * 60 + "\n")
-            f.write("交通法RAG问答系统 - 对话历史\n")
-            f.write("=" * 60 + "\n\n")
-            
-            for i, item in enumerate(rag_system.history, 1):
-                f.write(f"[{i}] {item['timestamp']}\n")
-                f.write(f"问题: {item['question']}\n")
-                f.write(f"答案: {item['answer']}\n")
-                f.write(f"来源: {item['num_sources']}个文档\n")
-                f.write(f"耗时: {item['time']:.2f}秒\n")
-                f.write("\n" + "-" * 60 + "\n\n")
-        
-        print(f"\n✅ 对话历史已保存到: {filename}\n")
+        rag_system.history.export_text(filename, title="交通法RAG问答系统 - 对话历史")
+        print(f"\n✅ 对话历史已导出到: {filename}\n")
     except Exception as e:
         print(f"\n❌ 保存失败: {e}\n")
 
@@ -271,9 +314,10 @@ def main():
             if user_input.lower() in ['exit', 'quit', 'bye']:
                 print("\n👋 感谢使用！再见！\n")
                 
-                # 询问是否保存历史
+                # 历史已经实时追加到JSONL，这里只询问是否导出文本版
                 if rag_system.history:
-                    save_choice = input("是否保存对话历史？(y/n): ").strip().lower()
+                    print(f"📋 对话历史已记录在: {rag_system.history.path}")
+                    save_choice = input("是否导出为文本？(y/n): ").strip().lower()
                     if save_choice == 'y':
                         save_history(rag_system)
                 
@@ -287,6 +331,10 @@ def main():
                 print_history(rag_system)
                 continue
             
+            elif user_input.lower().startswith('search '):
+                search_history(rag_system, user_input[7:].strip())
+                continue
+            
             elif user_input.lower() == 'clear':
                 os.system('clear' if os.name == 'posix' else 'cls')
                 print_banner()
@@ -308,6 +356,10 @@ def main():
         except Exception as e:
             print(f"\n❌ 错误: {e}\n")
             continue
+    
+    # 把还没落盘的历史写到磁盘
+    rag_system.history.close()
+    rag_system.conversation.close()
 
 
 # ============================================================
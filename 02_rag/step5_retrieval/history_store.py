@@ -0,0 +1,239 @@
+"""
+只追加的问答历史存储
+
+05_interactive_qa.py 原来把历史放在内存列表里，保存时整个文件重写一遍：
+会话越长，内存和每次保存的开销越大。HistoryStore：
+- 每条问答追加一行 JSONL，定期 fsync（每 fsync_every 条或每 fsync_interval 秒）
+- 内存里只保留最近 memory_size 条（环形缓冲）
+- 旁边的 .idx 文件记录每一行的起始偏移（8字节/条），
+  按序号读取、取最后N条都只需一次 seek，不用扫描整个文件
+
+    store = HistoryStore("qa_history.jsonl")
+    store.append({'question': ..., 'answer': ...})
+    store.tail(10)               # 最近10条
+    store.search("酒驾")         # 从新到旧查找
+"""
+
+import os
+import json
+import time
+import struct
+from collections import deque
+from pathlib import Path
+
+_OFFSET = struct.Struct("<Q")
+
+
+class HistoryStore:
+    """JSONL 追加写 + 偏移索引 + 内存环形缓冲"""
+
+    def __init__(self,
+                 path="qa_history.jsonl",
+                 memory_size: int = 100,
+                 fsync_every: int = 10,
+                 fsync_interval: float = 5.0):
+        """
+        Args:
+            path: JSONL 文件路径（索引文件为 path + ".idx"）
+            memory_size: 内存中保留的最近记录数
+            fsync_every: 每追加多少条强制落盘一次
+            fsync_interval: 距上次落盘超过多少秒时强制落盘
+        """
+        self.path = Path(path)
+        self.index_path = Path(str(self.path) + ".idx")
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.recent = deque(maxlen=memory_size)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._recover()
+        self._data = open(self.path, "ab")
+        self._index = open(self.index_path, "ab")
+        self._reader = open(self.path, "rb")
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+        # 预热环形缓冲
+        for record in self.range(max(0, self.count - memory_size), self.count):
+            self.recent.append(record)
+
+    # ---------------- 打开时的恢复 ----------------
+
+    def _recover(self):
+        """截掉崩溃时写了一半的行；索引与数据不一致时重建索引"""
+        data_size = self.path.stat().st_size if self.path.exists() else 0
+        if data_size:
+            with open(self.path, "rb+") as f:
+                f.seek(max(0, data_size - 1))
+                if f.read(1) != b"\n":
+                    # 找最后一个完整行
+                    pos = data_size
+                    while pos > 0:
+                        step = min(65536, pos)
+                        f.seek(pos - step)
+                        block = f.read(step)
+                        nl = block.rfind(b"\n")
+                        if nl >= 0:
+                            pos = pos - step + nl + 1
+                            break
+                        pos -= step
+                    f.truncate(pos)
+                    data_size = pos
+
+        index_size = self.index_path.stat().st_size if self.index_path.exists() else 0
+        count = index_size // _OFFSET.size
+        consistent = index_size % _OFFSET.size == 0
+        if consistent and count:
+            # 最后一条的偏移必须落在数据文件内，且它之后正好一行
+            with open(self.index_path, "rb") as f:
+                f.seek((count - 1) * _OFFSET.size)
+                last = _OFFSET.unpack(f.read(_OFFSET.size))[0]
+            with open(self.path, "rb") as f:
+                f.seek(last)
+                line = f.readline()
+                consistent = last < data_size and last + len(line) == data_size
+        elif consistent:
+            consistent = data_size == 0
+
+        if not consistent:
+            count = self._rebuild_index()
+        self.count = count
+
+    def _rebuild_index(self) -> int:
+        count = 0
+        with open(self.path, "rb") as data, open(self.index_path, "wb") as index:
+            offset = 0
+            for line in data:
+                index.write(_OFFSET.pack(offset))
+                offset += len(line)
+                count += 1
+        return count
+
+    # ---------------- 写入 ----------------
+
+    def append(self, record: dict):
+        """追加一条记录（O(1)，不重写已有内容）"""
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        offset = self._data.tell()
+        self._data.write(line)
+        self._index.write(_OFFSET.pack(offset))
+        # 先写数据再写索引，崩溃时最多丢掉最后一条
+        self._data.flush()
+        self._index.flush()
+        self.count += 1
+        self.recent.append(record)
+
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.time() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """把缓冲区强制写到磁盘"""
+        if self._unsynced == 0:
+            return
+        self._data.flush()
+        self._index.flush()
+        os.fsync(self._data.fileno())
+        os.fsync(self._index.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        self.sync()
+        self._data.close()
+        self._index.close()
+        self._reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---------------- 读取 ----------------
+
+    def __len__(self):
+        return self.count
+
+    def _offsets(self, start: int, stop: int):
+        with open(self.index_path, "rb") as f:
+            f.seek(start * _OFFSET.size)
+            raw = f.read((stop - start) * _OFFSET.size)
+        return [o for (o,) in _OFFSET.iter_unpack(raw)]
+
+    def get(self, i: int) -> dict:
+        """按序号读取一条记录（支持负数）"""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        first_cached = self.count - len(self.recent)
+        if i >= first_cached:
+            return self.recent[i - first_cached]
+        return next(self.range(i, i + 1))
+
+    def range(self, start: int, stop: int):
+        """按顺序读取 [start, stop) 的记录"""
+        stop = min(stop, self.count)
+        if start >= stop:
+            return
+        self._data.flush()
+        for offset in self._offsets(start, stop):
+            # 每条都重新定位，多个迭代器交替读取也不会错位
+            self._reader.seek(offset)
+            yield json.loads(self._reader.readline())
+
+    def tail(self, n: int = 10):
+        """最近 n 条（旧 → 新）；在环形缓冲内时不读磁盘"""
+        n = min(n, self.count)
+        if n <= len(self.recent):
+            return list(self.recent)[len(self.recent) - n:]
+        return list(self.range(self.count - n, self.count))
+
+    def __iter__(self):
+        return self.range(0, self.count)
+
+    def search(self, keyword: str, limit: int = 20, fields=("question", "answer"), block: int = 256):
+        """
+        从新到旧查找包含关键词的记录
+
+        按索引一次读一块（block 条），先在原始字节上过滤，命中的行才解析 JSON
+
+        Returns:
+            [(序号, 记录), ...]
+        """
+        needle = keyword.encode("utf-8")
+        results = []
+        self._data.flush()
+        stop = self.count
+        while stop > 0 and len(results) < limit:
+            start = max(0, stop - block)
+            offsets = self._offsets(start, stop)
+            self._reader.seek(offsets[0])
+            lines = [self._reader.readline() for _ in offsets]
+            for i in range(len(lines) - 1, -1, -1):
+                if needle not in lines[i]:
+                    continue
+                record = json.loads(lines[i])
+                if any(keyword in str(record.get(field, "")) for field in fields):
+                    results.append((start + i, record))
+                    if len(results) >= limit:
+                        break
+            stop = start
+        return results
+
+    def export_text(self, filename, title: str = "对话历史"):
+        """导出为可读文本（逐条流式写出，不占用额外内存）"""
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write("=" * 60 + "\n")
+            f.write(title + "\n")
+            f.write("=" * 60 + "\n\n")
+            for i, item in enumerate(self, 1):
+                f.write(f"[{i}] {item.get('timestamp', '')}\n")
+                f.write(f"问题: {item.get('question', '')}\n")
+                f.write(f"答案: {item.get('answer', '')}\n")
+                if 'num_sources' in item:
+                    f.write(f"来源: {item['num_sources']}个文档\n")
+                if 'time' in item:
+                    f.write(f"耗时: {item['time']:.2f}秒\n")
+                f.write("\n" + "-" * 60 + "\n\n")
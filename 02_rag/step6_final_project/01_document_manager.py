@@ -7,17 +7,145 @@ RAG最终项目 - 文档管理系统
 2. 元数据管理（文档名、类型、日期等）
 3. 文档更新和删除
 4. 向量库维护
+5. 写后缓冲（大量小文档合并成大批量向量化和写入）
 
 这是生产级RAG系统的基础组件
 """
 
 import os
+import sys
 import json
+import time
+import sqlite3
+import threading
 import chromadb
+from pathlib import Path
+from concurrent.futures import Future
 from datetime import datetime
 from sentence_transformers import SentenceTransformer
 from typing import List, Dict, Any
 
+# 链路追踪（01_inference/tracing.py，默认关闭，RAG_TRACE=1 打开）
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+import tracing
+
+
+class DocumentRegistry:
+    """
+    文档注册表：记录 文档 → 块id、块数、导入时间
+
+    存在向量库目录下的一个小SQLite文件里。列出文档、统计和删除
+    只查这张表，不再扫描整个集合
+    """
+    
+    def __init__(self, db_path: str):
+        """
+        Args:
+            db_path: 注册表SQLite文件路径
+        """
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    doc_name TEXT PRIMARY KEY,
+                    doc_type TEXT,
+                    import_time TEXT,
+                    chunks INTEGER NOT NULL
+                )
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chunks (
+                    chunk_id TEXT PRIMARY KEY,
+                    doc_name TEXT NOT NULL
+                )
+            """)
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_name)"
+            )
+    
+    def record(self, doc_name: str, doc_type: str, import_time: str, chunk_ids: List[str]):
+        """在一个事务里登记文档及其块（同名文档追加块数）"""
+        self.record_many([(doc_name, doc_type, import_time, chunk_ids)])
+    
+    def record_many(self, entries: List[tuple]):
+        """
+        在一个事务里登记一批文档（批量导入用：要么全部登记，要么一条都不登记）
+        
+        Args:
+            entries: (doc_name, doc_type, import_time, chunk_ids) 列表
+        """
+        with self.lock, self.conn:
+            for doc_name, doc_type, import_time, chunk_ids in entries:
+                self.conn.execute("""
+                    INSERT INTO documents (doc_name, doc_type, import_time, chunks)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(doc_name) DO UPDATE SET
+                        doc_type = excluded.doc_type,
+                        import_time = excluded.import_time,
+                        chunks = chunks + excluded.chunks
+                """, (doc_name, doc_type, import_time, len(chunk_ids)))
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO chunks (chunk_id, doc_name) VALUES (?, ?)",
+                    [(chunk_id, doc_name) for chunk_id in chunk_ids]
+                )
+    
+    def chunk_ids(self, doc_name: str) -> List[str]:
+        """某个文档的所有块id"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chunk_id FROM chunks WHERE doc_name = ?", (doc_name,)
+            ).fetchall()
+        return [row[0] for row in rows]
+    
+    def remove(self, doc_name: str):
+        """在一个事务里删除文档及其块记录"""
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE doc_name = ?", (doc_name,))
+            self.conn.execute("DELETE FROM documents WHERE doc_name = ?", (doc_name,))
+    
+    def list_documents(self) -> List[Dict[str, Any]]:
+        """所有文档的登记信息"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT doc_name, doc_type, import_time, chunks FROM documents ORDER BY import_time"
+            ).fetchall()
+        return [
+            {'doc_name': name, 'doc_type': doc_type, 'import_time': import_time, 'chunks': chunks}
+            for name, doc_type, import_time, chunks in rows
+        ]
+    
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+    
+    def rebuild(self, collections):
+        """
+        从向量库重建注册表（只在注册表为空、库里已有数据时执行一次）
+        
+        Args:
+            collections: 需要扫描的ChromaDB集合列表
+        """
+        docs = {}
+        for collection in collections:
+            results = collection.get(include=["metadatas"])
+            for chunk_id, metadata in zip(results['ids'], results['metadatas']):
+                metadata = metadata or {}
+                doc_name = metadata.get('doc_name', 'unknown')
+                doc = docs.setdefault(doc_name, {
+                    'doc_type': metadata.get('doc_type', 'unknown'),
+                    'import_time': metadata.get('import_time', 'unknown'),
+                    'chunk_ids': []
+                })
+                doc['chunk_ids'].append(chunk_id)
+        
+        for doc_name, doc in docs.items():
+            self.record(doc_name, doc['doc_type'], doc['import_time'], doc['chunk_ids'])
+    
+    def close(self):
+        self.conn.close()
+
 
 class DocumentManager:
     """文档管理器：管理多个文档的导入、存储和维护"""
@@ -48,8 +176,23 @@ class DocumentManager:
             metadata={"description": "多文档RAG系统"}
         )
         
+        # 文档注册表（旧库第一次使用时从集合重建）
+        self.registry = DocumentRegistry(os.path.join(chroma_path, "document_registry.sqlite3"))
+        if self.registry.is_empty() and self.collection.count() > 0:
+            print("   🔄 从向量库重建文档注册表...")
+            self.registry.rebuild([self.collection])
+        
         print(f"✅ 文档管理器初始化完成！当前文档数：{self.collection.count()}\n")
     
+    def _collection_for(self, doc_name: str):
+        """文档所在的集合（分片实现会覆盖）"""
+        return self.collection
+    
+    def count(self) -> int:
+        """文档块总数"""
+        return self.collection.count()
+    
+    @tracing.traced("docs.add_document")
     def add_document(self, 
                      content: str, 
                      doc_name: str,
@@ -75,20 +218,81 @@ class DocumentManager:
         print(f"   文档类型: {doc_type}")
         print(f"   文档长度: {len(content)} 字符")
         
-        # 1. 智能分块
-        chunks = self._smart_chunk(content, chunk_size, chunk_overlap)
+        # 1. 分块并准备id和元数据
+        prepared = self._prepare_document(
+            content, doc_name, doc_type, metadata, chunk_size, chunk_overlap
+        )
+        chunks = prepared['chunks']
+        timestamp = prepared['timestamp']
         print(f"   ✂️  分块完成: {len(chunks)} 个块")
         
         # 2. 生成向量（归一化）
         print("   🔄 生成向量...")
-        embeddings = self.embedding_model.encode(
-            chunks,
-            show_progress_bar=False,
-            convert_to_numpy=True,
-            normalize_embeddings=True
+        embeddings = self._encode(chunks)
+        
+        # 3. 添加到向量库
+        collection = self._collection_for(doc_name)
+        collection.add(
+            ids=prepared['ids'],
+            documents=chunks,
+            embeddings=embeddings.tolist(),
+            metadatas=prepared['metadatas']
         )
         
-        # 3. 准备元数据
+        # 4. 登记到文档注册表（失败则撤回向量库写入）
+        try:
+            self.registry.record(doc_name, doc_type, timestamp, prepared['ids'])
+        except Exception:
+            collection.delete(ids=prepared['ids'])
+            raise
+        
+        result = {
+            "doc_name": doc_name,
+            "chunks": len(chunks),
+            "timestamp": timestamp,
+            "total_docs": self.count()
+        }
+        
+        tracing.current_span().set(doc_type=doc_type, chars=len(content), chunks=len(chunks),
+                                   chunk_size=chunk_size)
+        print(f"   ✅ 文档已添加！总文档块数：{result['total_docs']}")
+        return result
+    
+    def write_behind(self, max_chunks: int = 512, max_delay: float = 2.0) -> "WriteBehindBuffer":
+        """
+        开启写后缓冲模式
+        
+        用法：
+            with manager.write_behind() as writer:
+                for doc in docs:
+                    writer.add_document(doc['content'], doc['name'])
+        
+        Args:
+            max_chunks: 缓冲块数达到该值时立即写入
+            max_delay: 最早的缓冲文档等待超过该秒数时写入
+            
+        Returns:
+            WriteBehindBuffer
+        """
+        return WriteBehindBuffer(self, max_chunks=max_chunks, max_delay=max_delay)
+    
+    def _prepare_document(self,
+                          content: str,
+                          doc_name: str,
+                          doc_type: str = "text",
+                          metadata: Dict[str, Any] = None,
+                          chunk_size: int = 200,
+                          chunk_overlap: int = 50) -> Dict[str, Any]:
+        """
+        分块并生成每个块的id和元数据（不做向量化）
+        
+        Returns:
+            包含 ids / chunks / metadatas / timestamp 的字典
+        """
+        # 1. 智能分块
+        chunks = self._smart_chunk(content, chunk_size, chunk_overlap)
+        
+        # 2. 准备元数据
         timestamp = datetime.now().isoformat()
         base_metadata = {
             "doc_name": doc_name,
@@ -102,7 +306,7 @@ class DocumentManager:
         if metadata:
             base_metadata.update(metadata)
         
-        # 4. 为每个块准备数据
+        # 3. 为每个块准备数据
         ids = []
         metadatas = []
         for i in range(len(chunks)):
@@ -116,23 +320,22 @@ class DocumentManager:
             })
             metadatas.append(chunk_metadata)
         
-        # 5. 添加到向量库
-        self.collection.add(
-            ids=ids,
-            documents=chunks,
-            embeddings=embeddings.tolist(),
-            metadatas=metadatas
-        )
-        
-        result = {
-            "doc_name": doc_name,
-            "chunks": len(chunks),
-            "timestamp": timestamp,
-            "total_docs": self.collection.count()
+        return {
+            "ids": ids,
+            "chunks": chunks,
+            "metadatas": metadatas,
+            "timestamp": timestamp
         }
-        
-        print(f"   ✅ 文档已添加！总文档块数：{result['total_docs']}")
-        return result
+    
+    def _encode(self, chunks: List[str]):
+        """批量生成归一化向量"""
+        with tracing.span("docs.encode", chunks=len(chunks)):
+            return self.embedding_model.encode(
+                chunks,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
     
     def _smart_chunk(self, text: str, chunk_size: int, overlap: int) -> List[str]:
         """
@@ -196,26 +399,8 @@ class DocumentManager:
         Returns:
             文档列表（去重后的文档元数据）
         """
-        # 获取所有数据
-        results = self.collection.get()
-        
-        if not results['metadatas']:
-            return []
-        
-        # 按文档名分组
-        docs_dict = {}
-        for metadata in results['metadatas']:
-            doc_name = metadata.get('doc_name', 'unknown')
-            if doc_name not in docs_dict:
-                docs_dict[doc_name] = {
-                    'doc_name': doc_name,
-                    'doc_type': metadata.get('doc_type', 'unknown'),
-                    'import_time': metadata.get('import_time', 'unknown'),
-                    'chunks': 0
-                }
-            docs_dict[doc_name]['chunks'] += 1
-        
-        return list(docs_dict.values())
+        # 直接读注册表，不扫描集合
+        return self.registry.list_documents()
     
     def delete_document(self, doc_name: str) -> Dict[str, Any]:
         """
@@ -229,26 +414,41 @@ class DocumentManager:
         """
         print(f"\n🗑️  删除文档: {doc_name}")
         
-        # 查询该文档的所有块
-        results = self.collection.get(
-            where={"doc_name": doc_name}
-        )
+        # 从注册表取该文档的所有块id
+        chunk_ids = self.registry.chunk_ids(doc_name)
         
-        if not results['ids']:
+        if not chunk_ids:
             print(f"   ⚠️  文档不存在: {doc_name}")
             return {"success": False, "message": "文档不存在"}
         
-        # 删除所有块
-        self.collection.delete(ids=results['ids'])
+        # 删除所有块，再删除登记
+        self._collection_for(doc_name).delete(ids=chunk_ids)
+        self.registry.remove(doc_name)
         
-        print(f"   ✅ 已删除 {len(results['ids'])} 个文档块")
+        print(f"   ✅ 已删除 {len(chunk_ids)} 个文档块")
         return {
             "success": True,
             "doc_name": doc_name,
-            "deleted_chunks": len(results['ids']),
-            "remaining_total": self.collection.count()
+            "deleted_chunks": len(chunk_ids),
+            "remaining_total": self.count()
         }
     
+    def update_document(self, content: str, doc_name: str, **kwargs) -> Dict[str, Any]:
+        """
+        更新文档：删除旧版本的所有块，再导入新内容
+        
+        Args:
+            content: 新的文档内容
+            doc_name: 文档名称
+            **kwargs: 传给 add_document 的其他参数
+            
+        Returns:
+            添加结果统计
+        """
+        if self.registry.chunk_ids(doc_name):
+            self.delete_document(doc_name)
+        return self.add_document(content, doc_name, **kwargs)
+    
     def search_documents(self, 
                         query: str, 
                         n_results: int = 5,
@@ -302,12 +502,192 @@ class DocumentManager:
         docs = self.list_documents()
         
         return {
-            "total_chunks": self.collection.count(),
+            "total_chunks": self.count(),
             "total_documents": len(docs),
             "documents": docs
         }
 
 
+class WriteBehindBuffer:
+    """
+    写后缓冲：把许多小的 add_document 调用合并成大批量
+    
+    每个小文档单独 encode + collection.add 时批量很小，正好落在
+    04_performance.py 批量曲线最慢的一端。这里先只做分块，把块排队，
+    达到块数阈值或时间阈值时一次性向量化并写入。
+    
+    add_document 返回 Future，所在批次写入向量库和注册表之后才完成，
+    完成即表示数据已落盘（持久化确认）
+    """
+    
+    def __init__(self, manager: DocumentManager, max_chunks: int = 512, max_delay: float = 2.0):
+        """
+        Args:
+            manager: 文档管理器（也可以是分片管理器）
+            max_chunks: 块数阈值
+            max_delay: 时间阈值（秒）
+        """
+        self.manager = manager
+        self.max_chunks = max_chunks
+        self.max_delay = max_delay
+        
+        self.pending = []  # [(prepared, doc_name, doc_type, future)]
+        self.pending_chunks = 0
+        self.oldest = None  # 最早缓冲文档的入队时间
+        self.closed = False
+        
+        self.lock = threading.Lock()        # 保护缓冲区
+        self.flush_lock = threading.Lock()  # 保证同一时间只有一个批次在写
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def add_document(self,
+                     content: str,
+                     doc_name: str,
+                     doc_type: str = "text",
+                     metadata: Dict[str, Any] = None,
+                     chunk_size: int = 200,
+                     chunk_overlap: int = 50) -> Future:
+        """
+        缓冲一个文档（参数与 DocumentManager.add_document 一致）
+        
+        Returns:
+            Future，写入完成后结果为 {doc_name, chunks, timestamp}
+        """
+        prepared = self.manager._prepare_document(
+            content, doc_name, doc_type, metadata, chunk_size, chunk_overlap
+        )
+        future = Future()
+        
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("WriteBehindBuffer 已关闭")
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending.append((prepared, doc_name, doc_type, future))
+            self.pending_chunks += len(prepared['chunks'])
+            full = self.pending_chunks >= self.max_chunks
+        
+        if full:
+            self.flush()
+        else:
+            self.wakeup.set()
+        return future
+    
+    @tracing.traced("docs.flush")
+    def flush(self) -> int:
+        """
+        立即写入所有缓冲的文档
+        
+        Returns:
+            本次写入的块数
+        """
+        with self.flush_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = []
+                self.pending_chunks = 0
+                self.oldest = None
+            
+            if not batch:
+                return 0
+            
+            groups = {}
+            try:
+                # 1. 所有块一次性向量化
+                all_chunks = [chunk for prepared, _, _, _ in batch for chunk in prepared['chunks']]
+                embeddings = self.manager._encode(all_chunks).tolist() if all_chunks else []
+                
+                # 2. 按目标集合分组后批量写入（分片管理器会路由到不同分片）
+                offset = 0
+                for prepared, doc_name, _, _ in batch:
+                    n = len(prepared['chunks'])
+                    collection = self.manager._collection_for(doc_name)
+                    group = groups.setdefault(id(collection), (collection, {
+                        "ids": [], "documents": [], "embeddings": [], "metadatas": []
+                    }))[1]
+                    group["ids"].extend(prepared['ids'])
+                    group["documents"].extend(prepared['chunks'])
+                    group["embeddings"].extend(embeddings[offset:offset + n])
+                    group["metadatas"].extend(prepared['metadatas'])
+                    offset += n
+                
+                for collection, group in groups.values():
+                    if group["ids"]:
+                        collection.add(**group)
+                
+                # 3. 登记到文档注册表（整批一个事务，失败时不留任何一行）
+                self.manager.registry.record_many([
+                    (doc_name, doc_type, prepared['timestamp'], prepared['ids'])
+                    for prepared, doc_name, doc_type, _ in batch
+                ])
+            except Exception as e:
+                # 和 add_document 一样撤回向量库写入（失败的那一组也删一次，可能写了一部分），
+                # 调用方拿到异常时这批文档确实没有存进去
+                for collection, group in groups.values():
+                    if group["ids"]:
+                        try:
+                            collection.delete(ids=group["ids"])
+                        except Exception as delete_error:
+                            print(f"   ⚠️  撤回失败: {delete_error}")
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                raise
+            
+            # 4. 持久化确认
+            for prepared, doc_name, _, future in batch:
+                future.set_result({
+                    "doc_name": doc_name,
+                    "chunks": len(prepared['chunks']),
+                    "timestamp": prepared['timestamp']
+                })
+            
+            tracing.current_span().set(documents=len(batch), chunks=len(all_chunks))
+            return len(all_chunks)
+    
+    def _run(self):
+        """后台线程：最早的缓冲文档超过 max_delay 时写入"""
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                if self.oldest is None:
+                    timeout = None
+                else:
+                    timeout = self.oldest + self.max_delay - time.monotonic()
+            
+            if timeout is None:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            
+            if timeout > 0:
+                self.wakeup.wait(timeout)
+                self.wakeup.clear()
+                continue
+            
+            try:
+                self.flush()
+            except Exception:
+                pass  # 异常已经通过 Future 交给调用方
+    
+    def close(self):
+        """停止后台线程并写入剩余的缓冲"""
+        with self.lock:
+            self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
 def demo():
     """演示文档管理系统的功能"""
     print("=" * 60)
@@ -12,19 +12,49 @@ RAG最终项目 - 高级检索策略
 """
 
 import os
+import sys
 import time
+import threading
+import contextvars
 import chromadb
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
 from sentence_transformers import SentenceTransformer
 from typing import List, Dict, Any, Tuple
 
+# 链路追踪（01_inference/tracing.py，默认关闭，RAG_TRACE=1 打开）
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+import tracing
+
+# 当前这次检索的各阶段耗时；每次 collect_timings() 一个新字典，
+# 检索器被多个线程/会话共享时互不干扰
+_stage_timings = contextvars.ContextVar("retrieval_stage_timings", default=None)
+
 
 class AdvancedRetriever:
     """高级检索器：实现多种检索策略"""
     
     def __init__(self, 
                  chroma_path: str = "./data/document_store",
-                 collection_name: str = "documents"):
-        """初始化检索器"""
+                 collection_name: str = "documents",
+                 lazy_hydration: bool = True):
+        """
+        初始化检索器
+        
+        Args:
+            chroma_path: ChromaDB存储路径
+            collection_name: 集合名称
+            lazy_hydration: 两阶段检索。候选生成和打分只用id和分数，
+                            最终top-k才批量取回文本和元数据
+        """
+        self.lazy_hydration = lazy_hydration
+        
+        # 最近查询的向量（答案缓存和检索共用，同一问题只编码一次）
+        self._query_embeddings = OrderedDict()
+        self._query_embedding_capacity = 256
+        self._query_embeddings_lock = threading.Lock()
+        
         print("📦 加载向量模型...")
         self.embedding_model = SentenceTransformer('shibing624/text2vec-base-chinese')
         # 设置归一化：输出的向量自动L2归一化到单位长度
@@ -40,15 +70,72 @@ class AdvancedRetriever:
             print(f"❌ 文档库不存在，请先运行 01_document_manager.py")
             raise
     
+    @staticmethod
+    @contextmanager
+    def collect_timings():
+        """
+        收集 with 块内检索各阶段的耗时（秒）：embed / ann / keyword / fusion / hydrate / rerank
+        
+            with retriever.collect_timings() as timings:
+                results = retriever.hybrid_search(query)
+            timings  →  {'embed': 0.012, 'ann': 0.004, ...}
+        """
+        timings = {}
+        token = _stage_timings.set(timings)
+        try:
+            yield timings
+        finally:
+            _stage_timings.reset(token)
+    
+    @staticmethod
+    def _record(stage: str, elapsed: float):
+        """累加阶段耗时（一次检索里同一阶段可能执行多次；不在 collect_timings 里时忽略）"""
+        timings = _stage_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+    
+    def embed_query(self, query: str):
+        """
+        查询向量化（已归一化，带最近使用缓存）
+        
+        Args:
+            query: 查询文本
+            
+        Returns:
+            numpy 向量
+        """
+        # 多个会话的检索和答案缓存查询会在线程池里并发调用这里
+        with self._query_embeddings_lock:
+            embedding = self._query_embeddings.get(query)
+            if embedding is not None:
+                self._query_embeddings.move_to_end(query)
+                return embedding
+        
+        # 编码不持锁（同一问题并发未命中时各算一次，结果相同）
+        embedding = self.embedding_model.encode(
+            query,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+        with self._query_embeddings_lock:
+            self._query_embeddings[query] = embedding
+            self._query_embeddings.move_to_end(query)
+            if len(self._query_embeddings) > self._query_embedding_capacity:
+                self._query_embeddings.popitem(last=False)
+        return embedding
+    
+    @tracing.traced("retriever.vector_search")
     def vector_search(self, 
                      query: str, 
-                     n_results: int = 10) -> List[Dict[str, Any]]:
+                     n_results: int = 10,
+                     hydrate: bool = True) -> List[Dict[str, Any]]:
         """
         纯向量检索（基础方法）
         
         Args:
             query: 查询文本
             n_results: 返回结果数
+            hydrate: 是否取回文本和元数据（False时只返回id和分数）
             
         Returns:
             检索结果列表
@@ -56,17 +143,18 @@ class AdvancedRetriever:
         start_time = time.time()
         
         # 生成查询向量（已归一化）
-        query_embedding = self.embedding_model.encode(
-            query,
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
+        query_embedding = self.embed_query(query)
+        embed_done = time.time()
+        self._record('embed', embed_done - start_time)
         
-        # 向量检索
+        # 向量检索（只要候选时不拉取文本和元数据）
+        include = ["documents", "metadatas", "distances"] if hydrate else ["distances"]
         results = self.collection.query(
             query_embeddings=[query_embedding.tolist()],
-            n_results=n_results
+            n_results=n_results,
+            include=include
         )
+        self._record('ann', time.time() - embed_done)
         
         # 格式化结果
         formatted_results = []
@@ -86,35 +174,41 @@ class AdvancedRetriever:
             # 相似度 = (2 - distance) / 2 = 1 - distance/2
             similarity = max(0, min(1, 1 - distance / 2))
             
-            formatted_results.append({
+            result = {
                 'id': results['ids'][0][i],
-                'document': results['documents'][0][i],
                 'distance': distance,
                 'similarity': similarity,
-                'metadata': results['metadatas'][0][i],
                 'method': 'vector_only'
-            })
+            }
+            if hydrate:
+                result['document'] = results['documents'][0][i]
+                result['metadata'] = results['metadatas'][0][i]
+            formatted_results.append(result)
         
-        elapsed = time.time() - start_time
-        return formatted_results, elapsed
+        tracing.current_span().set(k=n_results, hydrate=hydrate, candidates=len(formatted_results))
+        return formatted_results
     
+    @tracing.traced("retriever.keyword_search")
     def keyword_search(self, 
                        query: str, 
-                       n_results: int = 10) -> List[Dict[str, Any]]:
+                       n_results: int = 10,
+                       hydrate: bool = True) -> List[Dict[str, Any]]:
         """
         关键词检索（基于文本匹配）
         
         Args:
             query: 查询文本
             n_results: 返回结果数
+            hydrate: 是否取回元数据（打分本身需要文本，所以文本总会带上）
             
         Returns:
             检索结果列表
         """
         start_time = time.time()
         
-        # 获取所有文档
-        all_docs = self.collection.get()
+        # 获取所有文档（只要候选时不拉取元数据）
+        include = ["documents", "metadatas"] if hydrate else ["documents"]
+        all_docs = self.collection.get(include=include)
         
         # 计算关键词匹配分数
         results_with_score = []
@@ -141,21 +235,28 @@ class AdvancedRetriever:
                 score += doc.count(char) * 2
             
             if score > 0:
-                results_with_score.append({
+                result = {
                     'id': all_docs['ids'][i],
                     'document': doc,
                     'score': score,
                     'similarity': min(score / 100, 1.0),  # 归一化到0-1
-                    'metadata': all_docs['metadatas'][i],
                     'method': 'keyword_only'
-                })
+                }
+                if hydrate:
+                    result['metadata'] = all_docs['metadatas'][i]
+                results_with_score.append(result)
         
         # 按分数排序
         results_with_score.sort(key=lambda x: x['score'], reverse=True)
         
-        elapsed = time.time() - start_time
-        return results_with_score[:n_results], elapsed
+        self._record('keyword', time.time() - start_time)
+        tracing.current_span().set(
+            k=n_results, hydrate=hydrate,
+            scanned=len(all_docs['documents']), candidates=len(results_with_score)
+        )
+        return results_with_score[:n_results]
     
+    @tracing.traced("retriever.hybrid_search")
     def hybrid_search(self, 
                      query: str, 
                      n_results: int = 10,
@@ -173,11 +274,11 @@ class AdvancedRetriever:
         Returns:
             检索结果列表
         """
-        start_time = time.time()
-        
-        # 1. 分别执行两种检索
-        vector_results, _ = self.vector_search(query, n_results=20)
-        keyword_results, _ = self.keyword_search(query, n_results=20)
+        # 1. 分别执行两种检索（两阶段模式下只拿id和分数）
+        hydrate = not self.lazy_hydration
+        vector_results = self.vector_search(query, n_results=20, hydrate=hydrate)
+        keyword_results = self.keyword_search(query, n_results=20, hydrate=hydrate)
+        fusion_start = time.time()
         
         # 2. 合并结果
         all_results = {}
@@ -187,12 +288,13 @@ class AdvancedRetriever:
             doc_id = result['id']
             all_results[doc_id] = {
                 'id': doc_id,
-                'document': result['document'],
-                'metadata': result['metadata'],
                 'vector_score': result['similarity'],
                 'keyword_score': 0,
                 'method': 'hybrid'
             }
+            if hydrate:
+                all_results[doc_id]['document'] = result['document']
+                all_results[doc_id]['metadata'] = result['metadata']
         
         # 添加关键词检索结果
         for result in keyword_results:
@@ -202,12 +304,13 @@ class AdvancedRetriever:
             else:
                 all_results[doc_id] = {
                     'id': doc_id,
-                    'document': result['document'],
-                    'metadata': result['metadata'],
                     'vector_score': 0,
                     'keyword_score': result['similarity'],
                     'method': 'hybrid'
                 }
+                if hydrate:
+                    all_results[doc_id]['document'] = result['document']
+                    all_results[doc_id]['metadata'] = result['metadata']
         
         # 3. 计算混合分数
         for doc_id, result in all_results.items():
@@ -217,16 +320,57 @@ class AdvancedRetriever:
             )
             result['similarity'] = result['hybrid_score']
         
-        # 4. 排序并返回
+        # 4. 排序，只为最终top-k取回文本和元数据
         sorted_results = sorted(
             all_results.values(),
             key=lambda x: x['hybrid_score'],
             reverse=True
+        )[:n_results]
+        hydrate_start = time.time()
+        self._record('fusion', hydrate_start - fusion_start)
+        
+        if not hydrate:
+            self._hydrate(sorted_results)
+            self._record('hydrate', time.time() - hydrate_start)
+        
+        tracing.current_span().set(
+            k=n_results, vector_weight=vector_weight,
+            vector_candidates=len(vector_results), keyword_candidates=len(keyword_results),
+            candidates=len(all_results)
         )
+        return sorted_results
+    
+    def _hydrate(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        批量补全结果的文本和元数据（一次 collection.get）
         
-        elapsed = time.time() - start_time
-        return sorted_results[:n_results], elapsed
+        Args:
+            results: 只含id和分数的结果列表（原地修改）
+            
+        Returns:
+            补全后的结果列表
+        """
+        if not results:
+            return results
+        
+        fetched = self.collection.get(
+            ids=[r['id'] for r in results],
+            include=["documents", "metadatas"]
+        )
+        
+        # get 返回的顺序不保证与 ids 一致，按id对齐
+        by_id = {
+            doc_id: (doc, meta)
+            for doc_id, doc, meta in zip(fetched['ids'], fetched['documents'], fetched['metadatas'])
+        }
+        for result in results:
+            doc, meta = by_id.get(result['id'], ('', {}))
+            result['document'] = doc
+            result['metadata'] = meta or {}
+        
+        return results
     
+    @tracing.traced("retriever.rerank_results")
     def rerank_results(self, 
                       query: str,
                       results: List[Dict[str, Any]],
@@ -268,15 +412,17 @@ class AdvancedRetriever:
         # 重新排序
         results.sort(key=lambda x: x['rerank_score'], reverse=True)
         
-        elapsed = time.time() - start_time
+        self._record('rerank', time.time() - start_time)
+        tracing.current_span().set(k=top_k, candidates=len(results))
         
         # 标记为重排序结果
         for result in results[:top_k]:
             result['method'] = result.get('method', 'unknown') + '+rerank'
             result['similarity'] = result['rerank_score']
         
-        return results[:top_k], elapsed
+        return results[:top_k]
     
+    @tracing.traced("retriever.search_with_context")
     def search_with_context(self, 
                            query: str,
                            n_results: int = 5,
@@ -294,10 +440,9 @@ class AdvancedRetriever:
         Returns:
             包含上下文的检索结果
         """
-        start_time = time.time()
-        
         # 1. 先进行混合检索
-        results, _ = self.hybrid_search(query, n_results=n_results)
+        results = self.hybrid_search(query, n_results=n_results)
+        context_start = time.time()
         
         # 2. 为每个结果添加上下文
         for result in results:
@@ -345,8 +490,9 @@ class AdvancedRetriever:
             result['context_after'] = context_after
             result['full_context'] = ''.join(context_before) + result['document'] + ''.join(context_after)
         
-        elapsed = time.time() - start_time
-        return results, elapsed
+        self._record('context_window', time.time() - context_start)
+        tracing.current_span().set(k=n_results, context_window=context_window)
+        return results
 
 
 def demo():
@@ -355,8 +501,9 @@ def demo():
     print("RAG最终项目 - 高级检索策略演示")
     print("=" * 60)
     
-    # 初始化检索器
+    # 初始化检索器；打开链路追踪，各方法的耗时从 span 里读取
     retriever = AdvancedRetriever()
+    tracing.enable()
     
     # 测试查询
     test_queries = [
@@ -373,46 +520,46 @@ def demo():
         # 1. 纯向量检索
         print("\n📊 方法1: 纯向量检索")
         print("-" * 50)
-        vector_results, vector_time = retriever.vector_search(query, n_results=3)
+        vector_results = retriever.vector_search(query, n_results=3)
         for i, result in enumerate(vector_results, 1):
             print(f"\n结果 {i} (相似度: {result['similarity']:.1%})")
             print(f"来源: {result['metadata'].get('doc_name', 'unknown')}")
             print(f"内容: {result['document'][:100]}...")
-        print(f"\n⏱️  耗时: {vector_time*1000:.1f}ms")
+        print(f"\n⏱️  耗时: {tracing.last_duration('retriever.vector_search')*1000:.1f}ms")
         
         # 2. 纯关键词检索
         print("\n📊 方法2: 纯关键词检索")
         print("-" * 50)
-        keyword_results, keyword_time = retriever.keyword_search(query, n_results=3)
+        keyword_results = retriever.keyword_search(query, n_results=3)
         for i, result in enumerate(keyword_results, 1):
             print(f"\n结果 {i} (相似度: {result['similarity']:.1%})")
             print(f"来源: {result['metadata'].get('doc_name', 'unknown')}")
             print(f"内容: {result['document'][:100]}...")
-        print(f"\n⏱️  耗时: {keyword_time*1000:.1f}ms")
+        print(f"\n⏱️  耗时: {tracing.last_duration('retriever.keyword_search')*1000:.1f}ms")
         
         # 3. 混合检索
         print("\n📊 方法3: 混合检索 (向量70% + 关键词30%)")
         print("-" * 50)
-        hybrid_results, hybrid_time = retriever.hybrid_search(query, n_results=3)
+        hybrid_results = retriever.hybrid_search(query, n_results=3)
         for i, result in enumerate(hybrid_results, 1):
             print(f"\n结果 {i} (混合分: {result['similarity']:.1%})")
             print(f"  向量分: {result.get('vector_score', 0):.1%}")
             print(f"  关键词分: {result.get('keyword_score', 0):.1%}")
             print(f"来源: {result['metadata'].get('doc_name', 'unknown')}")
             print(f"内容: {result['document'][:100]}...")
-        print(f"\n⏱️  耗时: {hybrid_time*1000:.1f}ms")
+        print(f"\n⏱️  耗时: {tracing.last_duration('retriever.hybrid_search')*1000:.1f}ms")
         
         # 4. 混合检索 + 重排序
         print("\n📊 方法4: 混合检索 + 重排序")
         print("-" * 50)
-        hybrid_results, _ = retriever.hybrid_search(query, n_results=10)
-        reranked_results, rerank_time = retriever.rerank_results(query, hybrid_results, top_k=3)
+        hybrid_results = retriever.hybrid_search(query, n_results=10)
+        reranked_results = retriever.rerank_results(query, hybrid_results, top_k=3)
         for i, result in enumerate(reranked_results, 1):
             print(f"\n结果 {i} (重排分: {result['similarity']:.1%})")
             print(f"  原始混合分: {result.get('hybrid_score', 0):.1%}")
             print(f"来源: {result['metadata'].get('doc_name', 'unknown')}")
             print(f"内容: {result['document'][:100]}...")
-        print(f"\n⏱️  重排序耗时: {rerank_time*1000:.1f}ms")
+        print(f"\n⏱️  重排序耗时: {tracing.last_duration('retriever.rerank_results')*1000:.1f}ms")
     
     # 5. 上下文窗口演示
     print("\n" + "=" * 60)
@@ -422,7 +569,7 @@ def demo():
     print(f"\n查询: {query}")
     print("-" * 50)
     
-    context_results, context_time = retriever.search_with_context(
+    context_results = retriever.search_with_context(
         query, 
         n_results=2, 
         context_window=1
@@ -445,7 +592,12 @@ def demo():
             for ctx in result['context_after']:
                 print(f"  {ctx[:80]}...")
     
-    print(f"\n⏱️  耗时: {context_time*1000:.1f}ms")
+    print(f"\n⏱️  耗时: {tracing.last_duration('retriever.search_with_context')*1000:.1f}ms")
+    
+    # 各方法的耗时统计（hybrid_search 内部的向量/关键词检索也计入对应的 span）
+    tracing.print_summary("检索耗时统计")
+    n_events = tracing.export_chrome_trace("retrieval_trace.json")
+    print(f"💾 {n_events} 个span已导出到 retrieval_trace.json（chrome://tracing 或 ui.perfetto.dev 打开）")
     
     # 总结
     print("\n" + "=" * 60)
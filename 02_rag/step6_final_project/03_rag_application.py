@@ -14,13 +14,22 @@ RAG最终项目 - 完整RAG应用
 import os
 import sys
 import time
-from llama_cpp import Llama
+import queue
+import asyncio
+import threading
+from contextlib import nullcontext
 from typing import List, Dict, Any, Optional
 
 # 导入前面开发的模块
 from pathlib import Path
 import importlib.util
 
+# 常驻LLM服务（01_inference/llm_server.py）运行时直接连接，省去模型加载
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+from llm_server import connect_or_load
+from prefix_cache import PrefixCache
+import tracing
+
 # 动态导入同目录的模块
 current_dir = Path(__file__).parent
 retrieval_module_path = current_dir / "02_advanced_retrieval.py"
@@ -29,6 +38,103 @@ advanced_retrieval = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(advanced_retrieval)
 AdvancedRetriever = advanced_retrieval.AdvancedRetriever
 
+answer_cache_module_path = current_dir / "07_answer_cache.py"
+spec = importlib.util.spec_from_file_location("answer_cache", answer_cache_module_path)
+answer_cache = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(answer_cache)
+SemanticAnswerCache = answer_cache.SemanticAnswerCache
+
+condenser_module_path = current_dir / "09_query_condenser.py"
+spec = importlib.util.spec_from_file_location("query_condenser", condenser_module_path)
+query_condenser = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(query_condenser)
+QueryCondenser = query_condenser.QueryCondenser
+
+# Prompt模板：静态说明放在最前面，可以被前缀KV缓存复用
+RAG_PROMPT_PREFIX = """你是一个专业的AI助手。请基于提供的参考资料回答问题。
+
+回答要求：
+1. 优先使用参考资料中的信息
+2. 如果参考资料不够充分，可以结合你的知识补充
+3. 回答要准确、专业、简洁
+4. 如果参考资料与问题完全无关，说明情况后再用你的知识回答
+
+"""
+
+NO_CONTEXT_PROMPT_PREFIX = """你是一个专业的AI助手。请直接根据你的知识回答以下问题。
+
+"""
+
+
+class DecodeJob:
+    """交给解码线程的一次生成"""
+
+    def __init__(self, generate, prompt: str, loop: asyncio.AbstractEventLoop):
+        self.generate = generate                # 会话视图会替换 generate，所以随任务传入
+        self.prompt = prompt
+        self.loop = loop
+        self.output = asyncio.Queue()           # 流式片段，异常对象表示失败，None 表示结束
+        self.stop_event = threading.Event()     # 调用方不再需要输出
+        self.started = threading.Event()
+
+    def put(self, item):
+        self.loop.call_soon_threadsafe(self.output.put_nowait, item)
+
+
+class DecodeWorker:
+    """
+    answer_async 的专用解码线程
+
+    每个请求一个线程池任务的话，N 个并发会话会占住 N 个线程排队等模型，
+    检索和分词也用同一个线程池，会被一起拖住。这里固定几个线程从队列里取任务：
+    本进程的 Llama 一次只能服务一个请求，只用一个线程；常驻服务/批调度器
+    可以并发解码，线程数等于并发槽数。取到任务时调用方已经放弃的话直接丢弃。
+    """
+
+    def __init__(self, lock, n_threads: int = 1):
+        self.lock = lock
+        self.n_threads = n_threads
+        self.jobs = queue.Queue()
+        self.threads = []
+        self._start_lock = threading.Lock()
+
+    def submit(self, job: DecodeJob):
+        if not self.threads:
+            with self._start_lock:
+                if not self.threads:
+                    for i in range(self.n_threads):
+                        thread = threading.Thread(target=self._run, name=f"rag-decode-{i}", daemon=True)
+                        thread.start()
+                        self.threads.append(thread)
+        self.jobs.put(job)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if not job.stop_event.is_set():
+                    self._decode(job)
+            finally:
+                job.put(None)
+
+    def _decode(self, job: DecodeJob):
+        try:
+            with self.lock:
+                # 等锁期间调用方可能已经放弃了，不要再碰模型
+                if job.stop_event.is_set():
+                    return
+                job.started.set()
+                chunks = job.generate(job.prompt, stream=True)
+                try:
+                    for chunk in chunks:
+                        if job.stop_event.is_set():
+                            break
+                        job.put(chunk)
+                finally:
+                    chunks.close()
+        except Exception as e:
+            job.put(e)
+
 
 class ProductionRAG:
     """生产级RAG系统"""
@@ -36,7 +142,8 @@ class ProductionRAG:
     def __init__(self, 
                  model_path: str,
                  chroma_path: str = "./data/document_store",
-                 collection_name: str = "documents"):
+                 collection_name: str = "documents",
+                 llm=None):
         """
         初始化RAG系统
         
@@ -44,6 +151,8 @@ class ProductionRAG:
             model_path: LLM模型路径
             chroma_path: ChromaDB路径
             collection_name: 集合名称
+            llm: 已创建的LLM（Llama、LLMClient、OllamaBackend等，调用方式与 Llama.__call__ 相同）。
+                 不传时优先连接常驻LLM服务，服务没有运行才加载 model_path
         """
         print("=" * 60)
         print("🚀 初始化生产级RAG系统")
@@ -52,7 +161,7 @@ class ProductionRAG:
         # 1. 加载LLM
         print("\n📦 加载语言模型...")
         print(f"   模型: {os.path.basename(model_path)}")
-        self.llm = Llama(
+        self.llm = llm or connect_or_load(
             model_path=model_path,
             n_ctx=4096,
             n_gpu_layers=0,
@@ -75,10 +184,44 @@ class ProductionRAG:
             'use_context_window': False,  # 暂时关闭上下文窗口，用混合检索
             'context_window_size': 1,
             'similarity_threshold': 0.3,  # 降低阈值，因为向量距离可能是负数
-            'max_context_length': 2000,
+            'context_token_budget': None,  # None = n_ctx - llm_max_tokens - 模板token数
             'llm_temperature': 0.3,
-            'llm_max_tokens': 512
+            'llm_max_tokens': 512,
+            'use_prefix_cache': True,
+            'use_answer_cache': True,
+            'answer_cache_threshold': 0.92,
+            'condense_followups': True,  # 追问改写成独立问题后再检索
+            'greedy_with_draft': True  # 投机解码（草稿模型）只在贪心解码时生效，检测到时温度改为0
         }
+        if self.config['greedy_with_draft'] and getattr(self.llm, 'speculative', False):
+            self.config['llm_temperature'] = 0.0
+            print("   ✏️  检测到投机解码（草稿模型），生成温度设为0")
+        
+        # 4. 前缀KV缓存（只有本进程内的 Llama 才能保存/恢复状态）
+        self.prefix_cache = None
+        if hasattr(self.llm, 'save_state'):
+            self.prefix_cache = PrefixCache(self.llm)
+            self.prefix_cache.register(RAG_PROMPT_PREFIX)
+            self.prefix_cache.register(NO_CONTEXT_PROMPT_PREFIX)
+        
+        # 5. 语义答案缓存（同义问题 + 相同检索结果时跳过LLM）
+        self.answer_cache = SemanticAnswerCache(threshold=self.config['answer_cache_threshold'])
+        
+        # 6. 上下文打包：每个文档块的token数只计算一次
+        self._token_counts = {}
+        
+        # 7. answer_async 的解码线程：本进程内的 Llama 同一时间只能服务一个请求
+        #    （LLMClient 走HTTP、BatchScheduler 自己调度并发，不需要加锁）
+        #    可重入：会话层（08_session_manager.py）在同一线程里还要恢复/保存KV状态
+        if hasattr(self.llm, 'save_state') and not getattr(self.llm, 'thread_safe', False):
+            self._llm_lock = threading.RLock()
+            self.decoder = DecodeWorker(self._llm_lock, n_threads=1)
+        else:
+            self._llm_lock = nullcontext()
+            self.decoder = DecodeWorker(self._llm_lock, n_threads=getattr(self.llm, 'n_slots', 4))
+        
+        # 8. 追问改写：规则优先，拿不准时用很短的LLM调用
+        self.condenser = QueryCondenser(self.llm, lock=self._llm_lock)
         
         print("\n⚙️  系统配置:")
         for key, value in self.config.items():
@@ -88,6 +231,7 @@ class ProductionRAG:
         print("✅ RAG系统初始化完成！")
         print("=" * 60 + "\n")
     
+    @tracing.traced("rag.retrieve")
     def retrieve(self, query: str) -> Dict[str, Any]:
         """
         执行检索
@@ -99,106 +243,210 @@ class ProductionRAG:
             检索结果和统计信息
         """
         start_time = time.time()
-        
-        # 1. 根据配置选择检索方法
-        method = self.config['retrieval_method']
-        n_results = self.config['n_results']
-        
-        if self.config['use_context_window']:
-            # 带上下文窗口的检索
-            results, _ = self.retriever.search_with_context(
-                query,
-                n_results=n_results,
-                context_window=self.config['context_window_size']
-            )
-        elif method == 'vector':
-            results, _ = self.retriever.vector_search(query, n_results=n_results * 2)
-        elif method == 'keyword':
-            results, _ = self.retriever.keyword_search(query, n_results=n_results * 2)
-        else:  # hybrid
-            results, _ = self.retriever.hybrid_search(query, n_results=n_results * 2)
-        
-        # 2. 重排序（如果启用）
-        if self.config['use_rerank'] and not self.config['use_context_window']:
-            results, _ = self.retriever.rerank_results(query, results, top_k=n_results)
+        # 阶段耗时按本次调用收集（检索器被多个线程、会话视图共享）
+        with self.retriever.collect_timings() as timings:
+            # 1. 根据配置选择检索方法
+            method = self.config['retrieval_method']
+            n_results = self.config['n_results']
+            
+            if self.config['use_context_window']:
+                # 带上下文窗口的检索
+                results = self.retriever.search_with_context(
+                    query,
+                    n_results=n_results,
+                    context_window=self.config['context_window_size']
+                )
+            elif method == 'vector':
+                results = self.retriever.vector_search(query, n_results=n_results * 2)
+            elif method == 'keyword':
+                results = self.retriever.keyword_search(query, n_results=n_results * 2)
+            else:  # hybrid
+                results = self.retriever.hybrid_search(query, n_results=n_results * 2)
+            
+            # 2. 重排序（如果启用）
+            if self.config['use_rerank'] and not self.config['use_context_window']:
+                results = self.retriever.rerank_results(query, results, top_k=n_results)
         
         # 3. 过滤低相似度结果
         threshold = self.config['similarity_threshold']
         filtered_results = [r for r in results if r.get('similarity', 0) >= threshold]
         
         retrieval_time = time.time() - start_time
+        tracing.current_span().set(method=method, k=n_results, found=len(results), kept=len(filtered_results))
         
         return {
             'results': filtered_results,
             'total_found': len(filtered_results),
             'retrieval_time': retrieval_time,
-            'method': method + ('+rerank' if self.config['use_rerank'] else '')
+            'method': method + ('+rerank' if self.config['use_rerank'] else ''),
+            'timings': dict(timings)   # 各阶段耗时（embed/ann/keyword/fusion/...）
         }
     
-    def build_prompt(self, query: str, contexts: List[Dict[str, Any]]) -> str:
+    def build_prompt(self, query: str, contexts: List[Dict[str, Any]], history: str = "") -> str:
         """
         构建优化的Prompt
         
         Args:
             query: 用户查询
-            contexts: 检索到的上下文
+            contexts: 检索到的上下文（按相关度排序）
+            history: 对话历史文本（多轮会话），放在静态说明之后
             
         Returns:
             完整的prompt
         """
+        return self._build_prompt(query, contexts, history)[0]
+    
+    @tracing.traced("rag.build_prompt")
+    def _build_prompt(self, query: str, contexts: List[Dict[str, Any]], history: str = ""):
+        """
+        构建Prompt并返回本次的打包统计
+        
+        Returns:
+            (prompt, packing)，没有上下文时 packing 为None
+        """
         if not contexts:
             # 没有检索到相关内容
-            prompt = f"""你是一个专业的AI助手。请直接根据你的知识回答以下问题。
-
-问题：{query}
+            prompt = NO_CONTEXT_PROMPT_PREFIX + self._format_history(history) + f"""问题：{query}
 
 请给出准确、专业的回答："""
-            return prompt
-        
-        # 构建上下文
-        context_text = ""
-        max_length = self.config['max_context_length']
-        current_length = 0
+            return prompt, None
         
-        for i, ctx in enumerate(contexts, 1):
-            # 使用完整上下文（如果有）
-            if 'full_context' in ctx:
-                text = ctx['full_context']
-            else:
-                text = ctx['document']
-            
-            # 控制总长度
-            if current_length + len(text) > max_length:
-                remaining = max_length - current_length
-                if remaining > 100:  # 至少保留100字符
-                    text = text[:remaining] + "..."
-                else:
-                    break
-            
-            doc_name = ctx['metadata'].get('doc_name', '未知')
-            similarity = ctx.get('similarity', 0)
-            
-            context_text += f"\n参考资料 {i} (来源:{doc_name}, 相关度:{similarity:.0%}):\n{text}\n"
-            current_length += len(text)
-        
-        # 构建完整prompt
-        prompt = f"""你是一个专业的AI助手。请基于提供的参考资料回答问题。
-
-参考资料：
+        entries, packing = self.pack_contexts(query, contexts, history)
+        prompt = self._format_prompt(query, entries, history)
+        tracing.current_span().set(
+            contexts=len(contexts), selected=packing['selected'], dropped=packing['dropped'],
+            prompt_tokens=packing['prompt_tokens'], budget=packing['budget']
+        )
+        return prompt, packing
+    
+    @staticmethod
+    def _context_text(ctx: Dict[str, Any]) -> str:
+        # 使用完整上下文（如果有）
+        return ctx['full_context'] if 'full_context' in ctx else ctx['document']
+    
+    @staticmethod
+    def _format_context(i: int, ctx: Dict[str, Any], text: str) -> str:
+        doc_name = ctx['metadata'].get('doc_name', '未知')
+        similarity = ctx.get('similarity', 0)
+        return f"\n参考资料 {i} (来源:{doc_name}, 相关度:{similarity:.0%}):\n{text}\n"
+    
+    @staticmethod
+    def _format_history(history: str) -> str:
+        return f"对话历史：\n{history}\n" if history else ""
+    
+    def _format_prompt(self, query: str, entries: List[tuple], history: str = "") -> str:
+        """entries: [(ctx, text), ...]"""
+        context_text = "".join(
+            self._format_context(i, ctx, text) for i, (ctx, text) in enumerate(entries, 1)
+        )
+        # 静态说明在前，然后是对话历史（同一会话的下一轮可以复用这段KV缓存），参考资料和问题在后
+        return RAG_PROMPT_PREFIX + self._format_history(history) + f"""参考资料：
 {context_text}
 
 问题：{query}
 
-回答要求：
-1. 优先使用参考资料中的信息
-2. 如果参考资料不够充分，可以结合你的知识补充
-3. 回答要准确、专业、简洁
-4. 如果参考资料与问题完全无关，说明情况后再用你的知识回答
-
 请回答："""
+    
+    def _count_tokens(self, text: str, key=None) -> int:
+        """
+        用模型的分词器计算token数
+        
+        Args:
+            text: 文本
+            key: 缓存键（文档块id等），不传则不缓存
+        """
+        if key is not None and key in self._token_counts:
+            return self._token_counts[key]
+        count = len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=False))
+        if key is not None:
+            if len(self._token_counts) >= 10000:
+                self._token_counts.clear()
+            self._token_counts[key] = count
+        return count
+    
+    def _prompt_tokens(self, prompt: str) -> int:
+        # 与 Llama.create_completion 对提示词的分词方式一致
+        return len(self.llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True))
+    
+    @staticmethod
+    def _knapsack(values: List[float], costs: List[int], capacity: int) -> List[int]:
+        """0/1背包：在总成本不超过 capacity 的前提下使价值之和最大，返回选中的下标"""
+        best = [0.0] * (capacity + 1)
+        keep = [[False] * (capacity + 1) for _ in values]
+        for i, (value, cost) in enumerate(zip(values, costs)):
+            for w in range(capacity, cost - 1, -1):
+                if best[w - cost] + value > best[w]:
+                    best[w] = best[w - cost] + value
+                    keep[i][w] = True
         
-        return prompt
+        chosen = []
+        w = capacity
+        for i in reversed(range(len(values))):
+            if keep[i][w]:
+                chosen.append(i)
+                w -= costs[i]
+        return sorted(chosen)
     
+    def pack_contexts(self, query: str, contexts: List[Dict[str, Any]], history: str = ""):
+        """
+        在token预算内选择上下文，使相关度之和最大
+        
+        预算 = n_ctx - llm_max_tokens - 模板（说明、对话历史、问题）的token数，
+        也可以用 config['context_token_budget'] 进一步收紧。
+        放不下任何一个完整文档块时，截断最相关的那个。
+        
+        Returns:
+            ([(ctx, text), ...], 打包统计)，上下文保持原来的相关度顺序
+            （answer_async 会在多个线程里同时打包，统计随返回值带回，不放在实例上）
+        """
+        limit = self.llm.n_ctx() - self.config['llm_max_tokens']
+        template_tokens = self._prompt_tokens(self._format_prompt(query, [], history))
+        budget = limit - template_tokens
+        if self.config['context_token_budget']:
+            budget = min(budget, self.config['context_token_budget'])
+        budget = max(budget, 0)
+        
+        texts = [self._context_text(ctx) for ctx in contexts]
+        costs = []
+        for ctx, text in zip(contexts, texts):
+            # 参考资料标题（来源、相关度）单独计算，文档块正文按id缓存
+            header = self._format_context(len(contexts), ctx, "")
+            text_key = (ctx.get('id') or text, 'full_context' in ctx)
+            costs.append(self._count_tokens(header, key=('header', header)) +
+                         self._count_tokens(text, key=text_key))
+        # 相关度为0的块也值得放进空余的位置
+        values = [max(ctx.get('similarity', 0), 0) + 1e-6 for ctx in contexts]
+        
+        chosen = self._knapsack(values, costs, budget)
+        entries = [(contexts[i], texts[i]) for i in chosen]
+        
+        if not entries:
+            # 最相关的块单独都放不下：按token比例截断
+            ratio = budget / max(costs[0], 1)
+            entries = [(contexts[0], texts[0][:int(len(texts[0]) * ratio)] + "...")]
+        
+        # 分段计数与整体分词可能有几个token的出入，最后用完整prompt校验
+        prompt_tokens = self._prompt_tokens(self._format_prompt(query, entries, history))
+        while prompt_tokens > limit and entries:
+            if len(entries) > 1:
+                # 去掉相关度最低的
+                entries.remove(min(entries, key=lambda e: e[0].get('similarity', 0)))
+            else:
+                ctx, text = entries[0]
+                cut = int(len(text) * 0.9)
+                entries = [(ctx, text[:cut] + "...")] if cut > 0 else []
+            prompt_tokens = self._prompt_tokens(self._format_prompt(query, entries, history))
+        
+        packing = {
+            'budget': budget,
+            'used': prompt_tokens - template_tokens,
+            'prompt_tokens': prompt_tokens,
+            'selected': len(entries),
+            'dropped': len(contexts) - len(entries)
+        }
+        return entries, packing
+    
+    @tracing.traced("rag.generate")
     def generate(self, prompt: str, stream: bool = True):
         """
         生成回答
@@ -212,6 +460,10 @@ class ProductionRAG:
         """
         start_time = time.time()
         
+        # 恢复静态前缀的KV状态，只预填充参考资料和问题
+        if self.prefix_cache is not None and self.config['use_prefix_cache']:
+            self.prefix_cache.prepare(prompt)
+        
         response = self.llm(
             prompt,
             max_tokens=self.config['llm_max_tokens'],
@@ -223,7 +475,12 @@ class ProductionRAG:
         if stream:
             # 流式输出
             full_text = ""
+            first_token_time = None
+            n_chunks = 0
             for chunk in response:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                n_chunks += 1
                 text = chunk['choices'][0]['text']
                 full_text += text
                 yield {
@@ -232,23 +489,67 @@ class ProductionRAG:
                     'done': False
                 }
             
-            generation_time = time.time() - start_time
+            end_time = time.time()
+            first_token_time = first_token_time or end_time
+            # 流式输出每个块对应一个token
+            tracing.current_span().set(
+                prompt_chars=len(prompt), completion_tokens=n_chunks,
+                ttft_ms=(first_token_time - start_time) * 1000
+            )
             yield {
                 'text': '',
                 'full_text': full_text,
                 'done': True,
-                'generation_time': generation_time
+                'generation_time': end_time - start_time,
+                'ttft': first_token_time - start_time,       # 前缀恢复 + 预填充 + 第一个token
+                'decode_time': end_time - first_token_time,
+                'n_chunks': n_chunks
             }
         else:
             # 非流式输出
             full_text = response['choices'][0]['text']
             generation_time = time.time() - start_time
+            usage = response.get('usage') or {}
+            tracing.current_span().set(
+                prompt_chars=len(prompt), prompt_tokens=usage.get('prompt_tokens'),
+                completion_tokens=usage.get('completion_tokens')
+            )
             return {
                 'text': full_text,
                 'generation_time': generation_time
             }
     
-    def answer(self, query: str, stream: bool = True, verbose: bool = True):
+    def condense(self, query: str, turns: List[tuple]) -> tuple:
+        """
+        把追问改写成用于检索的独立问题
+        
+        Args:
+            query: 用户问题
+            turns: 之前的对话 [(检索用的问题, 回答), ...]
+            
+        Returns:
+            (检索用的问题, 改写方式)
+        """
+        if not self.config['condense_followups']:
+            return query, 'disabled'
+        return self.condenser.condense(query, turns)
+    
+    @staticmethod
+    def format_history(turns: List[tuple], max_chars: int = 1500) -> str:
+        """最近几轮对话的文本（从新往旧取，总长度不超过 max_chars）"""
+        lines = []
+        used = 0
+        for user, assistant in reversed(turns):
+            text = f"用户：{user}\n助手：{assistant}\n"
+            if used + len(text) > max_chars:
+                break
+            lines.append(text)
+            used += len(text)
+        return "".join(reversed(lines))
+    
+    @tracing.traced("rag.answer")
+    def answer(self, query: str, stream: bool = True, verbose: bool = True, history: str = "",
+               retrieval_query: Optional[str] = None):
         """
         回答问题（完整流程）
         
@@ -256,6 +557,8 @@ class ProductionRAG:
             query: 用户问题
             stream: 是否流式输出
             verbose: 是否显示详细信息
+            history: 对话历史文本（多轮会话）；有历史时回答依赖上下文，不使用答案缓存
+            retrieval_query: 用于检索的问题（追问改写的结果），不传则用 query
             
         Yields/Returns:
             回答结果
@@ -266,7 +569,7 @@ class ProductionRAG:
         if verbose:
             print(f"🔍 检索中...", end='', flush=True)
         
-        retrieval_result = self.retrieve(query)
+        retrieval_result = self.retrieve(retrieval_query or query)
         
         if verbose:
             print(f" 完成 ({retrieval_result['retrieval_time']*1000:.0f}ms)")
@@ -283,13 +586,67 @@ class ProductionRAG:
             else:
                 print("   ⚠️  未找到相关内容，将使用LLM直接回答")
         
-        # 2. 构建Prompt
-        prompt = self.build_prompt(query, retrieval_result['results'])
+        # 2. 语义答案缓存：同义问题 + 相同检索结果 → 直接回放答案，跳过LLM
+        if self.config['use_answer_cache'] and not history:
+            cached, cache_key = self._lookup_answer_cache(query, retrieval_result)
+            
+            if cached is not None:
+                tracing.current_span().set(cached=True)
+                if verbose:
+                    print(f"\n⚡ 命中答案缓存 (相似问题: {cached['query']}, 相似度 {cached['similarity']:.0%})")
+                    print(f"\n💬 AI回答:")
+                    print("-" * 60)
+                
+                answer_text = cached['answer']
+                if stream:
+                    # 按小段回放，保持与流式生成相同的输出格式
+                    for i in range(0, len(answer_text), 8):
+                        text = answer_text[i:i + 8]
+                        if verbose:
+                            print(text, end='', flush=True)
+                        yield {
+                            'text': text,
+                            'full_text': answer_text[:i + 8],
+                            'done': False
+                        }
+                if verbose:
+                    if not stream:
+                        print(answer_text, end='')
+                    print()
+                    print("-" * 60)
+                
+                result = {
+                    'query': query,
+                    'answer': answer_text,
+                    'retrieval_time': retrieval_result['retrieval_time'],
+                    'generation_time': 0.0,
+                    'total_time': time.time() - total_start,
+                    'num_contexts': retrieval_result['total_found'],
+                    'method': retrieval_result['method'],
+                    'timings': retrieval_result['timings'],
+                    'cached': True
+                }
+                if verbose:
+                    print(f"\n⏱️  总计: {result['total_time']*1000:.0f}ms (缓存命中)")
+                if stream:
+                    yield result
+                    return
+                return result
+        else:
+            cache_key = None
+        
+        # 3. 构建Prompt
+        prompt_start = time.time()
+        prompt, packing = self._build_prompt(query, retrieval_result['results'], history)
+        timings = {**retrieval_result['timings'], 'prompt_build': time.time() - prompt_start}
         
         if verbose:
             print(f"\n📝 Prompt长度: {len(prompt)} 字符")
+            if packing:
+                print(f"   上下文: {packing['used']}/{packing['budget']} tokens, "
+                      f"选用 {packing['selected']} 段, 舍弃 {packing['dropped']} 段")
         
-        # 3. 生成回答
+        # 4. 生成回答
         if verbose:
             print(f"\n💬 AI回答:")
             print("-" * 60)
@@ -315,9 +672,14 @@ class ProductionRAG:
                         'generation_time': chunk['generation_time'],
                         'total_time': total_time,
                         'num_contexts': retrieval_result['total_found'],
-                        'method': retrieval_result['method']
+                        'method': retrieval_result['method'],
+                        'timings': {**timings, 'ttft': chunk['ttft'], 'decode': chunk['decode_time']},
+                        'generated_chunks': chunk['n_chunks']
                     }
                     
+                    if cache_key is not None:
+                        self.answer_cache.store(query, cache_key[0], cache_key[1], cache_key[2], result['answer'])
+                    
                     if verbose:
                         print(f"\n⏱️  性能统计:")
                         print(f"   检索: {result['retrieval_time']*1000:.0f}ms")
@@ -340,6 +702,9 @@ class ProductionRAG:
                 'method': retrieval_result['method']
             }
             
+            if cache_key is not None:
+                self.answer_cache.store(query, cache_key[0], cache_key[1], cache_key[2], result['answer'])
+            
             if verbose:
                 print(result['answer'])
                 print("-" * 60)
@@ -350,17 +715,192 @@ class ProductionRAG:
             
             return result
     
+    def _lookup_answer_cache(self, query: str, retrieval_result: Dict[str, Any]):
+        """
+        查询答案缓存
+        
+        Returns:
+            (命中的缓存条目或None, 生成后写回缓存用的键)
+        """
+        chunk_ids = [r['id'] for r in retrieval_result['results']]
+        query_embedding = self.retriever.embed_query(query)
+        version = self._cache_version()
+        cached = self.answer_cache.lookup(query_embedding, chunk_ids, version,
+                                          threshold=self.config['answer_cache_threshold'])
+        return cached, (query_embedding, chunk_ids, version)
+    
+    async def answer_async(self, query: str, history: str = "", retrieval_query: Optional[str] = None):
+        """
+        异步回答问题（流式）
+        
+        与 answer(stream=True) 输出相同的数据，但不占用事件循环：
+        - 向量编码和检索在线程池中执行，模型空闲时同时预填充模板前缀（前缀KV缓存）
+        - 解码在专用解码线程中进行（DecodeWorker），token通过 asyncio.Queue 逐个送回
+        一个事件循环可以同时服务很多会话：
+        
+            async for item in rag.answer_async(query):
+                if 'total_time' in item: ...       # 最后一项是完整结果
+                else: print(item['text'], end='')
+        
+        Args:
+            query: 用户问题
+            history: 对话历史文本（同 answer）
+            retrieval_query: 用于检索的问题（同 answer）
+            
+        Yields:
+            {'text', 'full_text', 'done'} 流式片段，最后是完整结果
+        """
+        loop = asyncio.get_running_loop()
+        total_start = time.time()
+        
+        # 1. 检索与模板前缀预填充同时进行
+        retrieval_task = loop.run_in_executor(None, self.retrieve, retrieval_query or query)
+        warm_task = None
+        if self.prefix_cache is not None and self.config['use_prefix_cache']:
+            warm_task = loop.run_in_executor(None, self._warm_prefix)
+        retrieval_result = await retrieval_task
+        
+        # 2. 语义答案缓存
+        cache_key = None
+        if self.config['use_answer_cache'] and not history:
+            cached, cache_key = await loop.run_in_executor(
+                None, self._lookup_answer_cache, query, retrieval_result
+            )
+            if cached is not None:
+                # 命中缓存不需要前缀，预填充不等它（模型忙时它本来就立即返回）
+                answer_text = cached['answer']
+                for i in range(0, len(answer_text), 8):
+                    yield {'text': answer_text[i:i + 8], 'full_text': answer_text[:i + 8], 'done': False}
+                yield {
+                    'query': query,
+                    'answer': answer_text,
+                    'retrieval_time': retrieval_result['retrieval_time'],
+                    'generation_time': 0.0,
+                    'total_time': time.time() - total_start,
+                    'num_contexts': retrieval_result['total_found'],
+                    'method': retrieval_result['method'],
+                    'cached': True
+                }
+                return
+        
+        # 3. 构建Prompt（分词可能是对常驻服务的HTTP请求，同样放进线程池）
+        prompt = await loop.run_in_executor(None, self.build_prompt, query, retrieval_result['results'], history)
+        if warm_task is not None:
+            await warm_task
+        
+        # 4. 后端自带异步流式接口（OllamaBackend）时直接在事件循环里读取
+        if hasattr(self.llm, 'astream'):
+            start_time = time.time()
+            full_text = ""
+            async for chunk in self.llm.astream(
+                prompt,
+                max_tokens=self.config['llm_max_tokens'],
+                temperature=self.config['llm_temperature'],
+                stop=["问题：", "\n\n\n"]
+            ):
+                text = chunk['choices'][0]['text']
+                full_text += text
+                yield {'text': text, 'full_text': full_text, 'done': False}
+            
+            result = {
+                'query': query,
+                'answer': full_text,
+                'retrieval_time': retrieval_result['retrieval_time'],
+                'generation_time': time.time() - start_time,
+                'total_time': time.time() - total_start,
+                'num_contexts': retrieval_result['total_found'],
+                'method': retrieval_result['method']
+            }
+            if cache_key is not None:
+                self.answer_cache.store(query, cache_key[0], cache_key[1], cache_key[2], result['answer'])
+            yield result
+            return
+        
+        # 5. 其他后端交给专用解码线程，通过队列把token交给事件循环
+        job = DecodeJob(self.generate, prompt, loop)
+        self.decoder.submit(job)
+        finished = False
+        try:
+            while True:
+                chunk = await job.output.get()
+                if chunk is None:
+                    finished = True
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if not chunk['done']:
+                    yield chunk
+                    continue
+                
+                result = {
+                    'query': query,
+                    'answer': chunk['full_text'],
+                    'retrieval_time': retrieval_result['retrieval_time'],
+                    'generation_time': chunk['generation_time'],
+                    'total_time': time.time() - total_start,
+                    'num_contexts': retrieval_result['total_found'],
+                    'method': retrieval_result['method']
+                }
+                if cache_key is not None:
+                    self.answer_cache.store(query, cache_key[0], cache_key[1], cache_key[2], result['answer'])
+                yield result
+        finally:
+            # 调用方提前停止迭代（或任务被取消）：还在排队的任务会被直接丢弃；
+            # 已经在解码的任务在下一个token处停下，等它让出模型
+            # （会话层接着要恢复/保存同一个模型的KV状态）
+            job.stop_event.set()
+            if job.started.is_set() and not finished:
+                while await job.output.get() is not None:
+                    pass
+    
+    def _warm_prefix(self):
+        """
+        在模型空闲时预填充RAG模板前缀
+        
+        模型正在为别的请求解码时直接跳过，不在线程池里等锁
+        （检索、分词、答案缓存查询用的是同一个线程池）
+        """
+        acquire = getattr(self._llm_lock, 'acquire', None)
+        if acquire is None:
+            self.prefix_cache.prepare(RAG_PROMPT_PREFIX)
+            return
+        if not acquire(blocking=False):
+            return
+        try:
+            self.prefix_cache.prepare(RAG_PROMPT_PREFIX)
+        finally:
+            self._llm_lock.release()
+    
+    def _cache_version(self):
+        """
+        答案缓存的版本：集合状态 + LLM配置
+        
+        任何一项变化（导入/删除文档、换模型、改生成参数或模板），旧答案都不再命中
+        """
+        collection = self.retriever.collection
+        return (
+            collection.name,
+            collection.count(),
+            getattr(self.llm, 'model_path', type(self.llm).__name__),
+            self.config['llm_temperature'],
+            self.config['llm_max_tokens'],
+            RAG_PROMPT_PREFIX
+        )
+    
     def interactive_mode(self):
         """交互式问答模式"""
         print("\n" + "=" * 60)
         print("💬 进入交互式问答模式")
         print("=" * 60)
         print("\n命令:")
-        print("  - 输入问题进行提问")
+        print("  - 输入问题进行提问（可以追问，如\"那罚多少钱？\"）")
         print("  - 输入 'config' 查看/修改配置")
+        print("  - 输入 'trace' 查看各阶段耗时并导出链路追踪（需要 RAG_TRACE=1）")
         print("  - 输入 'quit' 或 'exit' 退出")
         print("\n" + "=" * 60 + "\n")
         
+        turns = []  # [(检索用的问题, 回答)]
+        
         while True:
             try:
                 # 获取用户输入
@@ -378,13 +918,32 @@ class ProductionRAG:
                     self._show_config_menu()
                     continue
                 
+                if query.lower() == 'trace':
+                    tracing.print_summary()
+                    if tracing.is_enabled():
+                        n_events = tracing.export_chrome_trace("rag_trace.json")
+                        print(f"💾 {n_events} 个span已导出到 rag_trace.json（chrome://tracing 打开）")
+                    continue
+                
+                # 追问先改写成独立问题再检索；独立问题不带历史，仍然可以命中答案缓存
+                retrieval_query, method = self.condense(query, turns)
+                history = ""
+                if retrieval_query != query:
+                    print(f"🔁 检索问题: {retrieval_query} ({method})")
+                    history = self.format_history(turns[-3:])
+                
                 # 回答问题
                 print()
                 final_result = None
-                for result in self.answer(query, stream=True, verbose=True):
+                for result in self.answer(query, stream=True, verbose=True, history=history,
+                                          retrieval_query=retrieval_query):
                     if isinstance(result, dict) and 'total_time' in result:
                         final_result = result
                 
+                if final_result is not None:
+                    turns.append((retrieval_query, final_result['answer']))
+                    turns = turns[-10:]
+                
                 print()
                 
             except KeyboardInterrupt:
@@ -447,6 +1006,11 @@ def demo():
     if choice == 'y':
         rag.interactive_mode()
     
+    if tracing.is_enabled():
+        tracing.print_summary()
+        tracing.export_chrome_trace("rag_trace.json")
+        print("💾 链路追踪已导出到 rag_trace.json")
+    
     print("\n" + "=" * 60)
     print("✅ 演示完成！")
     print("=" * 60)
@@ -463,6 +1027,18 @@ def demo():
     print("   - 探索更多优化技术")
 
 
+async def answer_concurrently(rag: ProductionRAG, queries: List[str]) -> List[Dict[str, Any]]:
+    """在一个事件循环里同时回答多个问题（answer_async 的用法示例）"""
+    async def collect(query):
+        result = None
+        async for item in rag.answer_async(query):
+            if 'total_time' in item:
+                result = item
+        return result
+    
+    return await asyncio.gather(*(collect(q) for q in queries))
+
+
 if __name__ == "__main__":
     demo()
 
@@ -9,9 +9,14 @@ RAG 交互式学习 - 亲手调参，理解原理
 """
 
 import os
+import sys
 from pathlib import Path
 import importlib.util
 
+# 链路追踪：各检索方法的耗时从 span 里读取
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "01_inference"))
+import tracing
+
 # 动态导入检索器
 current_dir = Path(__file__).parent
 retrieval_module_path = current_dir / "02_advanced_retrieval.py"
@@ -59,7 +64,8 @@ def compare_strategies(retriever, query):
     # 1. 纯向量检索
     print("1️⃣  纯向量检索 (语义理解)")
     print("-" * 60)
-    vector_results, vector_time = retriever.vector_search(query, n_results=3)
+    vector_results = retriever.vector_search(query, n_results=3)
+    vector_time = tracing.last_duration('retriever.vector_search')
     for i, result in enumerate(vector_results, 1):
         display_result(result, i)
     print(f"\n⏱️  耗时: {vector_time*1000:.0f}ms")
@@ -67,7 +73,8 @@ def compare_strategies(retriever, query):
     # 2. 纯关键词检索
     print("\n2️⃣  纯关键词检索 (精确匹配)")
     print("-" * 60)
-    keyword_results, keyword_time = retriever.keyword_search(query, n_results=3)
+    keyword_results = retriever.keyword_search(query, n_results=3)
+    keyword_time = tracing.last_duration('retriever.keyword_search')
     if keyword_results:
         for i, result in enumerate(keyword_results, 1):
             display_result(result, i)
@@ -78,7 +85,8 @@ def compare_strategies(retriever, query):
     # 3. 混合检索 (70% + 30%)
     print("\n3️⃣  混合检索 (向量70% + 关键词30%)")
     print("-" * 60)
-    hybrid_results, hybrid_time = retriever.hybrid_search(query, n_results=3)
+    hybrid_results = retriever.hybrid_search(query, n_results=3)
+    hybrid_time = tracing.last_duration('retriever.hybrid_search')
     for i, result in enumerate(hybrid_results, 1):
         display_result(result, i)
     print(f"\n⏱️  耗时: {hybrid_time*1000:.0f}ms")
@@ -86,8 +94,9 @@ def compare_strategies(retriever, query):
     # 4. 混合 + 重排序
     print("\n4️⃣  混合检索 + 重排序 (最优)")
     print("-" * 60)
-    hybrid_results_full, _ = retriever.hybrid_search(query, n_results=10)
-    reranked_results, rerank_time = retriever.rerank_results(query, hybrid_results_full, top_k=3)
+    hybrid_results_full = retriever.hybrid_search(query, n_results=10)
+    reranked_results = retriever.rerank_results(query, hybrid_results_full, top_k=3)
+    rerank_time = tracing.last_duration('retriever.rerank_results')
     for i, result in enumerate(reranked_results, 1):
         display_result(result, i)
     print(f"\n⏱️  重排序耗时: {rerank_time*1000:.0f}ms")
@@ -118,7 +127,7 @@ def experiment_weights(retriever, query):
         print(f"向量权重={vector_w}, 关键词权重={keyword_w}")
         print("-" * 60)
         
-        results, _ = retriever.hybrid_search(
+        results = retriever.hybrid_search(
             query, 
             n_results=2,
             vector_weight=vector_w,
@@ -135,7 +144,7 @@ def experiment_threshold(retriever, query):
     print(f"查询: {query}\n")
     
     # 先获取所有结果
-    results, _ = retriever.hybrid_search(query, n_results=10)
+    results = retriever.hybrid_search(query, n_results=10)
     
     thresholds = [0.2, 0.3, 0.4, 0.5, 0.6]
     
@@ -169,6 +178,7 @@ def interactive_menu():
     # 初始化检索器
     print("📦 正在加载...")
     retriever = AdvancedRetriever()
+    tracing.enable()
     
     test_queries = {
         '1': ('醉驾', '短查询'),
@@ -260,6 +270,7 @@ def quick_demo():
     
     print("📦 加载检索器...")
     retriever = AdvancedRetriever()
+    tracing.enable()
     
     # 实验1: 策略对比
     compare_strategies(retriever, "醉驾的处罚")
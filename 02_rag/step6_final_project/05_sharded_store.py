@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 分片文档库
+
+功能：
+1. 按文档名哈希把文档路由到 N 个分片（独立的持久化目录）
+2. 批量导入时并行写入各分片
+3. 跨文档检索并行扇出到所有分片，用 top-k 堆合并
+4. 单文档检索直接路由到所属分片
+
+单个集合意味着单个HNSW图和单个SQLite文件，导入和检索都受它限制；
+分片后每个分片独立建索引、独立落盘，可以随数据量横向扩展
+"""
+
+import os
+import heapq
+import zlib
+import chromadb
+from concurrent.futures import ThreadPoolExecutor
+from sentence_transformers import SentenceTransformer
+from typing import List, Dict, Any
+
+# 导入前面开发的模块
+from pathlib import Path
+import importlib.util
+
+# 动态导入同目录的模块
+current_dir = Path(__file__).parent
+manager_module_path = current_dir / "01_document_manager.py"
+spec = importlib.util.spec_from_file_location("document_manager", manager_module_path)
+document_manager = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(document_manager)
+DocumentManager = document_manager.DocumentManager
+
+
+class ShardedDocumentManager(DocumentManager):
+    """分片文档管理器：接口与 DocumentManager 一致，数据分布在多个分片上"""
+
+    def __init__(self,
+                 chroma_path: str = "./data/sharded_store",
+                 collection_name: str = "documents",
+                 num_shards: int = 4,
+                 max_workers: int = None):
+        """
+        初始化分片文档管理器
+
+        Args:
+            chroma_path: 分片根目录，每个分片位于 shard_{i} 子目录
+            collection_name: 每个分片内的集合名称
+            num_shards: 分片数（确定后不要修改，否则路由会变化）
+            max_workers: 并行读写的线程数，默认等于分片数
+        """
+        if num_shards < 1:
+            raise ValueError("num_shards 必须 >= 1")
+
+        self.num_shards = num_shards
+
+        # 初始化向量模型
+        print("📦 加载向量模型...")
+        self.embedding_model = SentenceTransformer('shibing624/text2vec-base-chinese')
+        self.embedding_model.encode_kwargs = {'normalize_embeddings': True}
+
+        # 每个分片一个独立的持久化目录（独立的SQLite和HNSW索引）
+        print(f"💾 初始化分片文档库: {chroma_path} ({num_shards} 个分片)")
+        self.clients = []
+        self.shards = []
+        for i in range(num_shards):
+            shard_path = os.path.join(chroma_path, f"shard_{i}")
+            client = chromadb.PersistentClient(path=shard_path)
+            collection = client.get_or_create_collection(
+                name=collection_name,
+                metadata={"description": "多文档RAG系统", "shard": i}
+            )
+            self.clients.append(client)
+            self.shards.append(collection)
+
+        # 兼容父类中直接使用 self.collection 的代码：指向第0个分片
+        self.client = self.clients[0]
+        self.collection = self.shards[0]
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or num_shards)
+
+        # 所有分片共用一个文档注册表（放在分片根目录）
+        self.registry = document_manager.DocumentRegistry(
+            os.path.join(chroma_path, "document_registry.sqlite3")
+        )
+        if self.registry.is_empty() and self.count() > 0:
+            print("   🔄 从各分片重建文档注册表...")
+            self.registry.rebuild(self.shards)
+
+        print(f"✅ 分片文档管理器初始化完成！当前文档块数：{self.count()}\n")
+
+    def shard_for(self, doc_name: str) -> int:
+        """
+        计算文档所属分片
+
+        使用 crc32 而不是内置 hash()，保证跨进程、跨运行结果稳定
+        """
+        return zlib.crc32(doc_name.encode('utf-8')) % self.num_shards
+
+    def _collection_for(self, doc_name: str):
+        """文档所属分片的集合（add/delete 经由父类方法路由到这里）"""
+        return self.shards[self.shard_for(doc_name)]
+
+    def count(self) -> int:
+        """所有分片的文档块总数"""
+        return sum(self.executor.map(lambda c: c.count(), self.shards))
+
+    def add_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        批量添加文档：一次向量化所有块，再并行写入各分片
+
+        Args:
+            documents: 每项是 add_document 的关键字参数字典
+                       （至少包含 content 和 doc_name）
+
+        Returns:
+            每个文档的添加结果
+        """
+        print(f"\n📚 批量导入 {len(documents)} 个文档...")
+
+        # 1. 分块并准备元数据
+        prepared_docs = [self._prepare_document(**doc) for doc in documents]
+
+        # 2. 所有块一次性向量化（大批量更快）
+        all_chunks = [chunk for p in prepared_docs for chunk in p['chunks']]
+        all_embeddings = self._encode(all_chunks) if all_chunks else []
+
+        # 3. 按分片分组
+        batches = {i: {"ids": [], "documents": [], "embeddings": [], "metadatas": []}
+                   for i in range(self.num_shards)}
+        offset = 0
+        for doc, prepared in zip(documents, prepared_docs):
+            n = len(prepared['chunks'])
+            batch = batches[self.shard_for(doc['doc_name'])]
+            batch["ids"].extend(prepared['ids'])
+            batch["documents"].extend(prepared['chunks'])
+            batch["embeddings"].extend(all_embeddings[offset:offset + n].tolist())
+            batch["metadatas"].extend(prepared['metadatas'])
+            offset += n
+
+        # 4. 并行写入各分片（等所有分片都结束，再看有没有失败的）
+        def write(shard_id):
+            batch = batches[shard_id]
+            if batch["ids"]:
+                self.shards[shard_id].add(**batch)
+            return len(batch["ids"])
+
+        futures = [self.executor.submit(write, i) for i in range(self.num_shards)]
+        errors = [f.exception() for f in futures]
+        failed = next((e for e in errors if e is not None), None)
+        if failed is not None:
+            # 和 add_document 一样撤回：已提交的分片删掉这批块，失败的分片也删一次（可能写了一部分）
+            self._rollback(batches)
+            print(f"   ❌ 写入失败，已撤回所有分片: {failed}")
+            raise failed
+
+        for shard_id, future in enumerate(futures):
+            if future.result():
+                print(f"   ✅ 分片 {shard_id}: 写入 {future.result()} 个块")
+
+        # 5. 登记到文档注册表（所有分片都已提交）：整批在一个事务里，
+        #    失败时注册表不留任何一行，只需撤回分片写入
+        try:
+            self.registry.record_many([
+                (doc['doc_name'], doc.get('doc_type', 'text'), prepared['timestamp'], prepared['ids'])
+                for doc, prepared in zip(documents, prepared_docs)
+            ])
+        except Exception:
+            self._rollback(batches)
+            raise
+
+        return [
+            {
+                "doc_name": doc['doc_name'],
+                "shard": self.shard_for(doc['doc_name']),
+                "chunks": len(prepared['chunks']),
+                "timestamp": prepared['timestamp']
+            }
+            for doc, prepared in zip(documents, prepared_docs)
+        ]
+
+    def _rollback(self, batches: Dict[int, Dict[str, list]]):
+        """删除一次批量导入准备写入各分片的块（不存在的id会被忽略）"""
+        def delete(shard_id):
+            ids = batches[shard_id]["ids"]
+            if ids:
+                self.shards[shard_id].delete(ids=ids)
+
+        for future in [self.executor.submit(delete, i) for i in range(self.num_shards)]:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"   ⚠️  撤回失败: {e}")
+
+    def search_documents(self,
+                         query: str,
+                         n_results: int = 5,
+                         doc_name: str = None) -> List[Dict[str, Any]]:
+        """
+        搜索文档
+
+        - 指定 doc_name：只查询所属分片
+        - 未指定：并行查询所有分片，每个分片取 top-n，再用堆合并出全局 top-n
+        """
+        query_embedding = self.embedding_model.encode(
+            query,
+            convert_to_numpy=True
+        ).tolist()
+
+        def search_shard(collection, where=None):
+            if collection.count() == 0:
+                return []
+            results = collection.query(
+                query_embeddings=[query_embedding],
+                n_results=n_results,
+                where=where
+            )
+            return [
+                {
+                    'id': results['ids'][0][i],
+                    'document': results['documents'][0][i],
+                    'distance': results['distances'][0][i],
+                    'metadata': results['metadatas'][0][i]
+                }
+                for i in range(len(results['ids'][0]))
+            ]
+
+        if doc_name:
+            collection = self.shards[self.shard_for(doc_name)]
+            return search_shard(collection, where={"doc_name": doc_name})
+
+        shard_results = self.executor.map(search_shard, self.shards)
+        candidates = [r for results in shard_results for r in results]
+        return heapq.nsmallest(n_results, candidates, key=lambda r: r['distance'])
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取系统统计信息（含每个分片的块数）"""
+        docs = self.list_documents()
+        shard_counts = list(self.executor.map(lambda c: c.count(), self.shards))
+
+        return {
+            "total_chunks": sum(shard_counts),
+            "total_documents": len(docs),
+            "shard_chunks": shard_counts,
+            "documents": docs
+        }
+
+    def close(self):
+        """关闭线程池和注册表"""
+        self.executor.shutdown(wait=True)
+        self.registry.close()
+
+
+def demo():
+    """演示分片文档库"""
+    print("=" * 60)
+    print("RAG最终项目 - 分片文档库演示")
+    print("=" * 60)
+
+    manager = ShardedDocumentManager(num_shards=4)
+
+    # 1. 批量导入（并行写入各分片）
+    documents = [
+        {
+            "content": "醉酒驾驶机动车的，由公安机关交通管理部门约束至酒醒，吊销机动车驾驶证，"
+                       "依法追究刑事责任；五年内不得重新取得机动车驾驶证。",
+            "doc_name": "交通法-醉驾",
+            "doc_type": "法律文本"
+        },
+        {
+            "content": "闯红灯的，一次记6分，罚款200元。超速50%以上的，处以罚款并扣12分。",
+            "doc_name": "交通法-违章",
+            "doc_type": "法律文本"
+        },
+        {
+            "content": "国家实行劳动者每日工作时间不超过八小时、平均每周工作时间不超过四十四小时的工时制度。"
+                       "用人单位应当保证劳动者每周至少休息一日。",
+            "doc_name": "劳动法-工时",
+            "doc_type": "法律文本"
+        },
+        {
+            "content": "工资应当以货币形式按月支付给劳动者本人。用人单位安排加班的，应当按照规定支付加班费。",
+            "doc_name": "劳动法-工资",
+            "doc_type": "法律文本"
+        }
+    ]
+    manager.add_documents(documents)
+
+    # 2. 分片分布
+    print("\n" + "=" * 60)
+    print("📊 分片分布")
+    print("=" * 60)
+    stats = manager.get_stats()
+    for i, n in enumerate(stats['shard_chunks']):
+        print(f"   分片 {i}: {n} 个块")
+    for doc in stats['documents']:
+        print(f"   📄 {doc['doc_name']} → 分片 {manager.shard_for(doc['doc_name'])}")
+
+    # 3. 跨分片检索
+    print("\n" + "=" * 60)
+    print("🔍 跨分片检索（并行扇出 + 堆合并）")
+    print("=" * 60)
+    for query in ["醉驾的处罚", "加班费"]:
+        print(f"\n问题: {query}")
+        for i, result in enumerate(manager.search_documents(query, n_results=2), 1):
+            print(f"   {i}. [{result['metadata']['doc_name']}] "
+                  f"(距离 {result['distance']:.3f}) {result['document'][:40]}...")
+
+    # 4. 单文档检索（直接路由）
+    print("\n" + "=" * 60)
+    print("🎯 单文档检索（只访问所属分片）")
+    print("=" * 60)
+    results = manager.search_documents("罚款", n_results=2, doc_name="交通法-违章")
+    for i, result in enumerate(results, 1):
+        print(f"   {i}. {result['document'][:60]}...")
+
+    manager.close()
+
+    print("\n" + "=" * 60)
+    print("✅ 演示完成！")
+    print("=" * 60)
+    print("\n💡 学到的知识:")
+    print("   1. 分片：每个分片独立的HNSW索引和SQLite文件")
+    print("   2. 路由：crc32(doc_name) % N，稳定且无需查表")
+    print("   3. 扇出：并行查询所有分片，堆合并得到全局top-k")
+    print("   4. 定向：单文档操作只访问一个分片")
+
+
+if __name__ == "__main__":
+    demo()
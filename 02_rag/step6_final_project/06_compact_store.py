@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 向量库压缩与空间回收
+
+ChromaDB 持久化目录只会越变越大：
+- 删除文档块后，HNSW索引里仍保留被标记删除的向量
+- 删除/重建集合后（例如 04_performance.py 的 test_batch_*），
+  旧的分段目录可能留在磁盘上
+- SQLite 删除数据后不会自动把空闲页还给文件系统
+
+这些残留会让冷启动（加载索引）变慢。本工具：
+1. 用存活的向量重建集合的索引
+2. VACUUM SQLite 文件
+3. 删除不再被任何集合引用的分段目录（孤儿目录）
+4. 报告回收的字节数，以及压缩前后的加载时间和检索延迟
+
+用法：
+    python 06_compact_store.py ./data/document_store
+    python 06_compact_store.py ./data/document_store --collection documents
+    python 06_compact_store.py ../step4_vectorstore/data/chroma_performance_test --dry-run
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import subprocess
+import statistics
+from typing import List, Dict, Any
+
+# 分段目录名是UUID
+SEGMENT_DIR_PATTERN = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+)
+TMP_SUFFIX = "__compact_tmp"
+
+
+def dir_size(path: str) -> int:
+    """目录总字节数"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def format_bytes(n: int) -> str:
+    """字节数转为易读格式"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+def live_segment_ids(chroma_path: str) -> set:
+    """SQLite 中登记的分段id（仍被集合引用）"""
+    db_path = os.path.join(chroma_path, "chroma.sqlite3")
+    if not os.path.exists(db_path):
+        return set()
+    conn = sqlite3.connect(db_path)
+    try:
+        return {row[0] for row in conn.execute("SELECT id FROM segments")}
+    finally:
+        conn.close()
+
+
+def find_orphan_segment_dirs(chroma_path: str) -> List[str]:
+    """找出磁盘上存在、但没有被任何集合引用的分段目录"""
+    live = live_segment_ids(chroma_path)
+    orphans = []
+    for name in os.listdir(chroma_path):
+        full = os.path.join(chroma_path, name)
+        if os.path.isdir(full) and SEGMENT_DIR_PATTERN.match(name) and name not in live:
+            orphans.append(full)
+    return orphans
+
+
+def measure_store(chroma_path: str,
+                  collection_name: str,
+                  n_queries: int = 20) -> Dict[str, Any]:
+    """
+    测量冷启动加载时间和检索延迟
+
+    ChromaDB 在同一进程内会复用已加载的客户端，所以放到子进程里测，
+    每次测量都是真正的冷启动
+
+    Returns:
+        {'load_time', 'query_avg', 'query_p50', 'count'}（时间单位：秒）
+    """
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--measure",
+         chroma_path, "--collection", collection_name,
+         "--queries", str(n_queries)],
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _measure_in_process(chroma_path: str, collection_name: str, n_queries: int) -> Dict[str, Any]:
+    """子进程中执行的测量逻辑（见 measure_store）"""
+    import chromadb
+
+    start = time.perf_counter()
+    client = chromadb.PersistentClient(path=chroma_path)
+    collection = client.get_collection(name=collection_name)
+    count = collection.count()
+
+    # 用库里已有的向量作为查询，不需要加载embedding模型
+    sample = collection.get(limit=n_queries, include=["embeddings"])
+    embeddings = [list(e) for e in sample['embeddings']] if count else []
+
+    # 第一次查询会触发索引加载，计入冷启动时间
+    if embeddings:
+        collection.query(query_embeddings=[embeddings[0]], n_results=1, include=["distances"])
+    load_time = time.perf_counter() - start
+
+    times = []
+    for embedding in embeddings:
+        t = time.perf_counter()
+        collection.query(query_embeddings=[embedding], n_results=min(10, count),
+                         include=["distances"])
+        times.append(time.perf_counter() - t)
+
+    return {
+        'count': count,
+        'load_time': load_time,
+        'query_avg': statistics.mean(times) if times else 0.0,
+        'query_p50': statistics.median(times) if times else 0.0
+    }
+
+
+def _copy_collection(source, target, batch_size: int) -> int:
+    """分页把 source 的所有数据复制到 target"""
+    copied = 0
+    offset = 0
+    while True:
+        page = source.get(
+            limit=batch_size,
+            offset=offset,
+            include=["embeddings", "documents", "metadatas"]
+        )
+        if not page['ids']:
+            break
+        target.add(
+            ids=page['ids'],
+            embeddings=[list(e) for e in page['embeddings']],
+            documents=page['documents'],
+            metadatas=page['metadatas']
+        )
+        copied += len(page['ids'])
+        offset += batch_size
+    return copied
+
+
+def rebuild_collection(client, name: str, batch_size: int = 500) -> int:
+    """
+    用存活的向量重建集合
+
+    先完整复制到临时集合，再删除并重建原集合。中途失败时临时集合
+    仍然保有全部数据，可以手动恢复
+
+    Returns:
+        重建后的向量数
+    """
+    source = client.get_collection(name=name)
+    metadata = source.metadata
+
+    try:
+        client.delete_collection(name=name + TMP_SUFFIX)
+    except Exception:
+        pass
+    tmp = client.create_collection(name=name + TMP_SUFFIX, metadata=metadata)
+    _copy_collection(source, tmp, batch_size)
+    if tmp.count() != source.count():
+        raise RuntimeError(f"复制到临时集合的数量不一致: {tmp.count()} != {source.count()}")
+
+    client.delete_collection(name=name)
+    rebuilt = client.create_collection(name=name, metadata=metadata)
+    count = _copy_collection(tmp, rebuilt, batch_size)
+    client.delete_collection(name=name + TMP_SUFFIX)
+    return count
+
+
+def vacuum_sqlite(chroma_path: str):
+    """把SQLite的空闲页还给文件系统"""
+    db_path = os.path.join(chroma_path, "chroma.sqlite3")
+    if not os.path.exists(db_path):
+        return
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def compact_store(chroma_path: str,
+                  collections: List[str] = None,
+                  dry_run: bool = False,
+                  n_queries: int = 20) -> Dict[str, Any]:
+    """
+    压缩一个ChromaDB持久化目录
+
+    Args:
+        chroma_path: 持久化目录
+        collections: 需要重建的集合（默认全部）
+        dry_run: 只统计，不修改
+        n_queries: 测量检索延迟的查询次数
+
+    Returns:
+        压缩报告
+    """
+    import chromadb
+
+    client = chromadb.PersistentClient(path=chroma_path)
+    names = collections or [c.name if hasattr(c, "name") else c for c in client.list_collections()]
+    names = [n for n in names if not n.endswith(TMP_SUFFIX)]
+
+    size_before = dir_size(chroma_path)
+    orphans = find_orphan_segment_dirs(chroma_path)
+
+    report = {
+        'path': chroma_path,
+        'size_before': size_before,
+        'orphan_dirs': len(orphans),
+        'orphan_bytes': sum(dir_size(p) for p in orphans),
+        'collections': {}
+    }
+
+    before = {name: measure_store(chroma_path, name, n_queries) for name in names}
+
+    if dry_run:
+        report['size_after'] = size_before
+        for name in names:
+            report['collections'][name] = {'before': before[name], 'after': None}
+        return report
+
+    # 1. 重建索引
+    for name in names:
+        print(f"   🔄 重建集合: {name} ({before[name]['count']} 个向量)")
+        rebuild_collection(client, name)
+
+    # 2. 释放客户端再处理磁盘文件
+    del client
+    try:
+        chromadb.api.client.SharedSystemClient.clear_system_cache()
+    except AttributeError:
+        pass
+
+    # 3. 删除孤儿分段目录（重建后原集合的旧目录也成为孤儿）
+    for path in find_orphan_segment_dirs(chroma_path):
+        print(f"   🗑️  删除孤儿分段目录: {os.path.basename(path)}")
+        shutil.rmtree(path, ignore_errors=True)
+
+    # 4. VACUUM
+    print("   🧹 VACUUM SQLite...")
+    vacuum_sqlite(chroma_path)
+
+    report['size_after'] = dir_size(chroma_path)
+    for name in names:
+        report['collections'][name] = {
+            'before': before[name],
+            'after': measure_store(chroma_path, name, n_queries)
+        }
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    """打印压缩报告"""
+    reclaimed = report['size_before'] - report['size_after']
+
+    print("\n" + "=" * 60)
+    print(f"📊 压缩报告: {report['path']}")
+    print("=" * 60)
+    print(f"   压缩前: {format_bytes(report['size_before'])}")
+    print(f"   压缩后: {format_bytes(report['size_after'])}")
+    print(f"   回收:   {format_bytes(reclaimed)} ({reclaimed} 字节)")
+    print(f"   孤儿目录: {report['orphan_dirs']} 个 ({format_bytes(report['orphan_bytes'])})")
+
+    print(f"\n{'集合':<24} {'加载(前)':>10} {'加载(后)':>10} {'检索(前)':>10} {'检索(后)':>10}")
+    print("-" * 68)
+    for name, stats in report['collections'].items():
+        before, after = stats['before'], stats['after']
+        if after is None:
+            print(f"{name:<24} {before['load_time']*1000:>8.1f}ms {'-':>10} "
+                  f"{before['query_avg']*1000:>8.2f}ms {'-':>10}")
+        else:
+            print(f"{name:<24} {before['load_time']*1000:>8.1f}ms {after['load_time']*1000:>8.1f}ms "
+                  f"{before['query_avg']*1000:>8.2f}ms {after['query_avg']*1000:>8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压缩ChromaDB持久化目录并回收空间")
+    parser.add_argument("chroma_path", help="ChromaDB持久化目录")
+    parser.add_argument("--collection", action="append", dest="collections",
+                        help="只重建指定集合（可多次指定，默认全部）")
+    parser.add_argument("--dry-run", action="store_true", help="只统计，不修改")
+    parser.add_argument("--queries", type=int, default=20, help="测量检索延迟的查询次数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出报告")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        # 子进程测量模式（见 measure_store）
+        name = args.collections[0]
+        print(json.dumps(_measure_in_process(args.chroma_path, name, args.queries)))
+        return
+
+    if not os.path.isdir(args.chroma_path):
+        print(f"❌ 目录不存在: {args.chroma_path}")
+        sys.exit(1)
+
+    print("=" * 60)
+    print(f"🗜️  压缩向量库: {args.chroma_path}" + ("（dry-run）" if args.dry_run else ""))
+    print("=" * 60)
+
+    report = compact_store(
+        args.chroma_path,
+        collections=args.collections,
+        dry_run=args.dry_run,
+        n_queries=args.queries
+    )
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 语义答案缓存
+
+很多用户问的是同一个问题的不同说法：
+    "醉驾会受到什么处罚"  vs  "喝醉了开车会被怎么处罚"
+
+答案缓存放在 ProductionRAG.answer 前面：
+1. 用问题向量在历史问题的小型向量索引里找最相似的问题
+2. 相似度超过阈值，并且这次检索到的文档块id和当时完全相同，
+   就直接回放缓存的答案（仍然以流式输出），完全跳过LLM
+3. 缓存条目绑定"版本"（集合状态 + LLM配置），版本变化后自动失效
+
+文档块id里带有导入时间戳，文档更新后id会变，检索结果对不上，
+旧答案自然不会命中
+
+lookup 在线程池里执行，store 在事件循环或其他会话的线程里执行，
+所有读写都在 self.lock 里进行（条目列表和向量矩阵必须一起更新）
+"""
+
+import time
+import threading
+import numpy as np
+from typing import List, Dict, Any, Optional
+
+
+class SemanticAnswerCache:
+    """基于问题向量相似度的答案缓存"""
+
+    def __init__(self, threshold: float = 0.92, capacity: int = 1000):
+        """
+        Args:
+            threshold: 命中所需的最低余弦相似度
+            capacity: 最多缓存多少条答案（超出后淘汰最久未使用的）
+        """
+        self.threshold = threshold
+        self.capacity = capacity
+        self.entries: List[Dict[str, Any]] = []
+        self.matrix: Optional[np.ndarray] = None  # 每行一个归一化的问题向量
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def lookup(self,
+               query_embedding,
+               chunk_ids: List[str],
+               version,
+               threshold: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        查找可以复用的答案
+
+        Args:
+            query_embedding: 问题向量
+            chunk_ids: 本次检索到的文档块id
+            version: 当前版本（集合状态 + LLM配置）
+            threshold: 本次查询的相似度阈值（默认用构造时的阈值；
+                       缓存被多个会话共用，不要改 self.threshold）
+
+        Returns:
+            命中的缓存条目（含 'answer'、'query'、'similarity'），未命中返回None
+        """
+        if threshold is None:
+            threshold = self.threshold
+        query_vector = self._normalize(query_embedding)
+        target_ids = frozenset(chunk_ids)
+
+        with self.lock:
+            if not self.entries:
+                self.stats['misses'] += 1
+                return None
+
+            similarities = self.matrix @ query_vector
+
+            # 从最相似的开始检查
+            for index in np.argsort(-similarities):
+                similarity = float(similarities[index])
+                if similarity < threshold:
+                    break
+                entry = self.entries[index]
+                if entry['version'] == version and entry['chunk_ids'] == target_ids:
+                    entry['last_used'] = time.time()
+                    entry['hits'] += 1
+                    self.stats['hits'] += 1
+                    return {**entry, 'similarity': similarity}
+
+            self.stats['misses'] += 1
+            return None
+
+    def store(self,
+              query: str,
+              query_embedding,
+              chunk_ids: List[str],
+              version,
+              answer: str):
+        """缓存一条答案"""
+        if not answer.strip():
+            return
+
+        entry = {
+            'query': query,
+            'chunk_ids': frozenset(chunk_ids),
+            'version': version,
+            'answer': answer,
+            'created': time.time(),
+            'last_used': time.time(),
+            'hits': 0
+        }
+        vector = self._normalize(query_embedding)[None, :]
+
+        with self.lock:
+            self.entries.append(entry)
+            self.matrix = vector if self.matrix is None else np.vstack([self.matrix, vector])
+
+            if len(self.entries) > self.capacity:
+                self._evict(len(self.entries) - self.capacity)
+
+    def _evict(self, n: int):
+        """淘汰最久未使用的 n 条（调用方持有 self.lock）"""
+        order = sorted(range(len(self.entries)), key=lambda i: self.entries[i]['last_used'])
+        self._keep(sorted(order[n:]))
+
+    def _keep(self, indices: List[int]):
+        self.entries = [self.entries[i] for i in indices]
+        self.matrix = self.matrix[indices] if indices else None
+
+    def invalidate(self, version=None):
+        """
+        清除缓存
+
+        Args:
+            version: 只保留这个版本的条目；不传则全部清除
+        """
+        with self.lock:
+            if version is None:
+                self.entries = []
+                self.matrix = None
+            else:
+                self._keep([i for i, e in enumerate(self.entries) if e['version'] == version])
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+def demo():
+    """用随机向量演示命中条件"""
+    print("=" * 60)
+    print("RAG最终项目 - 语义答案缓存演示")
+    print("=" * 60)
+
+    rng = np.random.default_rng(0)
+    cache = SemanticAnswerCache(threshold=0.9)
+
+    base = rng.normal(size=768)
+    paraphrase = base + rng.normal(scale=0.1, size=768)  # 意思相近的问法
+    unrelated = rng.normal(size=768)
+
+    cache.store("醉驾会受到什么处罚", base, ["交通法_0", "交通法_1"], "v1",
+                "醉酒驾驶机动车的，吊销驾驶证，依法追究刑事责任……")
+
+    cases = [
+        ("喝醉了开车会被怎么处罚", paraphrase, ["交通法_1", "交通法_0"], "v1"),
+        ("喝醉了开车会被怎么处罚（检索结果不同）", paraphrase, ["交通法_5"], "v1"),
+        ("喝醉了开车会被怎么处罚（版本变化）", paraphrase, ["交通法_0", "交通法_1"], "v2"),
+        ("闯红灯扣几分", unrelated, ["交通法_0", "交通法_1"], "v1"),
+    ]
+    for query, embedding, chunk_ids, version in cases:
+        hit = cache.lookup(embedding, chunk_ids, version)
+        status = f"✅ 命中 (相似度 {hit['similarity']:.2f})" if hit else "❌ 未命中"
+        print(f"\n问题: {query}")
+        print(f"   {status}")
+
+    print(f"\n📊 命中 {cache.stats['hits']} 次，未命中 {cache.stats['misses']} 次")
+
+
+if __name__ == "__main__":
+    demo()
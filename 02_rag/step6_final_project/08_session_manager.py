@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 多会话服务层
+
+ProductionRAG.interactive_mode 和 05_interactive_qa 一次只服务一个用户。
+SessionManager 让很多会话共享同一个检索器和模型，每个会话有自己的：
+- 对话历史（放进提示词，支持追问）
+- KV缓存状态：本进程内的 Llama 在每轮结束后保存状态，同一会话的下一轮
+  恢复后可以复用"说明 + 之前的对话历史"这段前缀，不用重新预填充
+- 配置覆盖（n_results、llm_temperature 等，只影响这个会话）
+
+空闲会话的淘汰：
+- TTL：超过 ttl 秒没有活动的会话整个删除
+- 内存预算：常驻内存（KV状态 + 历史）超过预算时，先丢弃最久未用会话的KV状态，
+  仍然超出再删除整个会话
+淘汰次数、常驻内存、活跃会话数通过 metrics() 获取。
+
+    manager = SessionManager(rag, memory_budget_mb=512, ttl=1800)
+    sid = manager.create(llm_temperature=0.1)
+    for chunk in manager.ask(sid, "醉驾怎么处罚？"):
+        ...
+"""
+
+import copy
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Any, Optional
+
+from pathlib import Path
+import importlib.util
+
+# 动态导入同目录的模块
+current_dir = Path(__file__).parent
+rag_module_path = current_dir / "03_rag_application.py"
+spec = importlib.util.spec_from_file_location("rag_application", rag_module_path)
+rag_application = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rag_application)
+ProductionRAG = rag_application.ProductionRAG
+
+
+class RAGSession:
+    """一个用户会话的状态"""
+
+    def __init__(self, session_id: str, config: Dict[str, Any], max_turns: int):
+        self.session_id = session_id
+        self.config = config                      # 只包含覆盖项
+        self.turns = deque(maxlen=max_turns)      # [{'query', 'retrieval_query', 'answer'}]
+        self.kv_state = None                      # Llama.save_state() 的结果
+        self.created_at = time.time()
+        self.last_active = self.created_at
+        self.n_requests = 0
+        self.lock = threading.Lock()              # 同一会话的请求按顺序处理
+        self.async_lock = None                    # ask_async 的排队（事件循环里创建）
+        self.rag = None                           # 带本会话配置的 ProductionRAG 视图
+
+    def kv_bytes(self) -> int:
+        if self.kv_state is None:
+            return 0
+        return int(getattr(self.kv_state, 'llama_state_size', 0))
+
+    def history_bytes(self) -> int:
+        return sum(len(t['query'].encode('utf-8')) + len(t['answer'].encode('utf-8')) for t in self.turns)
+
+    def memory_bytes(self) -> int:
+        return self.kv_bytes() + self.history_bytes()
+
+    def history_text(self, max_chars: int) -> str:
+        """最近几轮对话（从新往旧取，总长度不超过 max_chars）"""
+        return ProductionRAG.format_history([(t['query'], t['answer']) for t in self.turns], max_chars)
+
+    def condense(self, query: str):
+        """追问改写成检索用的独立问题"""
+        return self.rag.condense(query, [(t['retrieval_query'], t['answer']) for t in self.turns])
+
+
+class SessionManager:
+    """共享检索器和模型的多会话服务层"""
+
+    def __init__(self,
+                 rag: ProductionRAG,
+                 memory_budget_mb: float = 512,
+                 ttl: float = 1800,
+                 max_turns: int = 10,
+                 history_chars: int = 1500,
+                 sweep_interval: float = 30):
+        """
+        Args:
+            rag: 共享的 ProductionRAG（检索器、模型、缓存都只有一份）
+            memory_budget_mb: 所有会话常驻内存（KV状态 + 历史）的上限
+            ttl: 会话空闲多久后删除（秒）
+            max_turns: 每个会话保留的对话轮数
+            history_chars: 放进提示词的历史最多多少字
+            sweep_interval: 两次TTL检查的最小间隔（秒）
+        """
+        self.rag = rag
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.history_chars = history_chars
+        self.sweep_interval = sweep_interval
+
+        self.sessions: "OrderedDict[str, RAGSession]" = OrderedDict()   # 最近使用的在最后
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.local = hasattr(rag.llm, 'save_state')
+
+        self.stats = {
+            'created': 0,
+            'requests': 0,
+            'kv_restores': 0,
+            'kv_reuses': 0,
+            'evictions': {'ttl': 0, 'memory': 0, 'kv_memory': 0, 'closed': 0}
+        }
+
+    # ---------------- 会话管理 ----------------
+
+    def create(self, session_id: Optional[str] = None, **config_overrides) -> str:
+        """
+        创建会话
+
+        Args:
+            session_id: 会话id，不传则自动生成
+            **config_overrides: 覆盖 ProductionRAG.config 中的项（只影响这个会话）
+
+        Returns:
+            会话id
+        """
+        unknown = set(config_overrides) - set(self.rag.config)
+        if unknown:
+            raise ValueError(f"未知的配置项: {', '.join(sorted(unknown))}")
+
+        session_id = session_id or uuid.uuid4().hex[:12]
+        session = RAGSession(session_id, dict(config_overrides), self.max_turns)
+        session.rag = self._session_view(session)
+
+        with self._lock:
+            if session_id in self.sessions:
+                raise ValueError(f"会话已存在: {session_id}")
+            self.sessions[session_id] = session
+            self.stats['created'] += 1
+        self._sweep()
+        return session_id
+
+    def get(self, session_id: str) -> RAGSession:
+        """取得会话并标记为最近使用；会话不存在（或已被淘汰）时抛出 KeyError"""
+        self._sweep()
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise KeyError(f"会话不存在或已过期: {session_id}")
+            self.sessions.move_to_end(session_id)
+            session.last_active = time.time()
+            return session
+
+    def close(self, session_id: str):
+        """主动结束会话"""
+        with self._lock:
+            if self.sessions.pop(session_id, None) is not None:
+                self.stats['evictions']['closed'] += 1
+
+    def _session_view(self, session: RAGSession) -> ProductionRAG:
+        """
+        共享模型、检索器和缓存，但配置独立的 ProductionRAG 浅拷贝
+
+        生成时先恢复本会话的KV状态，结束后保存
+        """
+        view = copy.copy(self.rag)
+        view.config = {**self.rag.config, **session.config}
+        base_generate = type(self.rag).generate
+
+        def generate(prompt, stream=True):
+            with view._llm_lock:
+                self._restore_kv(session)
+                yield from base_generate(view, prompt, stream=stream)
+                self._save_kv(session)
+
+        view.generate = generate
+        return view
+
+    # ---------------- KV状态 ----------------
+
+    def _restore_kv(self, session: RAGSession):
+        state = session.kv_state
+        if not self.local or state is None:
+            return
+        llm = self.rag.llm
+        n = state.n_tokens
+        # 模型里还是这个会话上一轮的状态（中间没有别的会话用过）就不用恢复
+        if llm.n_tokens >= n and list(llm.input_ids[:n]) == list(state.input_ids[:n]):
+            self.stats['kv_reuses'] += 1
+        else:
+            llm.load_state(state)
+            self.stats['kv_restores'] += 1
+
+    def _save_kv(self, session: RAGSession):
+        if not self.local:
+            return
+        with self._lock:
+            if session.session_id not in self.sessions:
+                return          # 生成期间会话被淘汰了
+        session.kv_state = self.rag.llm.save_state()
+        self._enforce_budget(keep=session.session_id)
+
+    # ---------------- 淘汰 ----------------
+
+    def _sweep(self, force: bool = False):
+        """删除超过TTL的会话（最多每 sweep_interval 秒检查一次）"""
+        now = time.time()
+        if not force and now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        with self._lock:
+            # OrderedDict 按最近使用排序，过期的都在最前面
+            while self.sessions:
+                session_id, session = next(iter(self.sessions.items()))
+                if now - session.last_active < self.ttl or session.lock.locked():
+                    break
+                self.sessions.popitem(last=False)
+                self.stats['evictions']['ttl'] += 1
+
+    def _enforce_budget(self, keep: Optional[str] = None):
+        """超出内存预算：先丢最久未用会话的KV状态，不够再删除整个会话（keep 除外）"""
+        with self._lock:
+            total = sum(s.memory_bytes() for s in self.sessions.values())
+            if total <= self.memory_budget:
+                return
+            for session in list(self.sessions.values()):
+                if total <= self.memory_budget:
+                    return
+                if session.kv_state is not None and session.session_id != keep:
+                    total -= session.kv_bytes()
+                    session.kv_state = None
+                    self.stats['evictions']['kv_memory'] += 1
+            for session_id, session in list(self.sessions.items()):
+                if total <= self.memory_budget:
+                    return
+                if session_id == keep or session.lock.locked():
+                    continue
+                total -= session.memory_bytes()
+                del self.sessions[session_id]
+                self.stats['evictions']['memory'] += 1
+
+    # ---------------- 问答 ----------------
+
+    def ask(self, session_id: str, query: str, verbose: bool = False):
+        """
+        在会话中提问（流式）
+
+        Yields:
+            与 ProductionRAG.answer(stream=True) 相同：流式片段，最后是完整结果
+        """
+        session = self.get(session_id)
+        with session.lock:
+            history = session.history_text(self.history_chars)
+            retrieval_query, _ = session.condense(query)
+            result = None
+            for item in session.rag.answer(query, stream=True, verbose=verbose, history=history,
+                                           retrieval_query=retrieval_query):
+                if 'total_time' in item:
+                    result = item
+                yield item
+            self._finish(session, query, retrieval_query, result)
+
+    async def ask_async(self, session_id: str, query: str):
+        """
+        在会话中提问（异步流式，基于 ProductionRAG.answer_async）
+
+        回答在单独的任务里生成，会话锁由这个任务持有，不跨越交给调用方的 yield：
+        调用方中途放弃（break、没有 aclose 就丢掉生成器、任务被取消）时，
+        生成任务被取消并释放锁，不会让会话一直处于占用状态
+        """
+        session = self.get(session_id)
+        items = asyncio.Queue()
+        producer = asyncio.ensure_future(self._answer_async(session, query, items))
+        try:
+            while True:
+                item = await items.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            if not producer.done():
+                producer.cancel()
+
+    async def _answer_async(self, session: RAGSession, query: str, items: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        try:
+            await self._acquire_async(session)
+            try:
+                history = session.history_text(self.history_chars)
+                # 规则改写是微秒级的；需要LLM兜底时不能阻塞事件循环
+                retrieval_query, _ = await loop.run_in_executor(None, session.condense, query)
+                result = None
+                stream = session.rag.answer_async(query, history=history, retrieval_query=retrieval_query)
+                try:
+                    async for item in stream:
+                        if 'total_time' in item:
+                            result = item
+                        items.put_nowait(item)
+                finally:
+                    await stream.aclose()
+                self._finish(session, query, retrieval_query, result)
+            finally:
+                session.lock.release()
+                session.async_lock.release()
+        except Exception as e:
+            items.put_nowait(e)
+        finally:
+            items.put_nowait(None)
+
+    @staticmethod
+    async def _acquire_async(session: RAGSession):
+        """
+        取得会话锁，可以安全地取消
+
+        异步请求先在 asyncio.Lock 上排队（不占线程）；轮到之后再拿 session.lock，
+        它只会被同步的 ask() 占用，这时每隔10毫秒重试一次
+        """
+        if session.async_lock is None:
+            session.async_lock = asyncio.Lock()
+        await session.async_lock.acquire()
+        try:
+            while not session.lock.acquire(blocking=False):
+                await asyncio.sleep(0.01)
+        except BaseException:
+            session.async_lock.release()
+            raise
+
+    def _finish(self, session: RAGSession, query: str, retrieval_query: str, result: Optional[Dict[str, Any]]):
+        if result is None:
+            return
+        session.turns.append({'query': query, 'retrieval_query': retrieval_query, 'answer': result['answer']})
+        session.n_requests += 1
+        session.last_active = time.time()
+        self.stats['requests'] += 1
+        self._enforce_budget(keep=session.session_id)
+
+    # ---------------- 监控 ----------------
+
+    def metrics(self) -> Dict[str, Any]:
+        """活跃会话数、常驻内存、淘汰次数等"""
+        self._sweep()
+        with self._lock:
+            sessions = list(self.sessions.values())
+        resident = sum(s.memory_bytes() for s in sessions)
+        return {
+            'active_sessions': len(sessions),
+            'busy_sessions': sum(1 for s in sessions if s.lock.locked()),
+            'kv_states': sum(1 for s in sessions if s.kv_state is not None),
+            'resident_bytes': resident,
+            'resident_mb': resident / 1024 / 1024,
+            'memory_budget_mb': self.memory_budget / 1024 / 1024,
+            'created': self.stats['created'],
+            'requests': self.stats['requests'],
+            'kv_restores': self.stats['kv_restores'],
+            'kv_reuses': self.stats['kv_reuses'],
+            'evictions': dict(self.stats['evictions'])
+        }
+
+
+def print_metrics(metrics: Dict[str, Any]):
+    print("\n📊 会话指标:")
+    print(f"   活跃会话: {metrics['active_sessions']} (处理中 {metrics['busy_sessions']}, "
+          f"有KV状态 {metrics['kv_states']})")
+    print(f"   常驻内存: {metrics['resident_mb']:.1f}MB / {metrics['memory_budget_mb']:.0f}MB")
+    print(f"   请求: {metrics['requests']} | KV恢复: {metrics['kv_restores']} | "
+          f"KV直接复用: {metrics['kv_reuses']}")
+    evictions = metrics['evictions']
+    print(f"   淘汰: TTL {evictions['ttl']}, 内存 {evictions['memory']}, "
+          f"KV状态 {evictions['kv_memory']}, 主动关闭 {evictions['closed']}")
+
+
+def demo():
+    """演示：两个会话交替提问（各自的历史和配置）"""
+    import os
+
+    print("=" * 60)
+    print("RAG最终项目 - 多会话服务层演示")
+    print("=" * 60)
+
+    model_path = os.path.expanduser("~/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf")
+    if not os.path.exists(model_path):
+        print(f"\n❌ 模型文件不存在: {model_path}")
+        return
+
+    rag = ProductionRAG(model_path=model_path)
+    manager = SessionManager(rag, memory_budget_mb=256, ttl=600)
+
+    alice = manager.create(llm_temperature=0.1)
+    bob = manager.create(n_results=3)
+
+    conversation = [
+        (alice, "醉驾会受到什么处罚？"),
+        (bob, "劳动者的工作时间有什么规定？"),
+        (alice, "那会吊销驾照吗？"),
+        (bob, "加班工资怎么算？"),
+    ]
+
+    for session_id, query in conversation:
+        print(f"\n👤 [{session_id}] {query}")
+        print("🤖 ", end="")
+        for item in manager.ask(session_id, query):
+            if 'total_time' in item:
+                print(f"\n   ⏱️  {item['total_time']*1000:.0f}ms")
+            else:
+                print(item['text'], end="", flush=True)
+
+    print_metrics(manager.metrics())
+
+
+if __name__ == "__main__":
+    demo()
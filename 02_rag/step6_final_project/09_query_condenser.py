@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 追问改写（查询压缩）
+
+交互模式里的追问往往不完整：
+    用户：醉驾会受到什么处罚？
+    用户：那罚多少钱？          ← 直接拿去检索，命中的内容基本无关
+
+QueryCondenser 在检索前把追问改写成独立的问题：
+1. 规则/模板（不调用模型，微秒级）
+   - "酒驾呢？"        → 沿用上一问的谓语："酒驾会受到什么处罚？"
+   - "那罚多少钱？"    → 去掉承接词、补上主题："醉驾罚多少钱？"
+   - "它要扣几分？"    → 代词替换成主题："醉驾要扣几分？"
+2. 规则判断是追问但拿不准时，才用一次很短的LLM调用改写（max_tokens 很小）
+3. 结果按 (历史哈希, 问题) 记忆，同一会话里重复的追问不再计算
+
+改写后的问题只用于检索；提示词里仍然是用户的原话加对话历史。
+"""
+
+import re
+import hashlib
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+
+# 句首承接词：说明这句话接着上一问（长的在前，"那请问"不能被"那"截断）
+LEADING_CONNECTIVES = tuple(sorted(("那么", "那如果", "那要是", "那", "还有", "另外", "再问一下", "那请问", "所以"),
+                                   key=len, reverse=True))
+# 指代上一问主题的代词：多字的按整词匹配
+PRONOUNS = ("这种情况", "这种行为", "这个", "那个", "这样", "上述")
+# 单字代词只在分句开头算数，"应该""其他""其中"里的字不是代词
+SINGLE_CHAR_PRONOUNS = ("它", "其", "该")
+_SINGLE_CHAR_PRONOUN = re.compile(r"(?:^|(?<=[，,；;]))\s*([%s])(?![他它中余实次])" % "".join(SINGLE_CHAR_PRONOUNS))
+# 指向上一问、但不能直接换成主题的词（"其中哪些……"），交给LLM
+REFERRING_WORDS = ("其中", "其他", "其它", "其余")
+# 疑问词：问题的"谓语"从这里开始
+QUESTION_WORDS = ("什么", "怎么", "如何", "哪些", "哪", "多少", "几", "是否", "吗", "能不能", "可不可以", "有没有")
+# 主题末尾可以去掉的助动词/介词
+TOPIC_TRAILING = ("会受到", "会被", "应该", "需要", "要被", "会", "要", "被", "的", "是", "有", "应", "该", "受到")
+
+CONDENSE_PROMPT = """<|im_start|>system
+把用户的追问改写成一个可以独立理解的完整问题，只输出改写后的问题。<|im_end|>
+<|im_start|>user
+对话：
+{history}
+追问：{question}<|im_end|>
+<|im_start|>assistant
+"""
+
+_PUNCTUATION = "？?。.！!，, "
+
+
+def _strip_question(text: str) -> str:
+    return text.strip().rstrip(_PUNCTUATION)
+
+
+def find_pronoun(text: str) -> Optional[Tuple[str, int]]:
+    """
+    找出指代上一问主题的代词
+
+    Returns:
+        (代词, 位置)，没有时返回 None
+    """
+    found = [(text.find(p), p) for p in PRONOUNS if p in text]
+    m = _SINGLE_CHAR_PRONOUN.search(text)
+    if m:
+        found.append((m.start(1), m.group(1)))
+    if not found:
+        return None
+    position, pronoun = min(found)
+    return pronoun, position
+
+
+def split_topic(query: str) -> Tuple[str, str]:
+    """
+    把独立问题拆成 (主题, 谓语)
+
+        "醉驾会受到什么处罚？" → ("醉驾", "会受到什么处罚？")
+    找不到疑问词时返回 ("", query)
+    """
+    text = query.strip()
+    positions = [text.find(w) for w in QUESTION_WORDS if w in text]
+    if not positions:
+        return "", text
+    cut = min(positions)
+    topic = text[:cut]
+    # 去掉主题末尾的助动词（可能有好几个，如"会受到"）
+    changed = True
+    while changed:
+        changed = False
+        for word in TOPIC_TRAILING:
+            if topic.endswith(word) and len(topic) > len(word):
+                topic = topic[:-len(word)]
+                changed = True
+    topic = topic.strip(_PUNCTUATION)
+    return topic, text[len(topic):]
+
+
+class QueryCondenser:
+    """把追问改写成独立问题：规则优先，LLM兜底，结果记忆"""
+
+    def __init__(self,
+                 llm=None,
+                 lock=None,
+                 max_tokens: int = 48,
+                 max_turns: int = 2,
+                 cache_size: int = 1024,
+                 short_question: int = 8):
+        """
+        Args:
+            llm: 规则拿不准时用来改写的模型（None = 只用规则）
+            lock: 调用模型时持有的锁（本进程内的 Llama 不能并发使用）
+            max_tokens: LLM改写的最大token数
+            max_turns: LLM改写时带上最近几轮对话
+            cache_size: 记忆多少条改写结果
+            short_question: 没有承接词、代词时，不超过这个字数的问题也当作可能的追问
+        """
+        self.llm = llm
+        self.lock = lock or nullcontext()
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.cache_size = cache_size
+        self.short_question = short_question
+        self.cache = OrderedDict()
+        self.topics = OrderedDict()    # 规则改写出的问题 → 主题（下一次追问直接用，不用再拆）
+        self.stats = {'standalone': 0, 'rule': 0, 'llm': 0, 'cache_hits': 0, 'unresolved': 0}
+
+    @staticmethod
+    def _history_key(history: List[Tuple[str, str]]) -> str:
+        h = hashlib.sha1()
+        for query, answer in history:
+            h.update(query.encode("utf-8"))
+            h.update(b"\x00")
+            h.update(answer.encode("utf-8"))
+            h.update(b"\x01")
+        return h.hexdigest()
+
+    def condense(self, question: str, history: List[Tuple[str, str]]) -> Tuple[str, str]:
+        """
+        改写追问
+
+        Args:
+            question: 用户这次的问题
+            history: 之前的对话 [(独立问题, 回答), ...]，旧 → 新；
+                     问题应当是改写后的版本，这样连续追问也能找到主题
+
+        Returns:
+            (用于检索的问题, 方式)，方式为 standalone / rule / llm / cache / unresolved
+        """
+        if not history:
+            self.stats['standalone'] += 1
+            return question, 'standalone'
+
+        key = (self._history_key(history[-self.max_turns:]), question)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats['cache_hits'] += 1
+            return self.cache[key], 'cache'
+
+        rewritten, method = self._rule(question, history[-1][0])
+        if method == 'uncertain':
+            rewritten = self._llm_rewrite(question, history) if self.llm is not None else None
+            method = 'llm' if rewritten else 'unresolved'
+            rewritten = rewritten or question
+        self.stats[method] += 1
+
+        self.cache[key] = rewritten
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return rewritten, method
+
+    # ---------------- 规则 ----------------
+
+    def _rule(self, question: str, previous: str) -> Tuple[str, str]:
+        """
+        Returns:
+            (改写结果, 'rule')；不是追问时 (原问题, 'standalone')；
+            像追问但规则处理不了时 (原问题, 'uncertain')
+        """
+        text = question.strip()
+        # 先认代词再认承接词："那个罚款" 的 "那" 不是承接词
+        connective = None
+        if not any(text.startswith(p) for p in PRONOUNS):
+            connective = next((c for c in LEADING_CONNECTIVES if text.startswith(c)), None)
+        body = text[len(connective):].lstrip("，, ") if connective else text
+        pronoun = find_pronoun(body)
+        ends_with_ne = _strip_question(body).endswith("呢")
+
+        if body.startswith(REFERRING_WORDS):
+            # "其他情况呢？""其中哪些情形会被拘留？"：是追问，但没有可以替换的代词
+            return question, 'uncertain'
+
+        short = len(_strip_question(body)) <= self.short_question
+
+        if not (connective or pronoun or ends_with_ne):
+            # 没有任何追问标志：较长或有明确主题的问题当作独立问题，
+            # 很短又几乎没有主题的（"扣几分？"）交给LLM判断
+            if short and len(split_topic(text)[0]) < 2:
+                return question, 'uncertain'
+            return question, 'standalone'
+
+        if previous in self.topics:
+            topic = self.topics[previous]
+            predicate = previous[len(topic):] if previous.startswith(topic) else split_topic(previous)[1]
+        else:
+            topic, predicate = split_topic(previous)
+        if not topic:
+            return question, 'uncertain'
+
+        if ends_with_ne and not pronoun:
+            # "酒驾呢？" → 新主题 + 上一问的谓语
+            new_topic = _strip_question(body)[:-1].strip()
+            if new_topic and not split_topic(new_topic)[0]:
+                return self._remember(new_topic + predicate, new_topic), 'rule'
+            if not new_topic:
+                return question, 'uncertain'
+
+        if pronoun:
+            # "它要扣几分" → "醉驾要扣几分"
+            word, position = pronoun
+            return self._remember(body[:position] + topic + body[position + len(word):], topic), 'rule'
+
+        # "那罚多少钱？" → "醉驾罚多少钱？"
+        if body and topic not in body:
+            return self._remember(topic + body, topic), 'rule'
+        return body or question, 'rule'
+
+    def _remember(self, rewritten: str, topic: str) -> str:
+        self.topics[rewritten] = topic
+        if len(self.topics) > self.cache_size:
+            self.topics.popitem(last=False)
+        return rewritten
+
+    # ---------------- LLM兜底 ----------------
+
+    def _llm_rewrite(self, question: str, history: List[Tuple[str, str]]) -> Optional[str]:
+        lines = []
+        for query, answer in history[-self.max_turns:]:
+            lines.append(f"用户：{query}")
+            lines.append(f"助手：{answer[:100]}")
+        prompt = CONDENSE_PROMPT.format(history="\n".join(lines), question=question)
+
+        with self.lock:
+            output = self.llm(prompt, max_tokens=self.max_tokens, temperature=0.0,
+                              stop=["<|im_end|>", "\n"], stream=False)
+        text = output['choices'][0]['text'].strip()
+        text = re.sub(r"^(改写后的问题|问题)[:：]\s*", "", text)
+        # 太短或远长于原问题的输出不可信
+        if len(text) < 2 or len(text) > max(4 * len(question), 60):
+            return None
+        return text
+
+
+# 规则改写的回归用例：(上一问, 追问, 期望的检索问题)
+# 期望与追问相同表示规则不改写（独立问题，或交给LLM）
+REGRESSION_CASES = [
+    ("醉驾会受到什么处罚？", "劳动合同应该包括哪些内容？", "劳动合同应该包括哪些内容？"),
+    ("醉驾会受到什么处罚？", "其他情况呢？", "其他情况呢？"),
+    ("醉驾会受到什么处罚？", "其中哪些情形会被拘留？", "其中哪些情形会被拘留？"),
+    ("醉驾会受到什么处罚？", "那个罚款怎么交？", "醉驾罚款怎么交？"),
+    ("醉驾会受到什么处罚？", "那请问罚多少钱？", "醉驾罚多少钱？"),
+    ("醉驾会受到什么处罚？", "那罚多少钱？", "醉驾罚多少钱？"),
+    ("醉驾会受到什么处罚？", "它要扣几分？", "醉驾要扣几分？"),
+    ("醉驾会受到什么处罚？", "酒驾呢？", "酒驾会受到什么处罚？"),
+]
+
+
+def check_rules() -> bool:
+    """逐条检查 REGRESSION_CASES，打印不符合的用例"""
+    ok = True
+    for previous, question, expected in REGRESSION_CASES:
+        rewritten, method = QueryCondenser().condense(question, [(previous, "……")])
+        if rewritten != expected:
+            ok = False
+            print(f"   ❌ {question} → {rewritten} ({method})，期望 {expected}")
+    print(f"   {'✅' if ok else '❌'} 规则回归用例 {len(REGRESSION_CASES)} 条")
+    return ok
+
+
+def demo():
+    """演示规则改写（不需要模型）"""
+    print("=" * 60)
+    print("RAG最终项目 - 追问改写演示")
+    print("=" * 60)
+
+    condenser = QueryCondenser()
+    history = []
+    dialogue = [
+        "醉驾会受到什么处罚？",
+        "那罚多少钱？",
+        "酒驾呢？",
+        "它要扣几分？",
+        "劳动者的工作时间有什么规定？",
+        "加班呢？",
+    ]
+    for question in dialogue:
+        rewritten, method = condenser.condense(question, history)
+        print(f"\n👤 {question}")
+        if rewritten != question:
+            print(f"   🔁 检索: {rewritten}  ({method})")
+        else:
+            print(f"   ➡️  原样检索  ({method})")
+        history.append((rewritten, "……"))
+
+    # 同一段历史下再问一次：直接命中记忆
+    condenser.condense(dialogue[-1], history[:-1])
+    print(f"\n📊 {condenser.stats}")
+
+    print("\n🧪 回归用例:")
+    check_rules()
+
+
+if __name__ == "__main__":
+    demo()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 端到端延迟基准测试
+
+原来的计时分散在各处的 time.time() 打印里，没法比较两次改动的效果。
+这个脚本用一组问题驱动 ProductionRAG 或 TrafficLawRAG（step5），记录每个阶段的耗时：
+
+    embed → ann → keyword → fusion → hydrate → rerank → prompt_build
+    → prefill → ttft（首token）→ decode → total
+
+输出每个阶段的 p50/p95/p99 和吞吐量（JSON），并与保存的基线比较，
+超出容忍度的阶段标记为回归（退出码 1，可以放进CI）。
+
+    python 10_latency_benchmark.py --limit 20 --output latency.json
+    python 10_latency_benchmark.py --save-baseline latency_baseline.json
+    python 10_latency_benchmark.py --baseline latency_baseline.json --tolerance 0.2
+
+预填充时间：本进程内的 Llama 读取 llama.cpp 的性能计数器（准确值）；
+其他后端用 首token延迟 - 单个token的解码时间 估算。
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from typing import List, Dict, Any, Optional
+
+from pathlib import Path
+import importlib.util
+
+current_dir = Path(__file__).parent
+ROOT = current_dir.parents[1]
+DEFAULT_QUERIES = ROOT / "data" / "eval.jsonl"
+DEFAULT_MODEL = os.path.expanduser("~/llama.cpp/models/qwen2.5-3b-instruct-q4_k_m.gguf")
+
+sys.path.insert(0, str(ROOT / "01_inference"))
+from tracing import percentile
+
+# 报告中的阶段顺序
+STAGES = ['embed', 'ann', 'keyword', 'fusion', 'hydrate', 'rerank', 'context_window',
+          'prompt_build', 'prefill', 'ttft', 'decode', 'total']
+
+
+def _load_module(name: str, path: Path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ============================================================
+# 计时代理
+# ============================================================
+
+class TimedLLM:
+    """
+    包一层LLM，记录每次流式调用的预填充、首token、解码时间
+
+    其余属性和方法原样转发，RAG系统感觉不到区别
+    """
+
+    def __init__(self, llm):
+        self._llm = llm
+        self.last = {}
+        self._perf = self._perf_functions()
+
+    def _perf_functions(self):
+        """llama.cpp 的性能计数器（只有本进程内的 Llama 才有）"""
+        if not hasattr(self._llm, '_ctx'):
+            return None
+        try:
+            import llama_cpp
+        except ImportError:
+            return None
+        if hasattr(llama_cpp, 'llama_perf_context') and hasattr(llama_cpp, 'llama_perf_context_reset'):
+            return llama_cpp.llama_perf_context, llama_cpp.llama_perf_context_reset
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self._llm, name)
+
+    def __call__(self, prompt, *args, stream=False, **kwargs):
+        if not stream:
+            return self._llm(prompt, *args, stream=False, **kwargs)
+        return self._timed_stream(prompt, *args, **kwargs)
+
+    def _timed_stream(self, prompt, *args, **kwargs):
+        ctx = self._llm._ctx.ctx if self._perf else None
+        if self._perf:
+            self._perf[1](ctx)
+
+        start = time.perf_counter()
+        first = None
+        n_chunks = 0
+        for chunk in self._llm(prompt, *args, stream=True, **kwargs):
+            if first is None:
+                first = time.perf_counter()
+            n_chunks += 1
+            yield chunk
+        end = time.perf_counter()
+        first = first or end
+
+        decode = end - first
+        per_token = decode / max(n_chunks - 1, 1)
+        self.last = {
+            'ttft': first - start,
+            'decode': decode,
+            'n_tokens': n_chunks,
+            # 估算：首token延迟里扣掉一次解码
+            'prefill': max(first - start - per_token, 0.0),
+            'prefill_exact': False
+        }
+        if self._perf:
+            perf = self._perf[0](ctx)
+            self.last['prefill'] = perf.t_p_eval_ms / 1000
+            self.last['prefill_tokens'] = perf.n_p_eval
+            self.last['prefill_exact'] = True
+
+
+class _StageTimer:
+    """给对象的某些方法计时（TrafficLawRAG 没有内置的分阶段计时）"""
+
+    def __init__(self, target, methods: Dict[str, str], timings: Dict[str, float]):
+        self._target = target
+        self._methods = methods
+        self._timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        stage = self._methods.get(name)
+        if stage is None or not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._timings[stage] = self._timings.get(stage, 0.0) + time.perf_counter() - start
+        return timed
+
+
+# ============================================================
+# 被测系统
+# ============================================================
+
+class ProductionTarget:
+    """ProductionRAG：检索器和 answer() 已经带分阶段计时"""
+
+    name = 'production'
+
+    def __init__(self, model_path: str, chroma_path: str, use_answer_cache: bool = False):
+        rag_application = _load_module("rag_application", current_dir / "03_rag_application.py")
+        with redirect_stdout(io.StringIO()):
+            self.rag = rag_application.ProductionRAG(model_path=model_path, chroma_path=chroma_path)
+        # 答案缓存会让重复的问题跳过LLM，测延迟时默认关闭
+        self.rag.config['use_answer_cache'] = use_answer_cache
+        self.llm = TimedLLM(self.rag.llm)
+        self.rag.llm = self.llm
+        self.model_path = model_path
+
+    def run(self, query: str) -> Dict[str, Any]:
+        # 每个问题都从冷的查询向量开始，embed 阶段才有意义
+        self.rag.retriever._query_embeddings.clear()
+        self.llm.last = {}
+        result = None
+        for item in self.rag.answer(query, stream=True, verbose=False):
+            if 'total_time' in item:
+                result = item
+
+        # ttft/decode 用 answer() 自己的计时（包含前缀KV恢复），预填充来自计时代理
+        timings = dict(result.get('timings', {}))
+        if self.llm.last:
+            timings['prefill'] = self.llm.last['prefill']
+        timings['total'] = result['total_time']
+        return {
+            'timings': timings,
+            'n_tokens': self.llm.last.get('n_tokens', 0),
+            'prefill_exact': self.llm.last.get('prefill_exact', False),
+            'cached': result.get('cached', False)
+        }
+
+    def describe(self) -> Dict[str, Any]:
+        return {'model': os.path.basename(self.model_path), 'config': dict(self.rag.config)}
+
+
+class TrafficLawTarget:
+    """step5 的 TrafficLawRAG：给向量模型和集合加上计时代理"""
+
+    name = 'traffic'
+
+    def __init__(self, model_path: str, chroma_path: str):
+        step5_dir = current_dir.parent / "step5_retrieval"
+        sys.path.insert(0, str(step5_dir))
+        interactive_qa = _load_module("interactive_qa", step5_dir / "05_interactive_qa.py")
+
+        self.timings = {}
+        self._history_dir = tempfile.TemporaryDirectory()
+        with redirect_stdout(io.StringIO()):
+            self.rag = interactive_qa.TrafficLawRAG(
+                db_path=chroma_path,
+                embedding_model_name="shibing624/text2vec-base-chinese",
+                llm_path=model_path,
+                history_path=os.path.join(self._history_dir.name, "history.jsonl")
+            )
+        self.rag.embedding_model = _StageTimer(self.rag.embedding_model, {'encode': 'embed'}, self.timings)
+        self.rag.collection = _StageTimer(self.rag.collection, {'query': 'ann'}, self.timings)
+        self.llm = TimedLLM(self.rag.llm)
+        self.rag.llm = self.llm
+        self.model_path = model_path
+
+    def run(self, query: str) -> Dict[str, Any]:
+        self.timings.clear()
+        self.llm.last = {}
+        start = time.perf_counter()
+        # 直接调用检索和生成（query() 会写历史、打印检索结果）
+        with redirect_stdout(io.StringIO()):
+            docs = self.rag.retrieve(query)
+            context = "\n\n".join(doc['content'] for doc in docs)
+            self.rag.generate(query, context, stream=True)
+        total = time.perf_counter() - start
+
+        timings = dict(self.timings)
+        if self.llm.last:
+            timings['prefill'] = self.llm.last['prefill']
+            timings['ttft'] = self.llm.last['ttft']
+            timings['decode'] = self.llm.last['decode']
+        timings['total'] = total
+        return {
+            'timings': timings,
+            'n_tokens': self.llm.last.get('n_tokens', 0),
+            'prefill_exact': self.llm.last.get('prefill_exact', False),
+            'cached': False
+        }
+
+    def describe(self) -> Dict[str, Any]:
+        return {'model': os.path.basename(self.model_path)}
+
+
+# ============================================================
+# 统计与报告
+# ============================================================
+
+def summarize(samples: List[Dict[str, Any]], wall_time: float) -> Dict[str, Any]:
+    """把每个问题的计时汇总成各阶段的百分位和吞吐量"""
+    stages = {}
+    for stage in STAGES:
+        values = [s['timings'][stage] * 1000 for s in samples if stage in s['timings']]
+        if not values:
+            continue
+        stages[stage] = {
+            'count': len(values),
+            'mean_ms': sum(values) / len(values),
+            'p50_ms': percentile(values, 50),
+            'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99),
+            'max_ms': max(values)
+        }
+
+    decode_time = sum(s['timings'].get('decode', 0.0) for s in samples)
+    decode_tokens = sum(max(s['n_tokens'] - 1, 0) for s in samples)
+    return {
+        'stages': stages,
+        'throughput': {
+            'queries_per_sec': len(samples) / wall_time if wall_time > 0 else 0.0,
+            'decode_tokens_per_sec': decode_tokens / decode_time if decode_time > 0 else 0.0,
+            'generated_tokens': sum(s['n_tokens'] for s in samples)
+        },
+        'prefill_exact': all(s['prefill_exact'] for s in samples) if samples else False,
+        'cached_answers': sum(1 for s in samples if s['cached'])
+    }
+
+
+def compare(report: Dict[str, Any],
+            baseline: Dict[str, Any],
+            tolerance: float = 0.2,
+            min_delta_ms: float = 5.0) -> List[Dict[str, Any]]:
+    """
+    与基线比较
+
+    某阶段的 p50 或 p95 比基线慢 tolerance 以上（且绝对差超过 min_delta_ms，
+    避免微秒级阶段的抖动误报），或吞吐量下降 tolerance 以上，记为回归
+    """
+    regressions = []
+    for stage, current in report['stages'].items():
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            continue
+        for metric in ('p50_ms', 'p95_ms'):
+            old, new = base[metric], current[metric]
+            if new > old * (1 + tolerance) and new - old > min_delta_ms:
+                regressions.append({'stage': stage, 'metric': metric, 'baseline': old, 'current': new,
+                                    'change': (new - old) / old if old > 0 else float('inf')})
+
+    for metric, old in baseline.get('throughput', {}).items():
+        if metric == 'generated_tokens':
+            continue
+        new = report['throughput'].get(metric, 0.0)
+        if old > 0 and new < old * (1 - tolerance):
+            regressions.append({'stage': 'throughput', 'metric': metric, 'baseline': old, 'current': new,
+                                'change': (new - old) / old})
+    return regressions
+
+
+def print_report(report: Dict[str, Any], regressions: Optional[List[Dict[str, Any]]] = None):
+    meta = report['meta']
+    print("\n" + "=" * 72)
+    print(f"📊 延迟基准: {meta['target']} | {meta['model']} | {meta['n_samples']} 次请求")
+    print("=" * 72)
+    print(f"{'阶段':<16}{'p50':>10}{'p95':>10}{'p99':>10}{'均值':>10}{'次数':>8}")
+    print("-" * 72)
+    for stage, s in report['stages'].items():
+        print(f"{stage:<16}{s['p50_ms']:>9.1f}ms{s['p95_ms']:>8.1f}ms{s['p99_ms']:>8.1f}ms"
+              f"{s['mean_ms']:>8.1f}ms{s['count']:>8}")
+    print("-" * 72)
+    tp = report['throughput']
+    print(f"吞吐量: {tp['queries_per_sec']:.2f} 问/秒, 解码 {tp['decode_tokens_per_sec']:.1f} tokens/秒")
+    if not report['prefill_exact']:
+        print("ℹ️  prefill 为估算值（首token延迟 - 单token解码时间）")
+    if report['cached_answers']:
+        print(f"ℹ️  {report['cached_answers']} 次命中答案缓存")
+
+    if regressions is None:
+        return
+    if not regressions:
+        print("\n✅ 与基线相比没有回归")
+        return
+    print(f"\n❌ 发现 {len(regressions)} 项回归:")
+    for r in regressions:
+        unit = "" if r['stage'] == 'throughput' else "ms"
+        print(f"   {r['stage']}.{r['metric']}: {r['baseline']:.1f}{unit} → {r['current']:.1f}{unit} "
+              f"({r['change']:+.0%})")
+
+
+# ============================================================
+# 运行
+# ============================================================
+
+def load_queries(path: Path, limit: Optional[int] = None) -> List[str]:
+    """读取问题：.jsonl（messages 格式取用户消息，或 question 字段）或每行一个问题的文本文件"""
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.suffix == ".jsonl":
+                record = json.loads(line)
+                if 'messages' in record:
+                    line = next((m['content'] for m in record['messages'] if m['role'] == 'user'), "")
+                else:
+                    line = record.get('question') or record.get('query', "")
+            if line:
+                queries.append(line)
+            if limit and len(queries) >= limit:
+                break
+    return queries
+
+
+def run_benchmark(target, queries: List[str], repeat: int = 1, warmup: int = 1) -> Dict[str, Any]:
+    """依次执行每个问题，返回报告（含每次请求的原始计时）"""
+    for query in queries[:warmup]:
+        target.run(query)   # 预热：加载模型权重到内存、建立前缀缓存
+
+    samples = []
+    wall_start = time.perf_counter()
+    total = len(queries) * repeat
+    for r in range(repeat):
+        for i, query in enumerate(queries, 1):
+            sample = target.run(query)
+            sample['query'] = query
+            samples.append(sample)
+            done = r * len(queries) + i
+            print(f"\r   进度 {done}/{total}  最近一次 {sample['timings']['total']*1000:.0f}ms", end="", flush=True)
+    print()
+    wall_time = time.perf_counter() - wall_start
+
+    report = summarize(samples, wall_time)
+    report['meta'] = {
+        'target': target.name,
+        'n_queries': len(queries),
+        'repeat': repeat,
+        'n_samples': len(samples),
+        'wall_time': wall_time,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        **target.describe()
+    }
+    report['samples'] = [
+        {'query': s['query'], 'n_tokens': s['n_tokens'],
+         'timings_ms': {k: v * 1000 for k, v in s['timings'].items()}}
+        for s in samples
+    ]
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG端到端延迟基准测试")
+    parser.add_argument("--target", choices=["production", "traffic"], default="production",
+                        help="production = step6 ProductionRAG，traffic = step5 TrafficLawRAG")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help="GGUF模型路径")
+    parser.add_argument("--chroma", default=None, help="向量库路径（默认用各系统自己的）")
+    parser.add_argument("--queries", default=str(DEFAULT_QUERIES), help="问题文件（.jsonl 或每行一个问题）")
+    parser.add_argument("--limit", type=int, default=20, help="最多使用多少个问题")
+    parser.add_argument("--repeat", type=int, default=1, help="每个问题重复几次")
+    parser.add_argument("--warmup", type=int, default=1, help="预热请求数（不计入统计）")
+    parser.add_argument("--answer-cache", action="store_true", help="保留 ProductionRAG 的答案缓存")
+    parser.add_argument("--output", default="latency_report.json", help="报告输出路径")
+    parser.add_argument("--baseline", help="与这个基线报告比较")
+    parser.add_argument("--save-baseline", help="把本次结果另存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的变慢比例")
+    parser.add_argument("--min-delta-ms", type=float, default=5.0, help="小于这个绝对差不算回归")
+    args = parser.parse_args()
+
+    queries = load_queries(Path(args.queries), args.limit)
+    if not queries:
+        print(f"❌ 没有读到问题: {args.queries}")
+        sys.exit(2)
+
+    print(f"🚀 加载 {args.target} 系统...")
+    if args.target == "production":
+        target = ProductionTarget(args.model, args.chroma or str(current_dir / "data" / "document_store"),
+                                  use_answer_cache=args.answer_cache)
+    else:
+        default_db = current_dir.parent / "step4_vectorstore" / "data" / "chroma_traffic_law"
+        target = TrafficLawTarget(args.model, args.chroma or str(default_db))
+
+    print(f"⏱️  {len(queries)} 个问题 × {args.repeat} 次（预热 {args.warmup} 次）")
+    report = run_benchmark(target, queries, repeat=args.repeat, warmup=args.warmup)
+
+    regressions = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        report['regressions'] = regressions
+
+    print_report(report, regressions)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 报告已保存: {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 基线已保存: {args.save_baseline}")
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+RAG最终项目 - 检索质量 vs 延迟基准
+
+data/train.jsonl 和 data/eval.jsonl 里的问答都出自 traffic_law_document.md，
+这个脚本用它们检查检索质量，保证每一次提速都不以质量为代价：
+
+1. 把每个标准答案对应到文档块（字符二元组覆盖率最高的块 = 金标准块）
+2. 分别运行 向量 / 关键词 / 混合（多组权重）/ 加重排序 的检索流程
+3. 统计 recall@k、MRR 和每个问题的检索延迟
+4. 打印一张 质量-延迟 表，标出帕累托最优的流程（没有别的流程又快又准）
+
+    python 11_retrieval_benchmark.py
+    python 11_retrieval_benchmark.py --chroma ./data/document_store --collection documents
+    python 11_retrieval_benchmark.py --save-gold gold.json     # 保存对应关系，方便人工校对
+    python 11_retrieval_benchmark.py --gold gold.json          # 使用校对过的对应关系
+"""
+
+import io
+import sys
+import json
+import time
+import argparse
+from contextlib import redirect_stdout
+from typing import List, Dict, Any, Callable
+
+from pathlib import Path
+import importlib.util
+
+# 动态导入同目录的模块
+current_dir = Path(__file__).parent
+retrieval_module_path = current_dir / "02_advanced_retrieval.py"
+spec = importlib.util.spec_from_file_location("advanced_retrieval", retrieval_module_path)
+advanced_retrieval = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(advanced_retrieval)
+AdvancedRetriever = advanced_retrieval.AdvancedRetriever
+
+sys.path.insert(0, str(current_dir.parents[1] / "01_inference"))
+from tracing import percentile
+
+ROOT = current_dir.parents[1]
+DATA_FILES = {'train': ROOT / "data" / "train.jsonl", 'eval': ROOT / "data" / "eval.jsonl"}
+DEFAULT_CHROMA = current_dir.parent / "step4_vectorstore" / "data" / "chroma_traffic_law"
+
+KS = (1, 3, 5, 10)
+HYBRID_WEIGHTS = (0.3, 0.5, 0.7, 0.9)
+
+
+# ============================================================
+# 数据与金标准
+# ============================================================
+
+def load_qa(splits: List[str]) -> List[Dict[str, str]]:
+    """读取问答对（messages 格式），重复的问题只保留一次"""
+    qa = []
+    seen = set()
+    for split in splits:
+        with open(DATA_FILES[split], encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                messages = json.loads(line)['messages']
+                question = next(m['content'] for m in messages if m['role'] == 'user')
+                answer = next(m['content'] for m in messages if m['role'] == 'assistant')
+                if question not in seen:
+                    seen.add(question)
+                    qa.append({'question': question, 'answer': answer, 'split': split})
+    return qa
+
+
+def _bigrams(text: str) -> set:
+    chars = [c for c in text if not c.isspace()]
+    return {a + b for a, b in zip(chars, chars[1:])}
+
+
+def map_gold_chunks(qa: List[Dict[str, str]],
+                    chunk_ids: List[str],
+                    chunk_texts: List[str],
+                    min_score: float = 0.15,
+                    relative: float = 0.8) -> Dict[str, List[str]]:
+    """
+    为每个答案找金标准块
+
+    分数 = 问题 + 答案的字符二元组有多少比例出现在块里（答案大多是转述，
+    单看答案重合度偏低）；取最高分的块，以及分数不低于最高分 relative 倍的块（答案跨块时）
+
+    Returns:
+        {问题: [块id, ...]}，找不到可信对应（最高分 < min_score）的问题不在结果里
+    """
+    chunk_grams = [_bigrams(t) for t in chunk_texts]
+    gold = {}
+    for item in qa:
+        grams = _bigrams(item['question'] + item['answer'])
+        if not grams:
+            continue
+        scores = [len(grams & cg) / len(grams) for cg in chunk_grams]
+        best = max(scores, default=0.0)
+        if best < min_score:
+            continue
+        gold[item['question']] = [cid for cid, s in zip(chunk_ids, scores) if s >= best * relative]
+    return gold
+
+
+# ============================================================
+# 检索流程
+# ============================================================
+
+def build_pipelines(retriever, k: int) -> Dict[str, Callable[[str], List[Dict[str, Any]]]]:
+    """各个待评估的检索流程：query → 排好序的结果"""
+    def vector(q):
+        return retriever.vector_search(q, n_results=k)
+
+    def keyword(q):
+        return retriever.keyword_search(q, n_results=k)
+
+    def hybrid(weight):
+        def run(q):
+            return retriever.hybrid_search(q, n_results=k, vector_weight=weight, keyword_weight=1 - weight)
+        return run
+
+    def reranked(first_stage):
+        # 与 ProductionRAG.retrieve 相同：先取 2k 个候选，再重排序取前 k 个
+        def run(q):
+            candidates = first_stage(q)
+            return retriever.rerank_results(q, candidates, top_k=k)
+        return run
+
+    pipelines = {'vector': vector, 'keyword': keyword}
+    for weight in HYBRID_WEIGHTS:
+        pipelines[f'hybrid(v={weight:.1f})'] = hybrid(weight)
+    pipelines['vector+rerank'] = reranked(lambda q: retriever.vector_search(q, n_results=2 * k))
+    pipelines['hybrid(v=0.7)+rerank'] = reranked(
+        lambda q: retriever.hybrid_search(q, n_results=2 * k, vector_weight=0.7, keyword_weight=0.3)
+    )
+    return pipelines
+
+
+def evaluate(retriever,
+             pipeline: Callable[[str], List[Dict[str, Any]]],
+             questions: List[str],
+             gold: Dict[str, List[str]],
+             warm: bool = False) -> Dict[str, Any]:
+    """对一个流程计算 recall@k、MRR 和延迟"""
+    recalls = {k: [] for k in KS}
+    reciprocal_ranks = []
+    latencies = []
+    per_query = []
+
+    for question in questions:
+        if not warm:
+            # 每个问题都重新编码，向量检索的延迟才包含 embedding
+            retriever._query_embeddings.clear()
+        start = time.perf_counter()
+        results = pipeline(question)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        ranked = [r['id'] for r in results]
+        targets = set(gold[question])
+        for k in KS:
+            recalls[k].append(len(targets & set(ranked[:k])) / len(targets))
+        rank = next((i for i, doc_id in enumerate(ranked, 1) if doc_id in targets), None)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+        per_query.append({'question': question, 'rank': rank, 'latency_ms': latencies[-1]})
+
+    n = len(questions)
+    return {
+        **{f'recall@{k}': sum(v) / n for k, v in recalls.items()},
+        'mrr': sum(reciprocal_ranks) / n,
+        'latency_p50_ms': percentile(latencies, 50),
+        'latency_p95_ms': percentile(latencies, 95),
+        'latency_mean_ms': sum(latencies) / n,
+        'per_query': per_query
+    }
+
+
+def pareto_front(results: Dict[str, Dict[str, Any]], quality: str = 'recall@5',
+                 latency: str = 'latency_p50_ms') -> List[str]:
+    """质量更高（或相同）且更快（或相同）、并且至少一项严格更好的流程会支配另一个"""
+    front = []
+    for name, r in results.items():
+        dominated = any(
+            o[quality] >= r[quality] and o[latency] <= r[latency] and
+            (o[quality] > r[quality] or o[latency] < r[latency])
+            for other, o in results.items() if other != name
+        )
+        if not dominated:
+            front.append(name)
+    return front
+
+
+def print_table(results: Dict[str, Dict[str, Any]], front: List[str], n_questions: int):
+    print("\n" + "=" * 92)
+    print(f"📊 检索质量 vs 延迟（{n_questions} 个问题，★ = 帕累托最优：recall@5 vs p50延迟）")
+    print("=" * 92)
+    header = f"{'流程':<24}" + "".join(f"{'R@' + str(k):>8}" for k in KS) + f"{'MRR':>8}{'p50':>10}{'p95':>10}"
+    print(header)
+    print("-" * 92)
+    for name, r in sorted(results.items(), key=lambda item: item[1]['latency_p50_ms']):
+        mark = "★ " if name in front else "  "
+        row = f"{mark}{name:<22}" + "".join(f"{r[f'recall@{k}']:>8.2f}" for k in KS)
+        row += f"{r['mrr']:>8.3f}{r['latency_p50_ms']:>8.1f}ms{r['latency_p95_ms']:>8.1f}ms"
+        print(row)
+    print("-" * 92)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="检索质量 vs 延迟基准")
+    parser.add_argument("--chroma", default=str(DEFAULT_CHROMA), help="ChromaDB路径")
+    parser.add_argument("--collection", default="traffic_law", help="集合名称")
+    parser.add_argument("--split", choices=["train", "eval", "all"], default="all", help="使用哪部分问答")
+    parser.add_argument("--k", type=int, default=max(KS), help="每个流程返回的结果数")
+    parser.add_argument("--warm", action="store_true", help="保留查询向量缓存（只测检索本身）")
+    parser.add_argument("--gold", help="读取人工校对过的 {问题: [块id]} 对应关系")
+    parser.add_argument("--save-gold", help="把自动生成的对应关系保存下来")
+    parser.add_argument("--output", default="retrieval_benchmark.json", help="报告输出路径")
+    args = parser.parse_args()
+    if args.k < max(KS):
+        parser.error(f"--k 不能小于 {max(KS)}（要计算 recall@{max(KS)}）")
+
+    splits = ["train", "eval"] if args.split == "all" else [args.split]
+    qa = load_qa(splits)
+    print(f"📋 {len(qa)} 个问答对 ({', '.join(splits)})")
+
+    with redirect_stdout(io.StringIO()):
+        retriever = AdvancedRetriever(chroma_path=args.chroma, collection_name=args.collection)
+    collection = retriever.collection.get(include=["documents"])
+    print(f"📚 {len(collection['ids'])} 个文档块 ({args.collection})")
+
+    if args.gold:
+        with open(args.gold, encoding="utf-8") as f:
+            gold = json.load(f)
+    else:
+        gold = map_gold_chunks(qa, collection['ids'], collection['documents'])
+    if args.save_gold:
+        with open(args.save_gold, "w", encoding="utf-8") as f:
+            json.dump(gold, f, ensure_ascii=False, indent=2)
+        print(f"💾 对应关系已保存: {args.save_gold}")
+
+    questions = [item['question'] for item in qa if item['question'] in gold]
+    skipped = len(qa) - len(questions)
+    print(f"🎯 {len(questions)} 个问题找到金标准块" + (f"，{skipped} 个答案在文档里找不到对应，跳过" if skipped else ""))
+    if not questions:
+        sys.exit(1)
+
+    results = {}
+    for name, pipeline in build_pipelines(retriever, args.k).items():
+        print(f"   ⏱️  {name}...", end="", flush=True)
+        pipeline(questions[0])   # 预热
+        results[name] = evaluate(retriever, pipeline, questions, gold, warm=args.warm)
+        print(f" recall@5={results[name]['recall@5']:.2f}, p50={results[name]['latency_p50_ms']:.1f}ms")
+
+    front = pareto_front(results)
+    print_table(results, front, len(questions))
+
+    report = {
+        'collection': args.collection,
+        'n_questions': len(questions),
+        'splits': splits,
+        'k': args.k,
+        'pareto_front': front,
+        'pipelines': results,
+        'gold': gold
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n💾 报告已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()